@@ -0,0 +1,82 @@
+from typing import Iterator
+import bisect
+import datetime
+import itertools
+import random
+
+
+# Rows written per executemany call
+CHUNK_SIZE = 10000
+
+
+def get_popularity(num_friends: int, skew: float) -> list[float]:
+    # Cumulative Zipf weights: a few friends share most of the expenses
+    return list(itertools.accumulate(1 / (rank + 1) ** skew for rank in range(num_friends)))
+
+
+def get_num_participants(num_expenses: int, num_links: int, max_participants: int, rng: random.Random) -> list[int]:
+    # Exponentially distributed group sizes (many small groups, a few big trips) scaled to num_links
+    sizes = [rng.expovariate(1) for _ in range(num_expenses)]
+    scale = num_links / sum(sizes)
+    return [min(max_participants, max(1, round(size * scale))) for size in sizes]
+
+
+def chunks(rows: Iterator[tuple]) -> Iterator[list[tuple]]:
+    while True:
+        chunk = list(itertools.islice(rows, CHUNK_SIZE))
+        if not chunk:
+            return
+        yield chunk
+
+
+def generate(engine, num_friends: int, num_expenses: int, num_links: int, seed: int = 0,
+             skew: float = 1.0, max_participants: int = 50, paid_ratio: float = 0.3) -> dict[str, int]:
+    # Fill an empty database with a synthetic dataset. The stored balances are computed while
+    # generating, so the dataset is consistent without running the reconciliation.
+    # Expenses and links are streamed to the database: only the friend balances are kept in memory.
+    rng = random.Random(seed)
+    max_participants = max(1, min(max_participants, num_friends // 2))
+    num_participants = get_num_participants(num_expenses, num_links, max_participants, rng)
+    popularity = get_popularity(num_friends, skew)
+    total_weight = popularity[-1]
+    start_date = datetime.date(2020, 1, 1)
+    credit_balances = [0.0] * num_friends
+    debit_balances = [0.0] * num_friends
+    num_generated_links = 0
+
+    with engine.begin() as connection:
+        friends = ((index + 1, f"Friend {index + 1:07d}") for index in range(num_friends))
+        for chunk in chunks(friends):
+            connection.exec_driver_sql("INSERT INTO friend (id, name, credit_balance, debit_balance) VALUES (?, ?, 0, 0)", chunk)
+
+        expenses = []
+        links = []
+        for expense_index in range(num_expenses):
+            amount = float(rng.randint(5, 2000))
+            friend_indexes = set()
+            while len(friend_indexes) < num_participants[expense_index]:
+                friend_indexes.add(bisect.bisect_left(popularity, rng.random() * total_weight))
+            share = amount / (len(friend_indexes) + 1)
+            credit_balance = 0.0
+            for friend_index in sorted(friend_indexes):
+                credit = share if rng.random() < paid_ratio else 0.0
+                credit_balance += credit
+                credit_balances[friend_index] += credit
+                debit_balances[friend_index] += share
+                links.append((friend_index + 1, expense_index + 1, credit))
+            date = start_date + datetime.timedelta(days=rng.randint(0, 5 * 365))
+            expenses.append((expense_index + 1, f"Expense {expense_index + 1}", date.isoformat(), amount,
+                             credit_balance, len(friend_indexes) + 1))
+            if len(links) >= CHUNK_SIZE or expense_index == num_expenses - 1:
+                connection.exec_driver_sql("INSERT INTO expense (id, description, date, amount, credit_balance, num_friends) "
+                                           "VALUES (?, ?, ?, ?, ?, ?)", expenses)
+                if links:
+                    connection.exec_driver_sql("INSERT INTO friendexpenselink (friend_id, expense_id, amount) VALUES (?, ?, ?)", links)
+                num_generated_links += len(links)
+                expenses = []
+                links = []
+
+        balances = ((credit_balances[index], debit_balances[index], index + 1) for index in range(num_friends))
+        for chunk in chunks(balances):
+            connection.exec_driver_sql("UPDATE friend SET credit_balance = ?, debit_balance = ? WHERE id = ?", chunk)
+    return {"friends": num_friends, "expenses": num_expenses, "links": num_generated_links}
@@ -0,0 +1,312 @@
+# Benchmark every route of the API against a synthetic dataset, e.g.:
+#
+#   python -m benchmarks.run --friends 10000 --expenses 100000 --links 500000 --output results.json
+#   python -m benchmarks.run --mode async --compare results.json
+#
+# The dataset is generated once per size, seed and skew in --data-dir and reused by later runs.
+from typing import Any, Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import argparse
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the SplitWithMe API")
+    parser.add_argument("--friends", type=int, default=1000)
+    parser.add_argument("--expenses", type=int, default=10000)
+    parser.add_argument("--links", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent of the friend popularity")
+    parser.add_argument("--data-dir", default=".benchmarks", help="directory of the generated databases")
+    parser.add_argument("--mode", choices=["sync", "async"], default="sync", help="SPLITWITHME_DB_MODE of the server")
+    parser.add_argument("--profile", default="production", help="SPLITWITHME_DB_PROFILE of the server")
+    parser.add_argument("--storage", choices=["sqlite", "memory"], default="sqlite",
+                        help="SPLITWITHME_STORAGE of the server (memory only serves the friend and expense endpoints)")
+    parser.add_argument("--cache-size", type=int, default=0, help="SPLITWITHME_CACHE_SIZE of the server")
+    parser.add_argument("--url", help="benchmark a running server instead of an in-process TestClient")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--endpoints", help="comma separated names of the endpoints to run (all by default)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    args = parser.parse_args(argv)
+    # The in-process server runs in the dataset directory
+    for name in ("data_dir", "output", "compare"):
+        if getattr(args, name) is not None:
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    return args
+
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_database(args: argparse.Namespace) -> str:
+    # Databases are reused across runs with the same dataset parameters
+    name = f"f{args.friends}-e{args.expenses}-l{args.links}-s{args.seed}-z{args.skew}"
+    path = os.path.abspath(os.path.join(args.data_dir, name))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def percentile(values: list[float], rank: float) -> float:
+    # Nearest-rank percentile of sorted values
+    index = max(0, min(len(values) - 1, round(rank / 100 * len(values)) - 1))
+    return values[index]
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=REPOSITORY_DIR).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Endpoints served from SQL queries only: not served with --storage memory
+SQL_ONLY_ENDPOINTS = ("GET /export/", "GET /reports/", "GET /search/", "GET /settlement/")
+
+
+class Scenario:
+    # A benchmarked endpoint: prepare() does the untimed setup and returns the timed request
+
+    def __init__(self, name: str, prepare: Callable[[random.Random], tuple[str, str, Any]]):
+        self.name = name
+        self.prepare = prepare
+
+
+def get_scenarios(dataset: dict[str, int]) -> list[Scenario]:
+    num_friends, num_expenses = dataset["friends"], dataset["expenses"]
+    counter = iter(range(10 ** 9))
+    start = datetime.datetime.now(datetime.timezone.utc)
+    lock = threading.Lock()
+
+    def unique() -> int:
+        with lock:
+            return next(counter)
+
+    def friend_id(rng):
+        return rng.randint(1, num_friends)
+
+    def expense_id(rng):
+        return rng.randint(1, num_expenses)
+
+    def new_expense(rng):
+        return {"description": f"Benchmark {os.getpid()} {unique()}", "date": "2024-06-01", "amount": float(rng.randint(5, 500))}
+
+    def as_of(rng):
+        # A time since the benchmark started: the history may start when the server does
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return (start + (now - start) * rng.random()).isoformat()
+
+    def new_friend_in_expense(rng):
+        # Assign a new friend to a random expense (setup) and return both ids
+        new_friend = client.request("POST", "/friends/", json={"name": "Benchmark"}).json()["id"]
+        expense = expense_id(rng)
+        client.request("POST", f"/expenses/{expense}/friends?friend_id={new_friend}")
+        return expense, new_friend
+
+    return [
+        Scenario("GET /friends/", lambda rng: ("GET", "/friends/", None)),
+        Scenario("GET /friends/?name_prefix", lambda rng: ("GET", f"/friends/?sort=name&name_prefix=Friend%20{rng.randint(0, 9)}", None)),
+        Scenario("GET /friends/{id}", lambda rng: ("GET", f"/friends/{friend_id(rng)}", None)),
+        Scenario("GET /friends/{id}?as_of", lambda rng: ("GET", f"/friends/{friend_id(rng)}?as_of={quote(as_of(rng))}", None)),
+        Scenario("GET /friends/{id}/expenses", lambda rng: ("GET", f"/friends/{friend_id(rng)}/expenses", None)),
+        Scenario("POST /friends/", lambda rng: ("POST", "/friends/", {"name": f"Benchmark {unique()}"})),
+        Scenario("PUT /friends/{id}", lambda rng: ("PUT", f"/friends/{friend_id(rng)}", {"name": f"Friend {unique()}"})),
+        Scenario("DELETE /friends/{id}", lambda rng: ("DELETE", f"/friends/{new_friend_in_expense(rng)[1]}", None)),
+        Scenario("GET /expenses/", lambda rng: ("GET", "/expenses/", None)),
+        Scenario("GET /expenses/?date_from", lambda rng: ("GET", f"/expenses/?sort=date&date_from=202{rng.randint(0, 4)}-01-01", None)),
+        Scenario("GET /expenses/{id}", lambda rng: ("GET", f"/expenses/{expense_id(rng)}", None)),
+        Scenario("GET /expenses/{id}?as_of", lambda rng: ("GET", f"/expenses/{expense_id(rng)}?as_of={quote(as_of(rng))}", None)),
+        Scenario("POST /expenses/", lambda rng: ("POST", "/expenses/", new_expense(rng))),
+        Scenario("POST /expenses/batch", lambda rng: ("POST", "/expenses/batch", [new_expense(rng) for _ in range(20)])),
+        Scenario("PUT /expenses/{id}", lambda rng: ("PUT", f"/expenses/{client.request('POST', '/expenses/', json=new_expense(rng)).json()['id']}", new_expense(rng))),
+        Scenario("DELETE /expenses/{id}", lambda rng: ("DELETE", f"/expenses/{client.request('POST', '/expenses/', json=new_expense(rng)).json()['id']}", None)),
+        Scenario("GET /expenses/{id}/friends", lambda rng: ("GET", f"/expenses/{expense_id(rng)}/friends", None)),
+        Scenario("GET /expenses/{id}/friends/{friend_id}", lambda rng: ("GET", "/expenses/{}/friends/{}".format(*new_friend_in_expense(rng)), None)),
+        Scenario("POST /expenses/{id}/friends", lambda rng: ("POST", f"/expenses/{expense_id(rng)}/friends?friend_id={client.request('POST', '/friends/', json={'name': 'Benchmark'}).json()['id']}", None)),
+        Scenario("POST /expenses/friends/batch", lambda rng: ("POST", "/expenses/friends/batch?atomic=false",
+                                                             [{"expense_id": expense_id(rng), "friend_id": friend_id(rng)} for _ in range(20)])),
+        Scenario("PUT /expenses/{id}/friends/{friend_id}", lambda rng: ("PUT", "/expenses/{}/friends/{}?amount=1".format(*new_friend_in_expense(rng)), None)),
+        Scenario("PUT /expenses/friends/batch", lambda rng: ("PUT", "/expenses/friends/batch?atomic=false",
+                                                            [{"expense_id": expense_id(rng), "friend_id": friend_id(rng), "amount": 1} for _ in range(20)])),
+        Scenario("DELETE /expenses/{id}/friends/{friend_id}", lambda rng: ("DELETE", "/expenses/{}/friends/{}".format(*new_friend_in_expense(rng)), None)),
+        Scenario("GET /export/expenses", lambda rng: ("GET", f"/export/expenses?since=202{rng.randint(0, 4)}-01-01", None)),
+        Scenario("GET /export/friends", lambda rng: ("GET", "/export/friends?format=csv", None)),
+        Scenario("GET /reports/expenses", lambda rng: ("GET", f"/reports/expenses?period=month&date_from=202{rng.randint(0, 4)}-01-01", None)),
+        Scenario("GET /search/expenses", lambda rng: ("GET", f"/search/expenses?q=expense%20{expense_id(rng) // 10}", None)),
+        Scenario("GET /search/friends", lambda rng: ("GET", f"/search/friends?q=friend%20{friend_id(rng) // 10:06d}", None)),
+        Scenario("GET /settlement/?date_from", lambda rng: ("GET", f"/settlement/?date_from=202{rng.randint(0, 4)}-0{rng.randint(1, 9)}-01", None)),
+        Scenario("GET /reports/friends?friend_id", lambda rng: ("GET", f"/reports/friends?period=week&friend_id={friend_id(rng)}", None)),
+        Scenario("GET /metrics", lambda rng: ("GET", "/metrics", None)),
+        Scenario("GET /cache/stats", lambda rng: ("GET", "/cache/stats", None)),
+        # Not benchmarked: GET /events/ streams until the client disconnects (no latency to measure),
+        # and GET /metrics/profile only has samples with the profiler enabled
+    ]
+
+
+def count_statements() -> Callable[[], int]:
+    # Number of SQL statements executed by the in-process server so far
+    from sqlalchemy import event
+    from persistence import database
+
+    count = [0]
+    lock = threading.Lock()
+
+    def increment(*args):
+        with lock:
+            count[0] += 1
+
+    engines = {database.engine, database.read_engine, database.async_engine, database.async_read_engine} - {None}
+    for engine in engines:
+        event.listen(getattr(engine, "sync_engine", engine), "before_cursor_execute", increment)
+    return lambda: count[0]
+
+
+def run_scenario(scenario: Scenario, args: argparse.Namespace, statements: Optional[Callable[[], int]]) -> dict[str, Any]:
+    rng = random.Random(f"{args.seed}-{scenario.name}")
+    requests = [scenario.prepare(rng) for _ in range(args.requests)]
+
+    # SQL statements per request, measured on one sequential request
+    sql_statements = None
+    if statements is not None:
+        method, url, body = scenario.prepare(rng)
+        before = statements()
+        client.request(method, url, json=body)
+        sql_statements = statements() - before
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def send(request):
+        method, url, body = request
+        start = time.perf_counter()
+        response = client.request(method, url, json=body)
+        latency = time.perf_counter() - start
+        with lock:
+            latencies.append(latency)
+            if response.status_code >= 500:
+                errors[0] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        list(executor.map(send, requests))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "sql_statements": sql_statements,
+    }
+
+
+def compare(results: dict[str, Any], previous: dict[str, Any]):
+    print(f"\nCompared with {previous['meta'].get('commit') or 'previous run'}:")
+    for name, result in results["endpoints"].items():
+        before = previous["endpoints"].get(name)
+        if before is None:
+            continue
+        ratio = result["p95_ms"] / before["p95_ms"] if before["p95_ms"] else float("inf")
+        flag = "  <-- slower" if ratio > 1.2 else ""
+        print(f"{name:45} p95 {before['p95_ms']:9.2f} -> {result['p95_ms']:9.2f} ms ({ratio:5.2f}x){flag}")
+
+
+client = None
+
+
+def main(argv: Optional[list[str]] = None):
+    global client
+    args = parse_args(argv)
+    statements = None
+    if args.url:
+        import requests
+
+        class Client(requests.Session):
+            def request(self, method, url, **kwargs):
+                return super().request(method, args.url.rstrip("/") + url, **kwargs)
+
+        client = Client()
+        dataset = {"friends": args.friends, "expenses": args.expenses}
+    else:
+        # The server settings are read at import time, and the database is relative to the working directory
+        os.environ["SPLITWITHME_DB_MODE"] = args.mode
+        os.environ["SPLITWITHME_DB_PROFILE"] = args.profile
+        os.environ["SPLITWITHME_CACHE_SIZE"] = str(args.cache_size)
+        os.environ["SPLITWITHME_STORAGE"] = args.storage
+        sys.path.insert(0, REPOSITORY_DIR)
+        os.chdir(get_database(args))
+        from fastapi.testclient import TestClient
+        from persistence.database import engine
+        from persistence.utils import create_db_and_tables
+        from benchmarks.dataset import generate
+
+        if not os.path.exists("dataset.json"):
+            create_db_and_tables()
+            start = time.perf_counter()
+            dataset = generate(engine, args.friends, args.expenses, args.links, args.seed, args.skew)
+            print(f"Generated {dataset} in {time.perf_counter() - start:.1f} s")
+            with open("dataset.json", "w") as file:
+                json.dump(dataset, file)
+        with open("dataset.json") as file:
+            dataset = json.load(file)
+
+        import main as app_module
+        statements = count_statements()
+        client = TestClient(app_module.app)
+        client.__enter__()
+
+    scenarios = get_scenarios(dataset)
+    if args.storage == "memory":
+        scenarios = [scenario for scenario in scenarios if not scenario.name.startswith(SQL_ONLY_ENDPOINTS)]
+    if args.endpoints:
+        names = set(args.endpoints.split(","))
+        scenarios = [scenario for scenario in scenarios if scenario.name in names]
+
+    results = {
+        "meta": {
+            "commit": get_commit(),
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "mode": None if args.url else args.mode,
+            "profile": None if args.url else args.profile,
+            "cache_size": None if args.url else args.cache_size,
+            "storage": None if args.url else args.storage,
+            "url": args.url,
+            "dataset": dataset,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+        },
+        "endpoints": {},
+    }
+    print(f"{'endpoint':45} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'SQL':>5} {'errors':>6}")
+    for scenario in scenarios:
+        result = run_scenario(scenario, args, statements)
+        results["endpoints"][scenario.name] = result
+        print(f"{scenario.name:45} {result['throughput_rps']:9.1f} {result['p50_ms']:9.2f} {result['p95_ms']:9.2f} "
+              f"{result['p99_ms']:9.2f} {result['sql_statements'] if result['sql_statements'] is not None else '-':>5} {result['errors']:6}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+    if not args.url:
+        client.__exit__(None, None, None)
+
+
+if __name__ == "__main__":
+    main()
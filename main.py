@@ -1,16 +1,46 @@
+import time
+# Startup time is measured from here (imports included)
+STARTUP_BEGIN = time.perf_counter()
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 
 from persistence.utils import create_db_and_tables, init_db_if_empty
+from persistence.group_commit import credit_committer
+from persistence.database import engine
+from persistence.storage import STORAGE, memory_repository
+from persistence.history import snapshot_taker
+
+from routers import friends, expenses, friend_expenses, exports, reports, settlement, search, events, metrics
+from routers.cache import response_cache
 
-from routers import friends, expenses, friend_expenses
+IMPORTS_END = time.perf_counter()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    database_begin = time.perf_counter()
     create_db_and_tables()
     init_db_if_empty()
+    if memory_repository is not None:
+        memory_repository.load(engine)
+    else:
+        # The first snapshot starts the balance history, the next ones are taken periodically
+        snapshot_taker.run_once()
+        snapshot_taker.start()
+    startup_end = time.perf_counter()
+    app.state.startup_time = {"imports_ms": round((IMPORTS_END - STARTUP_BEGIN) * 1000, 1),
+                              "database_ms": round((startup_end - database_begin) * 1000, 1),
+                              "total_ms": round((startup_end - STARTUP_BEGIN) * 1000, 1)}
+    print(f"Startup completed in {app.state.startup_time['total_ms']} ms "
+          f"(imports {app.state.startup_time['imports_ms']} ms, database {app.state.startup_time['database_ms']} ms)")
+    if metrics.stack_sampler is not None:
+        metrics.stack_sampler.start()
     yield
+    if credit_committer is not None:
+        credit_committer.stop()
+    events.event_hub.stop()
+    snapshot_taker.stop()
 
 
 tags_metadata = [
@@ -25,6 +55,34 @@ tags_metadata = [
 {
         "name": "friend_expenses",
         "description": "CRUD operations with expenses and friends.",
+    },
+    {
+        "name": "export",
+        "description": "Bulk export of expenses and balances.",
+    },
+    {
+        "name": "reports",
+        "description": "Expense and friend totals by period.",
+    },
+    {
+        "name": "settlement",
+        "description": "Transfers that settle the balances.",
+    },
+    {
+        "name": "search",
+        "description": "Full-text search of expenses and friends.",
+    },
+    {
+        "name": "events",
+        "description": "Stream of the changes as Server-Sent Events.",
+    },
+    {
+        "name": "cache",
+        "description": "Response cache statistics.",
+    },
+    {
+        "name": "metrics",
+        "description": "Request, SQL and cache metrics.",
     }
 ]
 
@@ -35,12 +93,18 @@ description = """
 3. 💰 Update a friend's credit when you get paid
 4. 📊 Check balances: view the credit (what has been paid) and debit (what is still owed) balance for each expense and/or friend
 
+📦 Expenses, friend assignments and credit updates can also be sent in batch. By default a batch is applied only if all of its items are valid; with `atomic=false` the valid items are applied anyway. The response has one result per item.
+
+📈 Every response has a `Server-Timing` header with the time spent in the database and the number of SQL statements. The metrics of every route are exported in the Prometheus text format at `/metrics`.
+
+📄 Lists are paginated: each page returns its `items` and a `next_cursor`. Pass it as the `cursor` parameter to get the next page (`limit` sets the page size, up to 500).
+
 
 ### 👫 Friends
 You will able to:
 * **➕ Create a friend**: requires only one attribute, the `name` 
-* **🔍 Retrieve friend info**: includes the internal `id`, the `name` as well as the total `credit balance` and `debit balance`.
-* **📋 Retrive the list of friends**: shows all friends with their `id`, `name`, total `credit balance` and total `debit balance`.
+* **🔍 Retrieve friend info**: includes the internal `id`, the `name` as well as the total `credit balance` and `debit balance`. Use `as_of` to get the balances at a past time (the name is the current one).
+* **📋 Retrive the list of friends**: shows all friends with their `id`, `name`, total `credit balance` and total `debit balance`. They can be filtered by `name prefix` and sorted by `id` or `name`.
 * **📋 Retrive a friend list of expenses**: shows all expenses splitted with the specified friend with their `id`, `description`, `amount`, `num friends` that share the expense, `credit balance` and `debit balance`.
 * **✏️ Update a friend**: you can modify the `name` of a friend.
 * **❌ Delete a friend**: only possible if their current credit balance is 0.
@@ -48,12 +112,40 @@ You will able to:
 ### 💵 Expenses
 You will able to:
 * **➕ Create an expense**: requires `description`, `date` (format: YYYY-MM-DD) and `amount`
-* **🔍 Retrieve expense info**: includes the internal `id`, the `description`, `date`, `amount` and the total `credit balance`.
-* **📋 Retrive the list of expenses**: shows all expenses with their `id`, `description`, `date`, `amount`, `num friends` that split the expense and  total `credit balance`.
+* **🔍 Retrieve expense info**: includes the internal `id`, the `description`, `date`, `amount` and the total `credit balance`. Use `as_of` to get the credit balance at a past time (the other fields are the current ones).
+* **📋 Retrive the list of expenses**: shows all expenses with their `id`, `description`, `date`, `amount`, `num friends` that split the expense and  total `credit balance`. They can be filtered by `date` and `amount` range and sorted by `id`, `date` or `amount`.
 * **✏️ Update an expense**: you can change the `description`, `date` or `amount`.
 * **❌ Delete an expense**
 
 
+### 🔎 Search
+You will able to:
+* **🔎 Search expenses**: finds the expenses whose `description` has all the searched words, ignoring case and accents, best matches first. The last word, and those ending with `*`, can be incomplete (`travel sev` or `trav* sev` find "Travel to Sevilla").
+* **🔎 Search friends**: finds the friends by `name` in the same way.
+
+
+### 📤 Export
+You will able to:
+* **📤 Export all expenses**: streams every expense with its friends and their `credit balance` and `debit balance`, as NDJSON (one expense per line) or CSV (one friend per line). Use `since` to export only the expenses from a date onwards.
+* **📤 Export all friends**: streams every friend with their total `credit balance` and `debit balance`, as NDJSON or CSV.
+
+
+### 📊 Reports
+You will able to:
+* **📊 Get the expense totals by period**: the number of expenses, their `spend` (total amount), `credit` (paid by the friends) and `debit` (share of the friends) by `day`, `week`, `month` or `year`, optionally between two dates.
+* **📊 Get the friend totals by period**: the same totals for each friend and period, optionally for a single friend.
+
+
+### 🤝 Settlement
+You will able to:
+* **🤝 Settle up**: get the list of transfers (`from friend id`, `to friend id` and `amount`) that settles every balance, at most one per participant, where a null friend id is you. It can be restricted to some expenses (`expense_id`, repeated) or a `date` range.
+
+
+### 🔔 Events
+You will able to:
+* **🔔 Follow the changes**: `/events` streams (as Server-Sent Events) the friends created, updated or deleted, the expenses created, updated or deleted, the friends added to or removed from an expense and the credit updates, with the new `credit balance` and `debit balance` of the friends and expenses involved. Use `type`, `friend_id` and `expense_id` (repeated) to receive only some events. Every event has an increasing `id`: reconnect with the `Last-Event-ID` header to get the events you missed, or a `reset` event if they are too old.
+
+
 ### 🔗 Friends and expenses
 You will able to:
 
@@ -84,9 +176,25 @@ app.add_middleware(
     allow_origins=origins,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
+# Latency and SQL statistics of every request
+app.middleware("http")(metrics.instrument_request)
+
 app.include_router(friends.router)
 app.include_router(expenses.router)
 app.include_router(friend_expenses.router)
-
+if STORAGE == "sqlite":
+    # Served from SQL queries only
+    app.include_router(exports.router)
+    app.include_router(reports.router)
+    app.include_router(settlement.router)
+    app.include_router(search.router)
+app.include_router(events.router)
+app.include_router(metrics.router)
+
+
+@app.get("/cache/stats", tags=["cache"], summary="Get response cache counters")
+def get_cache_stats() -> dict[str, int]:
+    return response_cache.stats()
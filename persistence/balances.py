@@ -0,0 +1,291 @@
+from typing import Iterable, Optional
+from collections import defaultdict
+from sqlalchemy import bindparam, event, literal
+from sqlmodel import Session, select, update, delete, func
+from persistence.models import Friend, Expense, FriendExpenseLink
+from persistence.changes import CHANGES_KEY, mark_changed, add_event
+from persistence.history import record_entries
+
+
+def get_num_links_by_expense(expense_ids=None):
+    # Number of friends assigned to each expense (the owner is not included)
+    statement = select(FriendExpenseLink.expense_id, func.count(FriendExpenseLink.friend_id).label("num_links"))
+    if expense_ids is not None:
+        statement = statement.where(FriendExpenseLink.expense_id.in_(expense_ids))
+    return statement.group_by(FriendExpenseLink.expense_id).subquery()
+
+
+def get_friend_balances(session: Session, friend_ids: Optional[Iterable[int]] = None) -> dict[int, tuple[float, float]]:
+    # Credit and debit balance of a set of friends (all of them by default) in a single aggregate query.
+    # Friends without expenses are not included in the result.
+    if friend_ids is not None:
+        friend_ids = list(friend_ids)
+        # Only count the participants of the expenses shared with these friends
+        expense_ids = select(FriendExpenseLink.expense_id).where(FriendExpenseLink.friend_id.in_(friend_ids))
+        num_links = get_num_links_by_expense(expense_ids)
+    else:
+        num_links = get_num_links_by_expense()
+    statement = (select(FriendExpenseLink.friend_id,
+                        func.sum(FriendExpenseLink.amount),
+                        func.sum(Expense.amount / (num_links.c.num_links + 1)))
+                 .join(Expense, Expense.id == FriendExpenseLink.expense_id)
+                 .join(num_links, num_links.c.expense_id == FriendExpenseLink.expense_id)
+                 .group_by(FriendExpenseLink.friend_id))
+    if friend_ids is not None:
+        statement = statement.where(FriendExpenseLink.friend_id.in_(friend_ids))
+    balances = {}
+    for friend_id, credit_balance, debit_balance in session.exec(statement):
+        balances[friend_id] = (credit_balance or 0, debit_balance or 0)
+    return balances
+
+
+def get_expense_balances(session: Session, expense_ids: Optional[Iterable[int]] = None) -> dict[int, tuple[float, int]]:
+    # Credit balance and number of friends (owner included) of a set of expenses (all of them by default).
+    # Expenses without friends are not included in the result.
+    statement = (select(FriendExpenseLink.expense_id,
+                        func.sum(FriendExpenseLink.amount),
+                        func.count(FriendExpenseLink.friend_id))
+                 .group_by(FriendExpenseLink.expense_id))
+    if expense_ids is not None:
+        statement = statement.where(FriendExpenseLink.expense_id.in_(list(expense_ids)))
+    balances = {}
+    for expense_id, credit_balance, num_links in session.exec(statement):
+        balances[expense_id] = (credit_balance or 0, num_links + 1)
+    return balances
+
+
+# The balances stored in Friend and Expense are kept up to date by the write paths using the
+# functions below. They must be called in the same transaction as the change they account for.
+# Every change is also appended to the balance ledger (see persistence.history).
+# They never compute a balance from values read before: concurrent writes would be lost. Each
+# change is an atomic UPDATE (or DELETE) ... RETURNING, and the shares are computed from the
+# returned row. After the first one the transaction holds the write lock, so the next
+# statements see the same stored values.
+
+def shift_debit_balances(expense_id: int, delta, session: Session) -> list[int]:
+    # Add delta (a number, or a SQL expression evaluated by the UPDATE) to the debit balance of
+    # every friend sharing the expense. Returns their ids.
+    if isinstance(delta, (int, float)):
+        if delta == 0:
+            return []
+        delta = literal(delta)
+    participants = select(FriendExpenseLink.friend_id).where(FriendExpenseLink.expense_id == expense_id)
+    rows = session.exec(update(Friend)
+                        .where(Friend.id.in_(participants))
+                        .where(delta != 0)
+                        .values(debit_balance=Friend.debit_balance + delta)
+                        .returning(Friend.id, delta)).all()
+    record_entries(session, [(friend_id, expense_id, 0, friend_delta) for friend_id, friend_delta in rows])
+    friend_ids = [friend_id for friend_id, _ in rows]
+    mark_changed(session, friends=friend_ids, expenses=[expense_id])
+    return friend_ids
+
+
+def add_link_credit(expense_id: int, friend_id: int, amount: float, session: Session) -> Optional[float]:
+    # Single atomic UPDATE ... RETURNING, so concurrent credits never overwrite each other.
+    # Returns the new credit of the friend in the expense (None if the friend is not assigned to it).
+    return session.exec(update(FriendExpenseLink)
+                        .where(FriendExpenseLink.expense_id == expense_id)
+                        .where(FriendExpenseLink.friend_id == friend_id)
+                        .values(amount=FriendExpenseLink.amount + amount)
+                        .returning(FriendExpenseLink.amount)).scalar_one_or_none()
+
+
+def add_credit(expense_id: int, friend_id: int, amount: float, session: Session) -> Optional[float]:
+    new_amount = add_link_credit(expense_id, friend_id, amount, session)
+    if new_amount is not None:
+        add_balance_credits([(expense_id, friend_id, amount)], session)
+    return new_amount
+
+
+def add_credits(credits: list[tuple[int, int, float]], session: Session) -> list[Optional[float]]:
+    # Apply a list of (expense_id, friend_id, amount) credits: one UPDATE ... RETURNING per link,
+    # so only the credits of the links that still exist are added to the balances (one executemany
+    # per table). Returns the new credit of each one (None if the friend is not assigned to it).
+    new_amounts = [add_link_credit(expense_id, friend_id, amount, session) for expense_id, friend_id, amount in credits]
+    add_balance_credits([credit for credit, new_amount in zip(credits, new_amounts) if new_amount is not None], session)
+    return new_amounts
+
+
+def add_balance_credits(credits: list[tuple[int, int, float]], session: Session):
+    # Add the credits to the stored balances, one UPDATE per friend and per expense
+    if not credits:
+        return
+    mark_changed(session,
+                 friends=[friend_id for _, friend_id, _ in credits],
+                 expenses=[expense_id for expense_id, _, _ in credits])
+    for expense_id, friend_id, _ in credits:
+        add_event(session, "credit_updated", friends=[friend_id], expenses=[expense_id])
+    friend_credits = defaultdict(float)
+    expense_credits = defaultdict(float)
+    for expense_id, friend_id, amount in credits:
+        friend_credits[friend_id] += amount
+        expense_credits[expense_id] += amount
+    friend_table = Friend.__table__
+    session.exec(update(friend_table)
+                 .where(friend_table.c.id == bindparam("friend_id"))
+                 .values(credit_balance=friend_table.c.credit_balance + bindparam("delta")),
+                 params=[{"friend_id": friend_id, "delta": amount} for friend_id, amount in friend_credits.items()])
+    expense_table = Expense.__table__
+    session.exec(update(expense_table)
+                 .where(expense_table.c.id == bindparam("expense_id"))
+                 .values(credit_balance=expense_table.c.credit_balance + bindparam("delta")),
+                 params=[{"expense_id": expense_id, "delta": amount} for expense_id, amount in expense_credits.items()])
+    record_entries(session, [(friend_id, expense_id, amount, 0) for expense_id, friend_id, amount in credits])
+
+
+def add_participants(expense_id: int, friend_ids: list[int], session: Session):
+    # Call before inserting the links: the expense is split among len(friend_ids) more friends
+    amount, num_friends = session.exec(update(Expense)
+                                       .where(Expense.id == expense_id)
+                                       .values(num_friends=Expense.num_friends + len(friend_ids))
+                                       .returning(Expense.amount, Expense.num_friends)).one()
+    old_share = amount / (num_friends - len(friend_ids))
+    new_share = amount / num_friends
+    shifted_ids = shift_debit_balances(expense_id, new_share - old_share, session)
+    session.exec(update(Friend).where(Friend.id.in_(friend_ids)).values(debit_balance=Friend.debit_balance + new_share))
+    record_entries(session, [(friend_id, expense_id, 0, new_share) for friend_id in friend_ids])
+    mark_changed(session, friends=friend_ids, expenses=[expense_id])
+    add_event(session, "participant_added", friends=friend_ids, expenses=[expense_id], affected_friends=shifted_ids)
+
+
+def remove_participant(expense_id: int, friend_id: int, session: Session) -> bool:
+    # Delete the link: the expense is split among one less friend, and the friend loses their
+    # share and their credit in it. Returns False if the friend is not assigned to the expense.
+    credit = session.exec(delete(FriendExpenseLink)
+                          .where(FriendExpenseLink.expense_id == expense_id)
+                          .where(FriendExpenseLink.friend_id == friend_id)
+                          .returning(FriendExpenseLink.amount)).scalar_one_or_none()
+    if credit is None:
+        return False
+    amount, num_friends = session.exec(update(Expense)
+                                       .where(Expense.id == expense_id)
+                                       .values(num_friends=Expense.num_friends - 1,
+                                               credit_balance=Expense.credit_balance - credit)
+                                       .returning(Expense.amount, Expense.num_friends)).one()
+    old_share = amount / (num_friends + 1)
+    new_share = amount / num_friends
+    shifted_ids = shift_debit_balances(expense_id, new_share - old_share, session)
+    session.exec(update(Friend)
+                 .where(Friend.id == friend_id)
+                 .values(debit_balance=Friend.debit_balance - old_share,
+                         credit_balance=Friend.credit_balance - credit))
+    record_entries(session, [(friend_id, expense_id, -credit, -old_share)])
+    mark_changed(session, friends=[friend_id], expenses=[expense_id])
+    add_event(session, "participant_removed", friends=[friend_id], expenses=[expense_id], affected_friends=shifted_ids)
+    return True
+
+
+def update_amount(expense: Expense, amount: float, session: Session):
+    # Call before storing the new amount: the shares change by the difference with the stored
+    # amount, divided by the stored number of friends (read by the UPDATE of the shares)
+    delta = (select((float(amount) - Expense.amount) / Expense.num_friends)
+             .where(Expense.id == expense.id)
+             .scalar_subquery())
+    shifted_ids = shift_debit_balances(expense.id, delta, session)
+    # Always written: the loaded expense may already have this amount while the stored one changed
+    session.exec(update(Expense).where(Expense.id == expense.id).values(amount=amount))
+    mark_changed(session, expenses=[expense.id], lists=["expenses"])
+    add_event(session, "expense_updated", expenses=[expense.id], affected_friends=shifted_ids)
+
+
+def remove_expense(expense: Expense, session: Session):
+    # Call before deleting the expense: its friends lose their share and their credit in it
+    share = select(Expense.amount / Expense.num_friends).where(Expense.id == expense.id).scalar_subquery()
+    credit = (select(FriendExpenseLink.amount)
+              .where(FriendExpenseLink.expense_id == expense.id)
+              .where(FriendExpenseLink.friend_id == Friend.id)
+              .scalar_subquery())
+    rows = session.exec(update(Friend)
+                        .where(Friend.id.in_(select(FriendExpenseLink.friend_id).where(FriendExpenseLink.expense_id == expense.id)))
+                        .values(debit_balance=Friend.debit_balance - share,
+                                credit_balance=Friend.credit_balance - credit)
+                        .returning(Friend.id, credit, share)).all()
+    record_entries(session, [(friend_id, expense.id, -amount, -friend_share) for friend_id, amount, friend_share in rows])
+    friend_ids = [friend_id for friend_id, _, _ in rows]
+    mark_changed(session, friends=friend_ids, expenses=[expense.id], lists=["expenses"])
+    add_event(session, "expense_deleted", expenses=[expense.id], affected_friends=friend_ids)
+
+
+# Ids per IN list when reading the balances of the events
+CHUNK_SIZE = 500
+
+
+@event.listens_for(Session, "before_commit")
+def add_event_balances(session: Session):
+    # The events carry the balances as of their transaction, like the in-memory repository sends
+    # them: they are read before the commit, while the transaction still holds the write lock.
+    changes = session.info.get(CHANGES_KEY)
+    if changes is None or not changes["events"]:
+        return
+    events = changes["events"]
+    friend_ids = list({friend_id for event in events for friend_id in event["friend_ids"] + event["affected_friend_ids"]})
+    expense_ids = list({expense_id for event in events for expense_id in event["expense_ids"]})
+    friends = {}
+    for start in range(0, len(friend_ids), CHUNK_SIZE):
+        for friend_id, name, credit_balance, debit_balance in session.exec(
+                select(Friend.id, Friend.name, Friend.credit_balance, Friend.debit_balance)
+                .where(Friend.id.in_(friend_ids[start:start + CHUNK_SIZE]))):
+            friends[friend_id] = {"id": friend_id, "name": name, "credit_balance": credit_balance, "debit_balance": debit_balance}
+    expenses = {}
+    for start in range(0, len(expense_ids), CHUNK_SIZE):
+        for expense_id, description, amount, credit_balance, num_friends in session.exec(
+                select(Expense.id, Expense.description, Expense.amount, Expense.credit_balance, Expense.num_friends)
+                .where(Expense.id.in_(expense_ids[start:start + CHUNK_SIZE]))):
+            expenses[expense_id] = {"id": expense_id, "description": description, "amount": amount,
+                                    "credit_balance": credit_balance, "num_friends": num_friends}
+    # Deleted friends and expenses have no balances
+    for event in events:
+        event["friends"] = [friends[friend_id] for friend_id in dict.fromkeys(event["friend_ids"] + event["affected_friend_ids"])
+                            if friend_id in friends]
+        event["expenses"] = [expenses[expense_id] for expense_id in event["expense_ids"] if expense_id in expenses]
+
+
+def reconcile(session: Session, repair: bool = True, tolerance: float = 1e-6) -> list[str]:
+    # Recompute every stored balance in bulk and report (and optionally repair) the ones that drifted
+    drifts = []
+    # Ledger entries of the repairs
+    entries = []
+    friend_balances = get_friend_balances(session)
+    friend_repairs = []
+    for friend_id, credit_balance, debit_balance in session.exec(select(Friend.id, Friend.credit_balance, Friend.debit_balance)):
+        expected_credit, expected_debit = friend_balances.get(friend_id, (0, 0))
+        if abs(credit_balance - expected_credit) > tolerance or abs(debit_balance - expected_debit) > tolerance:
+            drifts.append(f"Friend '{friend_id}': credit {credit_balance} -> {expected_credit}, debit {debit_balance} -> {expected_debit}")
+            friend_repairs.append({"id": friend_id, "credit_balance": expected_credit, "debit_balance": expected_debit})
+            entries.append((friend_id, None, expected_credit - credit_balance, expected_debit - debit_balance))
+    expense_balances = get_expense_balances(session)
+    expense_repairs = []
+    for expense_id, credit_balance, num_friends in session.exec(select(Expense.id, Expense.credit_balance, Expense.num_friends)):
+        expected_credit, expected_num_friends = expense_balances.get(expense_id, (0, 1))
+        if credit_balance is None or abs(credit_balance - expected_credit) > tolerance or num_friends != expected_num_friends:
+            drifts.append(f"Expense '{expense_id}': credit {credit_balance} -> {expected_credit}, num friends {num_friends} -> {expected_num_friends}")
+            expense_repairs.append({"id": expense_id, "credit_balance": expected_credit, "num_friends": expected_num_friends})
+            entries.append((None, expense_id, expected_credit - (credit_balance or 0), 0))
+    if repair:
+        # Bulk UPDATE ... WHERE id = ? executed once per batch
+        if friend_repairs:
+            session.exec(update(Friend), params=friend_repairs)
+        if expense_repairs:
+            session.exec(update(Expense), params=expense_repairs)
+        # The repairs are changes of the balances too
+        record_entries(session, entries)
+        mark_changed(session,
+                     friends=[repair["id"] for repair in friend_repairs],
+                     expenses=[repair["id"] for repair in expense_repairs])
+        session.commit()
+    return drifts
+
+
+if __name__ == "__main__":
+    import argparse
+    from persistence.database import engine
+
+    parser = argparse.ArgumentParser(description="Check the stored friend and expense balances")
+    parser.add_argument("--dry-run", action="store_true", help="report the drift without repairing it")
+    args = parser.parse_args()
+    with Session(engine) as session:
+        drifts = reconcile(session, repair=not args.dry_run)
+    for drift in drifts:
+        print(drift)
+    print(f"{len(drifts)} balances {'drifted' if args.dry_run else 'repaired'}")
@@ -0,0 +1,53 @@
+from typing import Callable, Iterable
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+# The write paths record which friends and expenses they change in the session. Once the
+# transaction is committed, the listeners receive them (e.g. to invalidate cached responses).
+# Changes of a rolled back transaction are discarded.
+CHANGES_KEY = "changes"
+listeners: list[Callable[[dict[str, set]], None]] = []
+
+
+def get_changes(session: Session) -> dict[str, set]:
+    # friends and expenses: ids whose data or balances changed
+    # lists: lists whose members, filters or order changed ("friends" or "expenses")
+    # events: what happened, in order (see add_event)
+    return session.info.setdefault(CHANGES_KEY, {"friends": set(), "expenses": set(), "lists": set(), "events": []})
+
+
+def mark_changed(session: Session, friends: Iterable[int] = (), expenses: Iterable[int] = (), lists: Iterable[str] = ()):
+    changes = get_changes(session)
+    changes["friends"].update(friends)
+    changes["expenses"].update(expenses)
+    changes["lists"].update(lists)
+
+
+def add_event(session: Session, type: str, friends: Iterable[int] = (), expenses: Iterable[int] = (),
+              affected_friends: Iterable[int] = ()):
+    # type: friend_created, friend_updated, friend_deleted, expense_created, expense_updated,
+    # expense_deleted, participant_added, participant_removed or credit_updated.
+    # friends and expenses are the subjects of the event, affected_friends the other friends
+    # whose balances changed with it (e.g. the debits of the participants when one joins).
+    get_changes(session)["events"].append({"type": type, "friend_ids": list(friends), "expense_ids": list(expenses),
+                                           "affected_friend_ids": list(affected_friends)})
+
+
+def on_commit(listener: Callable[[dict[str, set]], None]):
+    listeners.append(listener)
+    return listener
+
+
+@event.listens_for(Session, "after_commit")
+def notify_changes(session: Session):
+    changes = session.info.pop(CHANGES_KEY, None)
+    if changes is None:
+        return
+    for listener in listeners:
+        listener(changes)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_changes(session: Session):
+    session.info.pop(CHANGES_KEY, None)
@@ -1,12 +1,178 @@
 from typing import Any
 from sqlmodel import create_engine, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import event
+from sqlalchemy.util import await_only
+from concurrent.futures import Future
+import asyncio
+from sqlalchemy.ext.asyncio import create_async_engine
+from fastapi import Depends
+from persistence.instrumentation import CountingConnection, instrument_engine
+import functools
+import inspect
+import os
 
 
 SQLITE_FILE_NAME = "expenses.db"
 SQLITE_URL = f"sqlite:///{SQLITE_FILE_NAME}"
+SQLITE_ASYNC_URL = f"sqlite+aiosqlite:///{SQLITE_FILE_NAME}"
+SQLITE_READ_ONLY_URL = f"sqlite:///file:{SQLITE_FILE_NAME}?mode=ro&uri=true"
+SQLITE_ASYNC_READ_ONLY_URL = f"sqlite+aiosqlite:///file:{SQLITE_FILE_NAME}?mode=ro&uri=true"
 
-engine = create_engine(SQLITE_URL, echo=True)
+# Serve requests with async def handlers on an async engine (SPLITWITHME_DB_MODE=async)
+# or with def handlers in the threadpool on the sync engine (SPLITWITHME_DB_MODE=sync)
+DB_MODE = os.environ.get("SPLITWITHME_DB_MODE", "sync")
+if DB_MODE not in ("sync", "async"):
+    raise ValueError(f"Unknown SPLITWITHME_DB_MODE '{DB_MODE}' (required: sync or async)")
+
+# Engine profiles (SPLITWITHME_DB_PROFILE). Every setting can be overridden with its own
+# environment variable, e.g. SPLITWITHME_DB_BUSY_TIMEOUT=10000
+PROFILES = {
+    "development": {
+        "echo": True,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "mmap_size": 0,
+        "cache_size": -2000,
+        "foreign_keys": True,
+        "pool_size": 5,
+        "max_overflow": 10,
+        "pool_timeout": 30.0,
+        "read_only_connections": False,
+        "group_commit_window": 0.0,
+        "group_commit_max_size": 500,
+    },
+    "production": {
+        "echo": False,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "mmap_size": 268435456,
+        "cache_size": -65536,
+        "foreign_keys": True,
+        "pool_size": 20,
+        "max_overflow": 20,
+        "pool_timeout": 30.0,
+        "read_only_connections": True,
+        "group_commit_window": 0.0,
+        "group_commit_max_size": 500,
+    },
+}
+
+
+def get_settings() -> dict[str, Any]:
+    profile = os.environ.get("SPLITWITHME_DB_PROFILE", "development")
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown SPLITWITHME_DB_PROFILE '{profile}' (required: {' or '.join(PROFILES)})")
+    settings = dict(PROFILES[profile])
+    for name, default in settings.items():
+        value = os.environ.get(f"SPLITWITHME_DB_{name.upper()}")
+        if value is None:
+            continue
+        if isinstance(default, bool):
+            settings[name] = value.lower() in ("1", "true", "yes", "on")
+        else:
+            settings[name] = type(default)(value)
+    return settings
+
+
+DB_SETTINGS = get_settings()
+# Pragmas applied to every new connection (journal_mode is persistent, so read-only connections skip it)
+CONNECTION_PRAGMAS = ["synchronous", "busy_timeout", "mmap_size", "cache_size", "foreign_keys"]
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record, read_only: bool = False):
+    cursor = dbapi_connection.cursor()
+    if not read_only:
+        cursor.execute(f"PRAGMA journal_mode = {DB_SETTINGS['journal_mode']}")
+    for name in CONNECTION_PRAGMAS:
+        value = DB_SETTINGS[name]
+        cursor.execute(f"PRAGMA {name} = {int(value) if isinstance(value, bool) else value}")
+    cursor.close()
+
+
+def configure_engine(engine, read_only: bool = False):
+    sync_engine = getattr(engine, "sync_engine", engine)
+    event.listen(sync_engine, "connect", functools.partial(set_sqlite_pragmas, read_only=read_only))
+    return instrument_engine(engine)
+
+
+def get_engine_options() -> dict[str, Any]:
+    return {
+        "echo": DB_SETTINGS["echo"],
+        "pool_size": DB_SETTINGS["pool_size"],
+        "max_overflow": DB_SETTINGS["max_overflow"],
+        "pool_timeout": DB_SETTINGS["pool_timeout"],
+        # Connections count the rows they fetch for the request metrics
+        "connect_args": {"factory": CountingConnection},
+    }
+
+
+engine = configure_engine(create_engine(SQLITE_URL, **get_engine_options()))
+async_engine = None
+if DB_MODE == "async":
+    async_engine = configure_engine(create_async_engine(SQLITE_ASYNC_URL, **get_engine_options()))
+
+# Readers use their own read-only connections, so they never wait behind a writer
+read_engine = engine
+async_read_engine = async_engine
+if DB_SETTINGS["read_only_connections"]:
+    read_engine = configure_engine(create_engine(SQLITE_READ_ONLY_URL, **get_engine_options()), read_only=True)
+    if DB_MODE == "async":
+        async_read_engine = configure_engine(create_async_engine(SQLITE_ASYNC_READ_ONLY_URL, **get_engine_options()), read_only=True)
 
 def get_session() -> Any:
     with Session(engine) as session:
-        yield session
\ No newline at end of file
+        yield session
+
+def get_read_session() -> Any:
+    with Session(read_engine) as session:
+        yield session
+
+async def get_async_session() -> Any:
+    async with AsyncSession(async_engine) as session:
+        yield session
+
+async def get_async_read_session() -> Any:
+    async with AsyncSession(async_read_engine) as session:
+        yield session
+
+
+# Async versions of the session dependencies, and how the handler gets the sync session (None:
+# as is). Other modules add the dependencies built on a session (see persistence.storage).
+ASYNC_DEPENDENCIES = {get_session: (get_async_session, None), get_read_session: (get_async_read_session, None)}
+
+
+def db_handler(handler):
+    # In async mode, turn a handler written against a sync Session into an async def handler.
+    # The handler body runs on the async session connection through run_sync, so lazy loads
+    # and commits await the driver instead of blocking a threadpool worker.
+    if DB_MODE == "sync":
+        return handler
+
+    signature = inspect.signature(handler)
+    name = next((parameter.name for parameter in signature.parameters.values()
+                 if getattr(parameter.default, "dependency", None) in ASYNC_DEPENDENCIES), None)
+    if name is None:
+        # Not served from a database session (e.g. the in-memory repository)
+        return handler
+    async_dependency, wrap = ASYNC_DEPENDENCIES[signature.parameters[name].default.dependency]
+    parameters = [parameter.replace(default=Depends(async_dependency)) if parameter.name == name else parameter
+                  for parameter in signature.parameters.values()]
+
+    @functools.wraps(handler)
+    async def async_handler(**kwargs):
+        session = kwargs.pop(name)
+        return await session.run_sync(lambda sync_session: handler(**{name: wrap(sync_session) if wrap else sync_session}, **kwargs))
+
+    async_handler.__signature__ = signature.replace(parameters=parameters)
+    return async_handler
+
+
+def wait(future: Future) -> Any:
+    # Wait for a future from a handler: in async mode the handler runs on the event loop
+    # (through run_sync), so it awaits the future instead of blocking the loop
+    if DB_MODE == "async":
+        return await_only(asyncio.wrap_future(future))
+    return future.result()
@@ -0,0 +1,82 @@
+from typing import Optional
+from concurrent.futures import Future
+from sqlmodel import Session
+from persistence.database import engine, DB_SETTINGS
+from persistence.balances import add_link_credit, add_balance_credits
+import queue
+import threading
+import time
+
+
+class CreditCommitter:
+    # Group commit of credit updates: the credits submitted within the same window are applied
+    # by a single writer thread in one transaction, so they share one commit (and one fsync).
+    # Every credit is still an atomic UPDATE ... RETURNING, so no increment is ever lost.
+
+    def __init__(self, engine, window: float, max_size: int):
+        self.engine = engine
+        self.window = window
+        self.max_size = max_size
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, expense_id: int, friend_id: int, amount: float) -> Future:
+        # The future returns the new credit of the friend in the expense (None if not assigned)
+        future = Future()
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="credit-committer", daemon=True)
+                self.thread.start()
+        self.queue.put((expense_id, friend_id, amount, future))
+        return future
+
+    def stop(self):
+        with self.lock:
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread.join()
+                self.thread = None
+
+    def run(self):
+        while True:
+            credit = self.queue.get()
+            if credit is None:
+                return
+            credits = [credit]
+            deadline = time.monotonic() + self.window
+            while len(credits) < self.max_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    credit = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if credit is None:
+                    self.commit(credits)
+                    return
+                credits.append(credit)
+            self.commit(credits)
+
+    def commit(self, credits: list):
+        try:
+            with Session(self.engine) as session:
+                new_amounts = [add_link_credit(expense_id, friend_id, amount, session)
+                               for expense_id, friend_id, amount, _ in credits]
+                add_balance_credits([(expense_id, friend_id, amount)
+                                     for (expense_id, friend_id, amount, _), new_amount in zip(credits, new_amounts)
+                                     if new_amount is not None], session)
+                session.commit()
+        except Exception as exception:
+            for *_, future in credits:
+                future.set_exception(exception)
+        else:
+            for (*_, future), new_amount in zip(credits, new_amounts):
+                future.set_result(new_amount)
+
+
+# Opt-in with SPLITWITHME_DB_GROUP_COMMIT_WINDOW (in seconds)
+credit_committer: Optional[CreditCommitter] = None
+if DB_SETTINGS["group_commit_window"] > 0:
+    credit_committer = CreditCommitter(engine, DB_SETTINGS["group_commit_window"], DB_SETTINGS["group_commit_max_size"])
@@ -0,0 +1,235 @@
+from typing import Optional
+from datetime import datetime, timedelta, timezone
+from persistence.database import engine
+from persistence.models import Friend, Expense, BalanceEntry, BalanceSnapshot, SnapshotBalance
+from persistence.repository import HistoryUnavailable
+from sqlmodel import Session, select, delete, insert, func, or_
+from sqlalchemy import literal
+from sqlalchemy.orm import aliased
+import logging
+import os
+import threading
+
+
+# Every change of a balance is appended to the ledger (BalanceEntry) by persistence.balances, in
+# the same transaction. Snapshots store the balances changed since the previous one, so the
+# balance at a time is the one in the latest snapshot before it plus the few ledger entries
+# between that snapshot and the time.
+
+# Seconds between snapshots (SPLITWITHME_SNAPSHOT_INTERVAL, 0 disables them: the balances at a
+# time are then replayed from the first snapshot)
+SNAPSHOT_INTERVAL = float(os.environ.get("SPLITWITHME_SNAPSHOT_INTERVAL", "3600"))
+# Days of history kept (SPLITWITHME_HISTORY_RETENTION_DAYS, 0 keeps all of it)
+RETENTION_DAYS = float(os.environ.get("SPLITWITHME_HISTORY_RETENTION_DAYS", "365"))
+RETENTION = timedelta(days=RETENTION_DAYS) if RETENTION_DAYS > 0 else None
+
+logger = logging.getLogger("splitwithme.history")
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def to_utc(value: datetime) -> datetime:
+    # Naive times are taken as UTC
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def record_entries(session: Session, entries: list[tuple[Optional[int], Optional[int], float, float]]):
+    # Append (friend_id, expense_id, credit, debit) changes to the ledger. Call after the UPDATEs
+    # of the balances: the transaction holds the write lock, so the times follow the commit order.
+    if not entries:
+        return
+    timestamp = utc_now()
+    session.exec(insert(BalanceEntry), params=[{"timestamp": timestamp, "friend_id": friend_id, "expense_id": expense_id,
+                                                "credit": credit, "debit": debit}
+                                               for friend_id, expense_id, credit, debit in entries])
+
+
+def get_snapshot(session: Session, as_of: datetime) -> BalanceSnapshot:
+    # Snapshots are taken in time order: the index on taken_at finds the latest one
+    snapshot = session.exec(select(BalanceSnapshot).where(BalanceSnapshot.taken_at <= as_of)
+                            .order_by(BalanceSnapshot.taken_at.desc(), BalanceSnapshot.id.desc()).limit(1)).first()
+    if snapshot is None:
+        raise HistoryUnavailable(session.exec(select(func.min(BalanceSnapshot.taken_at))).one())
+    return snapshot
+
+
+def get_balance_as_of(session: Session, as_of: datetime, friend_id: Optional[int] = None,
+                      expense_id: Optional[int] = None) -> tuple[float, float]:
+    # Credit and debit balance of a friend, or credit balance of an expense (its debit is 0), at a
+    # time: the latest balance stored up to the latest snapshot taken before it, plus the ledger
+    # entries after that snapshot and up to the time. One index range per query.
+    snapshot = get_snapshot(session, as_of)
+    if friend_id is not None:
+        balance_column, entry_column, subject_id = SnapshotBalance.friend_id, BalanceEntry.friend_id, friend_id
+        debit = func.sum(BalanceEntry.debit)
+    else:
+        balance_column, entry_column, subject_id = SnapshotBalance.expense_id, BalanceEntry.expense_id, expense_id
+        debit = literal(0)
+    balance = session.exec(select(SnapshotBalance.credit_balance, SnapshotBalance.debit_balance)
+                           .where(balance_column == subject_id)
+                           .where(SnapshotBalance.snapshot_id <= snapshot.id)
+                           .order_by(SnapshotBalance.snapshot_id.desc()).limit(1)).first()
+    credit_balance, debit_balance = balance if balance is not None else (0, 0)
+    statement = (select(func.sum(BalanceEntry.credit), debit)
+                 .where(entry_column == subject_id)
+                 .where(BalanceEntry.id > snapshot.last_entry_id)
+                 .where(BalanceEntry.timestamp <= as_of))
+    # Entries are numbered in commit order: the ones up to the time are in the next snapshot
+    next_entry_id = session.exec(select(BalanceSnapshot.last_entry_id).where(BalanceSnapshot.id > snapshot.id)
+                                 .order_by(BalanceSnapshot.id).limit(1)).first()
+    if next_entry_id is not None:
+        statement = statement.where(BalanceEntry.id <= next_entry_id)
+    credit, debit = session.exec(statement).one()
+    return credit_balance + (credit or 0), debit_balance + (debit or 0)
+
+
+def take_snapshot(session: Session) -> Optional[BalanceSnapshot]:
+    # Store the balances changed since the previous snapshot, or every balance that is not 0 in
+    # the first one. Returns None (and stores nothing) if the ledger has no new entries.
+    # The snapshot is inserted first, so the balances are read within the write transaction.
+    snapshot = BalanceSnapshot(taken_at=utc_now(), last_entry_id=0)
+    session.add(snapshot)
+    session.flush()
+    previous = session.exec(select(BalanceSnapshot).where(BalanceSnapshot.id < snapshot.id)
+                            .order_by(BalanceSnapshot.id.desc()).limit(1)).first()
+    last_entry = session.exec(select(BalanceEntry.id, BalanceEntry.timestamp)
+                              .order_by(BalanceEntry.id.desc()).limit(1)).first()
+    if previous is None:
+        snapshot.last_entry_id = last_entry[0] if last_entry is not None else 0
+        session.exec(insert(SnapshotBalance).from_select(
+            ["snapshot_id", "friend_id", "credit_balance", "debit_balance"],
+            select(literal(snapshot.id), Friend.id, Friend.credit_balance, Friend.debit_balance)
+            .where(or_(Friend.credit_balance != 0, Friend.debit_balance != 0))))
+        session.exec(insert(SnapshotBalance).from_select(
+            ["snapshot_id", "expense_id", "credit_balance", "debit_balance"],
+            select(literal(snapshot.id), Expense.id, Expense.credit_balance, literal(0))
+            .where(Expense.credit_balance != 0)))
+    elif last_entry is None or last_entry[0] == previous.last_entry_id:
+        session.rollback()
+        return None
+    else:
+        # Taken at the time of its last entry, so the entries after it are after its time
+        snapshot.last_entry_id, snapshot.taken_at = last_entry
+        add_changed_balances(session, snapshot, previous, BalanceEntry.friend_id, SnapshotBalance.friend_id)
+        add_changed_balances(session, snapshot, previous, BalanceEntry.expense_id, SnapshotBalance.expense_id)
+    session.commit()
+    session.refresh(snapshot)
+    return snapshot
+
+
+def add_changed_balances(session: Session, snapshot: BalanceSnapshot, previous: BalanceSnapshot,
+                         entry_column, balance_column):
+    # INSERT ... SELECT of the previous balance plus the sum of the new entries, by friend or by expense
+    entries = (select(entry_column.label("subject_id"),
+                      func.sum(BalanceEntry.credit).label("credit"),
+                      func.sum(BalanceEntry.debit).label("debit"))
+               .where(entry_column.is_not(None))
+               .where(BalanceEntry.id > previous.last_entry_id)
+               .where(BalanceEntry.id <= snapshot.last_entry_id)
+               .group_by(entry_column)
+               .subquery())
+
+    def get_previous(column):
+        return (select(column).where(balance_column == entries.c.subject_id)
+                .order_by(SnapshotBalance.snapshot_id.desc()).limit(1).scalar_subquery())
+
+    credit_balance = func.coalesce(get_previous(SnapshotBalance.credit_balance), 0) + entries.c.credit
+    if balance_column is SnapshotBalance.friend_id:
+        debit_balance = func.coalesce(get_previous(SnapshotBalance.debit_balance), 0) + entries.c.debit
+    else:
+        debit_balance = literal(0)
+    session.exec(insert(SnapshotBalance).from_select(
+        ["snapshot_id", balance_column.key, "credit_balance", "debit_balance"],
+        select(literal(snapshot.id), entries.c.subject_id, credit_balance, debit_balance)))
+
+
+def compact(session: Session, retention: timedelta) -> int:
+    # Drop the history older than the retention. The latest snapshot taken before the cutoff is
+    # kept (with one balance per friend and expense that is not 0), the snapshots and ledger
+    # entries before it are deleted. Returns the number of deleted entries.
+    cutoff = utc_now() - retention
+    boundary = session.exec(select(BalanceSnapshot).where(BalanceSnapshot.taken_at <= cutoff)
+                            .order_by(BalanceSnapshot.taken_at.desc(), BalanceSnapshot.id.desc()).limit(1)).first()
+    if boundary is None:
+        return 0
+    newer = aliased(SnapshotBalance)
+    for column, newer_column in ((SnapshotBalance.friend_id, newer.friend_id),
+                                 (SnapshotBalance.expense_id, newer.expense_id)):
+        # Balances replaced by a newer one up to the boundary
+        superseded = (select(newer.id).where(newer_column == column)
+                      .where(newer.snapshot_id > SnapshotBalance.snapshot_id)
+                      .where(newer.snapshot_id <= boundary.id))
+        session.exec(delete(SnapshotBalance)
+                     .where(column.is_not(None))
+                     .where(SnapshotBalance.snapshot_id < boundary.id)
+                     .where(superseded.exists()))
+    # A missing balance is 0
+    session.exec(delete(SnapshotBalance)
+                 .where(SnapshotBalance.snapshot_id <= boundary.id)
+                 .where(SnapshotBalance.credit_balance == 0)
+                 .where(SnapshotBalance.debit_balance == 0))
+    session.exec(delete(BalanceSnapshot).where(BalanceSnapshot.id < boundary.id))
+    num_entries = session.exec(delete(BalanceEntry).where(BalanceEntry.id <= boundary.last_entry_id)).rowcount
+    session.commit()
+    return num_entries
+
+
+class SnapshotTaker:
+    # Takes a snapshot every interval and drops the history older than the retention, in a thread
+
+    def __init__(self, engine, interval: float, retention: Optional[timedelta]):
+        self.engine = engine
+        self.interval = interval
+        self.retention = retention
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.interval > 0 and self.thread is None:
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, name="snapshot-taker", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                # Retried at the next interval: the ledger keeps every change meanwhile
+                logger.exception("Balance snapshot failed")
+
+    def run_once(self) -> Optional[BalanceSnapshot]:
+        with Session(self.engine) as session:
+            snapshot = take_snapshot(session)
+            if self.retention is not None:
+                compact(session, self.retention)
+            return snapshot
+
+
+snapshot_taker = SnapshotTaker(engine, SNAPSHOT_INTERVAL, RETENTION)
+
+
+if __name__ == "__main__":
+    import argparse
+    from persistence.utils import create_db_and_tables
+
+    parser = argparse.ArgumentParser(description="Take a balance snapshot and drop the history older than the retention")
+    parser.add_argument("--retention-days", type=float, default=RETENTION_DAYS,
+                        help="days of history kept (0 keeps all of it)")
+    args = parser.parse_args()
+    create_db_and_tables()
+    with Session(engine) as session:
+        snapshot = take_snapshot(session)
+        print(f"Snapshot {snapshot.id} taken at {snapshot.taken_at}" if snapshot is not None else "No changes since the last snapshot")
+        if args.retention_days > 0:
+            print(f"{compact(session, timedelta(days=args.retention_days))} ledger entries dropped")
@@ -0,0 +1,105 @@
+from typing import Any, Optional
+from contextvars import ContextVar
+from sqlalchemy import event
+import logging
+import os
+import sqlite3
+import time
+
+
+# SQL statements slower than this are logged (SPLITWITHME_SLOW_QUERY_MS, 0 disables the log)
+SLOW_QUERY_MS = float(os.environ.get("SPLITWITHME_SLOW_QUERY_MS", "0"))
+
+slow_query_logger = logging.getLogger("splitwithme.slow_query")
+
+# Statistics of the database work done for the current request (None outside requests)
+request_stats: ContextVar[Optional[dict[str, Any]]] = ContextVar("request_stats", default=None)
+
+
+def new_request_stats(route: str = "") -> dict[str, Any]:
+    return {"route": route, "statements": 0, "db_time": 0.0, "rows": 0}
+
+
+class CountingCursor(sqlite3.Cursor):
+    # Adds the rows fetched through the cursor to the request that checked out its connection
+
+    def count(self, rows: int):
+        stats = self.connection.request_stats
+        if stats is not None:
+            stats["rows"] += rows
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self.count(1)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = super().fetchmany(*args, **kwargs)
+        self.count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self.count(len(rows))
+        return rows
+
+
+class CountingConnection(sqlite3.Connection):
+    # sqlite3 connection factory. Rows may be fetched in another thread (the aiosqlite one),
+    # where the request context is not available, so the request is bound to the connection
+    # while it is checked out.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.request_stats = None
+
+    def cursor(self, factory=CountingCursor):
+        return super().cursor(factory)
+
+
+def get_sqlite_connection(dbapi_connection) -> Any:
+    # The async driver wraps the sqlite3 connection
+    connection = getattr(dbapi_connection, "driver_connection", dbapi_connection)
+    return getattr(connection, "_conn", connection)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["query_start"].pop()
+    stats = request_stats.get()
+    if stats is not None:
+        stats["statements"] += 1
+        stats["db_time"] += duration
+        # Rows changed by statements without results (the fetched rows are counted by the cursor)
+        if cursor.description is None and cursor.rowcount > 0:
+            stats["rows"] += cursor.rowcount
+    if SLOW_QUERY_MS > 0 and duration * 1000 >= SLOW_QUERY_MS:
+        slow_query_logger.warning("Slow query (%.1f ms)%s: %s %s", duration * 1000,
+                                  f" in {stats['route']}" if stats is not None and stats["route"] else "",
+                                  " ".join(statement.split()), parameters if not executemany else f"[{len(parameters)} rows]")
+
+
+def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    connection = get_sqlite_connection(dbapi_connection)
+    if isinstance(connection, CountingConnection):
+        connection.request_stats = request_stats.get()
+
+
+def on_checkin(dbapi_connection, connection_record):
+    connection = get_sqlite_connection(dbapi_connection)
+    if isinstance(connection, CountingConnection):
+        connection.request_stats = None
+
+
+def instrument_engine(engine):
+    # Count the statements, database time and rows of every request served by the engine
+    sync_engine = getattr(engine, "sync_engine", engine)
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(sync_engine.pool, "checkout", on_checkout)
+    event.listen(sync_engine.pool, "checkin", on_checkin)
+    return engine
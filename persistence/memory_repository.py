@@ -0,0 +1,571 @@
+from typing import Callable, Iterator, Literal, Optional
+from datetime import date, datetime
+from persistence.models import Friend, Expense, FriendExpenseLink, FriendExpense, ExpenseFriend
+from persistence.changes import mark_changed, add_event, get_changes, notify_changes
+from persistence.history import RETENTION, utc_now
+from persistence.repository import AlreadyExists, HistoryUnavailable, Repository
+from routers.pagination import decode_cursor, get_prefix_upper_bound
+from sqlalchemy import text
+import bisect
+import threading
+
+
+# Records are plain __slots__ objects: no per-instance dict, so millions of links fit in memory.
+# The sorted id lists of FriendRecord and ExpenseRecord are the indexes of the links by friend
+# and by expense.
+
+class FriendRecord:
+    __slots__ = ("id", "name", "credit_balance", "debit_balance", "expense_ids")
+
+    def __init__(self, id: int, name: str, credit_balance: float = 0, debit_balance: float = 0):
+        self.id = id
+        self.name = name
+        self.credit_balance = credit_balance
+        self.debit_balance = debit_balance
+        self.expense_ids = []
+
+
+class ExpenseRecord:
+    __slots__ = ("id", "description", "date", "amount", "credit_balance", "num_friends", "friend_ids")
+
+    def __init__(self, id: int, description: str, date: date, amount: float, credit_balance: float = 0, num_friends: int = 1):
+        self.id = id
+        self.description = description
+        self.date = date
+        self.amount = amount
+        self.credit_balance = credit_balance
+        self.num_friends = num_friends
+        self.friend_ids = []
+
+
+class LinkRecord:
+    __slots__ = ("expense_id", "friend_id", "amount")
+
+    def __init__(self, expense_id: int, friend_id: int, amount: float = 0):
+        self.expense_id = expense_id
+        self.friend_id = friend_id
+        self.amount = amount
+
+
+class SortedIndex:
+    # Sorted list of (sort value, id) keys, scanned from a cursor like paginate() scans an index
+
+    def __init__(self, keys: Optional[list[tuple]] = None):
+        self.keys = sorted(keys or [])
+
+    def add(self, key: tuple):
+        bisect.insort(self.keys, key)
+
+    def remove(self, key: tuple):
+        del self.keys[bisect.bisect_left(self.keys, key)]
+
+    def scan(self, after: Optional[tuple], descending: bool, low: Optional[tuple] = None, high: Optional[tuple] = None) -> Iterator[tuple]:
+        # Keys after the cursor key, within [low, high)
+        start = bisect.bisect_left(self.keys, low) if low is not None else 0
+        end = bisect.bisect_left(self.keys, high) if high is not None else len(self.keys)
+        if descending:
+            if after is not None:
+                end = min(end, bisect.bisect_left(self.keys, after))
+            return (self.keys[index] for index in range(end - 1, start - 1, -1))
+        if after is not None:
+            start = max(start, bisect.bisect_right(self.keys, after))
+        return (self.keys[index] for index in range(start, end))
+
+
+def take(keys: Iterator[tuple], limit: int, matches: Optional[Callable[[int], bool]] = None) -> list[int]:
+    # Ids of the first limit + 1 keys that match (the extra one tells whether there is a next page)
+    ids = []
+    for key in keys:
+        if matches is None or matches(key[-1]):
+            ids.append(key[-1])
+            if len(ids) > limit:
+                break
+    return ids
+
+
+def get_after(cursor: Optional[str], sort: str, sort_column=None) -> Optional[tuple]:
+    if cursor is None:
+        return None
+    sort_value, id = decode_cursor(cursor, sort_column)
+    return (id,) if sort == "id" else (sort_value, id)
+
+
+def insert_id(ids: list[int], id: int):
+    bisect.insort(ids, id)
+
+
+def remove_id(ids: list[int], id: int):
+    del ids[bisect.bisect_left(ids, id)]
+
+
+class Transaction:
+    # Changes of a write, published to the on_commit listeners like a committed session
+    __slots__ = ("info",)
+
+    def __init__(self):
+        self.info = {}
+
+
+class MemoryRepository(Repository):
+    # Repository in process memory, for tests and load tests that do not measure SQLite. Friends
+    # and expenses are kept by id, with sorted indexes for every list order, and the links are
+    # indexed by (expense, friend) and by friend and by expense. Nothing is persisted.
+    # A single lock serializes the operations: each write is atomic, like a transaction.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.friends: dict[int, FriendRecord] = {}
+        self.expenses: dict[int, ExpenseRecord] = {}
+        self.links: dict[tuple[int, int], LinkRecord] = {}
+        self.expense_keys: dict[tuple[str, date], int] = {}
+        self.friends_by_id = SortedIndex()
+        self.friends_by_name = SortedIndex()
+        self.expenses_by_id = SortedIndex()
+        self.expenses_by_date = SortedIndex()
+        self.expenses_by_amount = SortedIndex()
+        self.next_friend_id = 1
+        self.next_expense_id = 1
+        # Balance history: (time, credit balance, debit balance) of every friend and (time, credit
+        # balance) of every expense since history_start, in time order. Nothing is kept for 0.
+        self.friend_history: dict[int, list[tuple]] = {}
+        self.expense_history: dict[int, list[tuple]] = {}
+        self.history_start = utc_now()
+
+    def load(self, engine):
+        # Start from the contents of a database (balances included, as stored)
+        with engine.connect() as connection, self.lock:
+            for id, name, credit_balance, debit_balance in connection.execute(
+                    text("SELECT id, name, credit_balance, debit_balance FROM friend")):
+                self.friends[id] = FriendRecord(id, name, credit_balance, debit_balance)
+            for id, description, expense_date, amount, credit_balance, num_friends in connection.execute(
+                    text("SELECT id, description, date, amount, credit_balance, num_friends FROM expense")):
+                expense_date = date.fromisoformat(expense_date)
+                self.expenses[id] = ExpenseRecord(id, description, expense_date, amount, credit_balance, num_friends)
+                self.expense_keys[(description, expense_date)] = id
+            for expense_id, friend_id, amount in connection.execute(
+                    text("SELECT expense_id, friend_id, amount FROM friendexpenselink ORDER BY expense_id, friend_id")):
+                self.links[(expense_id, friend_id)] = LinkRecord(expense_id, friend_id, amount)
+                self.friends[friend_id].expense_ids.append(expense_id)
+                self.expenses[expense_id].friend_ids.append(friend_id)
+            self.friends_by_id = SortedIndex([(id,) for id in self.friends])
+            self.friends_by_name = SortedIndex([(friend.name, friend.id) for friend in self.friends.values()])
+            self.expenses_by_id = SortedIndex([(id,) for id in self.expenses])
+            self.expenses_by_date = SortedIndex([(expense.date, expense.id) for expense in self.expenses.values()])
+            self.expenses_by_amount = SortedIndex([(expense.amount, expense.id) for expense in self.expenses.values()])
+            # Ids are never reused, like in the database: the new ones start after the deleted ones
+            sequences = dict(connection.execute(text("SELECT name, seq FROM sqlite_sequence")).all())
+            self.next_friend_id = max(max(self.friends, default=0), sequences.get("friend", 0)) + 1
+            self.next_expense_id = max(max(self.expenses, default=0), sequences.get("expense", 0)) + 1
+            # The history starts with the loaded balances
+            self.history_start = utc_now()
+            self.friend_history = {friend.id: [(self.history_start, friend.credit_balance, friend.debit_balance)]
+                                   for friend in self.friends.values() if friend.credit_balance or friend.debit_balance}
+            self.expense_history = {expense.id: [(self.history_start, expense.credit_balance)]
+                                    for expense in self.expenses.values() if expense.credit_balance}
+
+    def commit(self, transaction: Transaction):
+        # Call with the lock held, after the write: the events carry the balances as of the write,
+        # and the new balances are added to the history
+        changes = get_changes(transaction)
+        now = utc_now()
+        for friend_id in changes["friends"]:
+            friend = self.friends.get(friend_id)
+            if friend is not None:
+                add_history(self.friend_history, friend_id, now, (friend.credit_balance, friend.debit_balance))
+            else:
+                self.friend_history.pop(friend_id, None)
+        for expense_id in changes["expenses"]:
+            expense = self.expenses.get(expense_id)
+            if expense is not None:
+                add_history(self.expense_history, expense_id, now, (expense.credit_balance,))
+            else:
+                self.expense_history.pop(expense_id, None)
+        for event in changes["events"]:
+            event["friends"] = [to_balances(self.friends[friend_id])
+                                for friend_id in dict.fromkeys(event["friend_ids"] + event["affected_friend_ids"])
+                                if friend_id in self.friends]
+            event["expenses"] = [to_balances(self.expenses[expense_id]) for expense_id in event["expense_ids"]
+                                 if expense_id in self.expenses]
+
+    # Friends
+
+    def get_friend(self, friend_id: int) -> Optional[Friend]:
+        with self.lock:
+            record = self.friends.get(friend_id)
+            values = get_values(record) if record is not None else None
+        return Friend(**values) if values is not None else None
+
+    def get_friends(self, name_prefix: Optional[str], sort: Literal["id", "name"], descending: bool,
+                    cursor: Optional[str], limit: int) -> list[Friend]:
+        after = get_after(cursor, sort)
+        with self.lock:
+            if sort == "name":
+                low = high = None
+                if name_prefix:
+                    upper_bound = get_prefix_upper_bound(name_prefix)
+                    low, high = (name_prefix,), (upper_bound,) if upper_bound is not None else None
+                ids = take(self.friends_by_name.scan(after, descending, low, high), limit)
+            elif name_prefix:
+                ids = take(self.friends_by_id.scan(after, descending), limit,
+                           lambda friend_id: self.friends[friend_id].name.startswith(name_prefix))
+            else:
+                ids = take(self.friends_by_id.scan(after, descending), limit)
+            rows = [get_values(self.friends[friend_id]) for friend_id in ids]
+        # The models are built outside the lock (it only copies the values)
+        return [Friend(**values) for values in rows]
+
+    def get_friend_as_of(self, friend_id: int, as_of: datetime) -> Optional[Friend]:
+        with self.lock:
+            record = self.friends.get(friend_id)
+            if record is None:
+                return None
+            self.check_history(as_of)
+            values = get_values(record)
+            values["credit_balance"], values["debit_balance"] = get_history(self.friend_history, friend_id, as_of, (0, 0))
+        return Friend(**values)
+
+    def get_friend_expenses(self, friend_id: int, cursor: Optional[str], limit: int) -> Optional[list[FriendExpense]]:
+        after = get_after(cursor, "id")
+        with self.lock:
+            friend = self.friends.get(friend_id)
+            if friend is None:
+                return None
+            start = bisect.bisect_right(friend.expense_ids, after[0]) if after is not None else 0
+            friend_expenses = []
+            for expense_id in friend.expense_ids[start:start + limit + 1]:
+                expense = self.expenses[expense_id]
+                friend_expenses.append(FriendExpense(id=expense.id, description=expense.description, amount=expense.amount,
+                                                     num_friends=expense.num_friends,
+                                                     credit_balance=self.links[(expense_id, friend_id)].amount,
+                                                     debit_balance=expense.amount / expense.num_friends))
+            return friend_expenses
+
+    def get_existing_friends(self, friend_ids: set[int]) -> set[int]:
+        with self.lock:
+            return {friend_id for friend_id in friend_ids if friend_id in self.friends}
+
+    def add_friend(self, friend: Friend) -> Optional[Friend]:
+        transaction = Transaction()
+        with self.lock:
+            if friend.id in self.friends:
+                return None
+            friend_id = friend.id if friend.id is not None else self.next_friend_id
+            self.next_friend_id = max(self.next_friend_id, friend_id + 1)
+            record = FriendRecord(friend_id, friend.name, friend.credit_balance, friend.debit_balance)
+            self.friends[friend_id] = record
+            self.friends_by_id.add((friend_id,))
+            self.friends_by_name.add((record.name, friend_id))
+            mark_changed(transaction, lists=["friends"])
+            add_event(transaction, "friend_created", friends=[friend_id])
+            self.commit(transaction)
+            values = get_values(record)
+        notify_changes(transaction)
+        return Friend(**values)
+
+    def update_friend(self, friend: Friend, name: str):
+        transaction = Transaction()
+        with self.lock:
+            record = self.friends[friend.id]
+            self.friends_by_name.remove((record.name, record.id))
+            record.name = name
+            self.friends_by_name.add((record.name, record.id))
+            mark_changed(transaction, friends=[record.id], lists=["friends"])
+            add_event(transaction, "friend_updated", friends=[record.id])
+            self.commit(transaction)
+        notify_changes(transaction)
+
+    def delete_friend(self, friend: Friend):
+        transaction = Transaction()
+        with self.lock:
+            record = self.friends[friend.id]
+            for expense_id in list(record.expense_ids):
+                self.remove_link(self.links[(expense_id, record.id)], transaction)
+            del self.friends[record.id]
+            self.friends_by_id.remove((record.id,))
+            self.friends_by_name.remove((record.name, record.id))
+            mark_changed(transaction, friends=[record.id], lists=["friends"])
+            add_event(transaction, "friend_deleted", friends=[record.id])
+            self.commit(transaction)
+        notify_changes(transaction)
+
+    # Expenses
+
+    def get_expense(self, expense_id: int) -> Optional[Expense]:
+        with self.lock:
+            record = self.expenses.get(expense_id)
+            values = get_values(record) if record is not None else None
+        return Expense(**values) if values is not None else None
+
+    def get_expense_as_of(self, expense_id: int, as_of: datetime) -> Optional[Expense]:
+        with self.lock:
+            record = self.expenses.get(expense_id)
+            if record is None:
+                return None
+            self.check_history(as_of)
+            values = get_values(record)
+            values["credit_balance"], = get_history(self.expense_history, expense_id, as_of, (0,))
+        return Expense(**values)
+
+    def check_history(self, as_of: datetime):
+        start = self.history_start if RETENTION is None else max(self.history_start, utc_now() - RETENTION)
+        if as_of < start:
+            raise HistoryUnavailable(start)
+
+    def get_expenses(self, date_from: Optional[date], date_to: Optional[date],
+                     min_amount: Optional[float], max_amount: Optional[float],
+                     sort: Literal["id", "date", "amount"], descending: bool,
+                     cursor: Optional[str], limit: int) -> list[Expense]:
+        after = get_after(cursor, sort, Expense.date if sort == "date" else None)
+
+        def matches(expense_id: int) -> bool:
+            expense = self.expenses[expense_id]
+            return ((date_from is None or expense.date >= date_from) and (date_to is None or expense.date <= date_to)
+                    and (min_amount is None or expense.amount >= min_amount) and (max_amount is None or expense.amount <= max_amount))
+
+        with self.lock:
+            # The range of the sort column is scanned from the index, the other filters are checked
+            if sort == "date":
+                keys = self.expenses_by_date.scan(after, descending, (date_from,) if date_from is not None else None,
+                                                  (date_to, float("inf")) if date_to is not None else None)
+            elif sort == "amount":
+                keys = self.expenses_by_amount.scan(after, descending, (min_amount,) if min_amount is not None else None,
+                                                    (max_amount, float("inf")) if max_amount is not None else None)
+            else:
+                keys = self.expenses_by_id.scan(after, descending)
+            rows = [get_values(self.expenses[expense_id]) for expense_id in take(keys, limit, matches)]
+        return [Expense(**values) for values in rows]
+
+    def get_existing_expenses(self, expense_ids: set[int]) -> set[int]:
+        with self.lock:
+            return {expense_id for expense_id in expense_ids if expense_id in self.expenses}
+
+    def get_existing_expense_keys(self, keys: set[tuple[str, date]]) -> set[tuple[str, date]]:
+        with self.lock:
+            return {key for key in keys if key in self.expense_keys}
+
+    def add_expenses(self, expenses: list[Expense]) -> list[int]:
+        transaction = Transaction()
+        with self.lock:
+            keys = [(expense.description, expense.date) for expense in expenses]
+            if len(set(keys)) < len(keys) or any(key in self.expense_keys for key in keys):
+                raise AlreadyExists()
+            used_ids = [expense.id for expense in expenses if expense.id is not None]
+            if len(set(used_ids)) < len(used_ids) or any(expense_id in self.expenses for expense_id in used_ids):
+                # Like the primary key of the expense table
+                raise ValueError("Expense id already used")
+            expense_ids = []
+            for expense in expenses:
+                expense_id = expense.id if expense.id is not None else self.next_expense_id
+                self.next_expense_id = max(self.next_expense_id, expense_id + 1)
+                record = ExpenseRecord(expense_id, expense.description, expense.date, expense.amount,
+                                       expense.credit_balance, expense.num_friends)
+                self.add_expense_record(record)
+                expense_ids.append(record.id)
+                add_event(transaction, "expense_created", expenses=[record.id])
+            mark_changed(transaction, lists=["expenses"])
+            self.commit(transaction)
+        notify_changes(transaction)
+        return expense_ids
+
+    def update_expense(self, expense: Expense, description: str, date: date, amount: float):
+        transaction = Transaction()
+        with self.lock:
+            record = self.expenses[expense.id]
+            existing_id = self.expense_keys.get((description, date))
+            if existing_id is not None and existing_id != record.id:
+                raise AlreadyExists()
+            self.remove_expense_record(record)
+            delta = (amount - record.amount) / record.num_friends
+            shifted_ids = self.shift_debit_balances(record, delta) if delta != 0 else []
+            record.description = description
+            record.date = date
+            record.amount = amount
+            self.add_expense_record(record)
+            mark_changed(transaction, friends=shifted_ids, expenses=[record.id], lists=["expenses"])
+            add_event(transaction, "expense_updated", expenses=[record.id], affected_friends=shifted_ids)
+            self.commit(transaction)
+        notify_changes(transaction)
+
+    def delete_expense(self, expense: Expense):
+        transaction = Transaction()
+        with self.lock:
+            record = self.expenses[expense.id]
+            share = record.amount / record.num_friends
+            for friend_id in record.friend_ids:
+                friend = self.friends[friend_id]
+                link = self.links.pop((record.id, friend_id))
+                friend.debit_balance -= share
+                friend.credit_balance -= link.amount
+                remove_id(friend.expense_ids, record.id)
+            self.remove_expense_record(record)
+            mark_changed(transaction, friends=record.friend_ids, expenses=[record.id], lists=["expenses"])
+            add_event(transaction, "expense_deleted", expenses=[record.id], affected_friends=record.friend_ids)
+            self.commit(transaction)
+        notify_changes(transaction)
+
+    def add_expense_record(self, record: ExpenseRecord):
+        self.expenses[record.id] = record
+        self.expense_keys[(record.description, record.date)] = record.id
+        self.expenses_by_id.add((record.id,))
+        self.expenses_by_date.add((record.date, record.id))
+        self.expenses_by_amount.add((record.amount, record.id))
+
+    def remove_expense_record(self, record: ExpenseRecord):
+        del self.expenses[record.id]
+        del self.expense_keys[(record.description, record.date)]
+        self.expenses_by_id.remove((record.id,))
+        self.expenses_by_date.remove((record.date, record.id))
+        self.expenses_by_amount.remove((record.amount, record.id))
+
+    # Friends in expenses
+
+    def get_link(self, expense_id: int, friend_id: int) -> Optional[FriendExpenseLink]:
+        with self.lock:
+            link = self.links.get((expense_id, friend_id))
+            return FriendExpenseLink(expense_id=expense_id, friend_id=friend_id, amount=link.amount) if link is not None else None
+
+    def get_existing_links(self, keys: set[tuple[int, int]]) -> set[tuple[int, int]]:
+        with self.lock:
+            return {key for key in keys if key in self.links}
+
+    def get_expense_friends(self, expense_id: int, cursor: Optional[str], limit: int) -> Optional[list[ExpenseFriend]]:
+        after = get_after(cursor, "id")
+        with self.lock:
+            expense = self.expenses.get(expense_id)
+            if expense is None:
+                return None
+            start = bisect.bisect_right(expense.friend_ids, after[0]) if after is not None else 0
+            debit_per_friend = expense.amount / expense.num_friends
+            return [ExpenseFriend(id=friend_id, name=self.friends[friend_id].name,
+                                  credit_balance=self.links[(expense_id, friend_id)].amount, debit_balance=debit_per_friend)
+                    for friend_id in expense.friend_ids[start:start + limit + 1]]
+
+    def get_expense_friend(self, expense_id: int, friend_id: int) -> Optional[ExpenseFriend]:
+        with self.lock:
+            link = self.links.get((expense_id, friend_id))
+            if link is None:
+                return None
+            expense = self.expenses[expense_id]
+            return ExpenseFriend(id=friend_id, name=self.friends[friend_id].name, credit_balance=link.amount,
+                                 debit_balance=expense.amount / expense.num_friends)
+
+    def add_participants(self, links: dict[int, list[int]]):
+        transaction = Transaction()
+        with self.lock:
+            for expense_id, friend_ids in links.items():
+                if not friend_ids:
+                    continue
+                expense = self.expenses[expense_id]
+                old_share = expense.amount / expense.num_friends
+                new_share = expense.amount / (expense.num_friends + len(friend_ids))
+                shifted_ids = self.shift_debit_balances(expense, new_share - old_share) if new_share != old_share else []
+                for friend_id in friend_ids:
+                    friend = self.friends[friend_id]
+                    friend.debit_balance += new_share
+                    self.links[(expense_id, friend_id)] = LinkRecord(expense_id, friend_id)
+                    insert_id(friend.expense_ids, expense_id)
+                    insert_id(expense.friend_ids, friend_id)
+                expense.num_friends += len(friend_ids)
+                mark_changed(transaction, friends=shifted_ids + friend_ids, expenses=[expense_id])
+                add_event(transaction, "participant_added", friends=friend_ids, expenses=[expense_id], affected_friends=shifted_ids)
+            self.commit(transaction)
+        notify_changes(transaction)
+
+    def add_credit(self, expense_id: int, friend_id: int, amount: float) -> Optional[float]:
+        transaction = Transaction()
+        with self.lock:
+            link = self.links.get((expense_id, friend_id))
+            if link is None:
+                return None
+            self.apply_credits([(expense_id, friend_id, amount)], transaction)
+            self.commit(transaction)
+            new_amount = link.amount
+        notify_changes(transaction)
+        return new_amount
+
+    def add_credits(self, credits: list[tuple[int, int, float]], atomic: bool = False) -> list[Optional[float]]:
+        transaction = Transaction()
+        with self.lock:
+            links = [self.links.get((expense_id, friend_id)) for expense_id, friend_id, _ in credits]
+            if atomic and None in links:
+                return [None if link is None else link.amount + amount for link, (*_, amount) in zip(links, credits)]
+            self.apply_credits([credit for credit, link in zip(credits, links) if link is not None], transaction)
+            self.commit(transaction)
+            new_amounts = [None if link is None else link.amount for link in links]
+        notify_changes(transaction)
+        return new_amounts
+
+    def apply_credits(self, credits: list[tuple[int, int, float]], transaction: Transaction):
+        for expense_id, friend_id, amount in credits:
+            self.links[(expense_id, friend_id)].amount += amount
+            self.friends[friend_id].credit_balance += amount
+            self.expenses[expense_id].credit_balance += amount
+            add_event(transaction, "credit_updated", friends=[friend_id], expenses=[expense_id])
+        mark_changed(transaction,
+                     friends=[friend_id for _, friend_id, _ in credits],
+                     expenses=[expense_id for expense_id, _, _ in credits])
+
+    def remove_participant(self, link: FriendExpenseLink):
+        transaction = Transaction()
+        with self.lock:
+            self.remove_link(self.links[(link.expense_id, link.friend_id)], transaction)
+            self.commit(transaction)
+        notify_changes(transaction)
+
+    def remove_link(self, link: LinkRecord, transaction: Transaction):
+        # The expense is split among one less friend
+        expense = self.expenses[link.expense_id]
+        friend = self.friends[link.friend_id]
+        old_share = expense.amount / expense.num_friends
+        new_share = expense.amount / (expense.num_friends - 1)
+        del self.links[(link.expense_id, link.friend_id)]
+        remove_id(expense.friend_ids, friend.id)
+        remove_id(friend.expense_ids, expense.id)
+        shifted_ids = self.shift_debit_balances(expense, new_share - old_share) if new_share != old_share else []
+        friend.debit_balance -= old_share
+        friend.credit_balance -= link.amount
+        expense.credit_balance -= link.amount
+        expense.num_friends -= 1
+        mark_changed(transaction, friends=shifted_ids + [friend.id], expenses=[expense.id])
+        add_event(transaction, "participant_removed", friends=[friend.id], expenses=[expense.id], affected_friends=shifted_ids)
+
+    def shift_debit_balances(self, expense: ExpenseRecord, delta: float) -> list[int]:
+        # Add delta to the debit balance of every friend sharing the expense. Returns their ids.
+        for friend_id in expense.friend_ids:
+            self.friends[friend_id].debit_balance += delta
+        return list(expense.friend_ids)
+
+
+def add_history(history: dict[int, list[tuple]], id: int, time: datetime, balances: tuple):
+    balances_history = history.get(id)
+    if balances_history is None:
+        if any(balances):
+            history[id] = [(time, *balances)]
+        return
+    if balances_history[-1][1:] != balances:
+        balances_history.append((time, *balances))
+    if RETENTION is not None:
+        # Only the latest balances before the start of the retention are needed
+        start = bisect.bisect_right(balances_history, time - RETENTION, key=lambda item: item[0]) - 1
+        if start > 0:
+            del balances_history[:start]
+
+
+def get_history(history: dict[int, list[tuple]], id: int, as_of: datetime, default: tuple) -> tuple:
+    # Balances at a time: the latest ones added up to it
+    balances_history = history.get(id, ())
+    index = bisect.bisect_right(balances_history, as_of, key=lambda item: item[0])
+    return balances_history[index - 1][1:] if index > 0 else default
+
+
+def get_values(record) -> dict:
+    # Fields of a friend or expense record (the indexes of its links excluded)
+    return {name: getattr(record, name) for name in record.__slots__[:-1]}
+
+
+def to_balances(record) -> dict:
+    # Balances sent with the events (see routers.events)
+    if isinstance(record, FriendRecord):
+        return {"id": record.id, "name": record.name, "credit_balance": record.credit_balance, "debit_balance": record.debit_balance}
+    return {"id": record.id, "description": record.description, "amount": record.amount,
+            "credit_balance": record.credit_balance, "num_friends": record.num_friends}
@@ -1,13 +1,25 @@
 
-from typing import Optional
-from sqlmodel import Field, Relationship, SQLModel
+from typing import Generic, Optional, TypeVar
+from sqlmodel import Field, Index, Relationship, SQLModel
 from pydantic import BaseModel
+import datetime
+
+T = TypeVar("T")
 
 class Message(BaseModel):
     detail: str
 
 
+class Page(BaseModel, Generic[T]):
+    items: list[T]
+    next_cursor: Optional[str] = None
+
+
 class FriendExpenseLink(SQLModel, table=True):
+    # Covering indexes for the lookups (and balance sums) by friend and by expense
+    __table_args__ = (Index("ix_friendexpenselink_friend_id_expense_id_amount", "friend_id", "expense_id", "amount"),
+                      Index("ix_friendexpenselink_expense_id_friend_id_amount", "expense_id", "friend_id", "amount"))
+
     friend_id: Optional[int] = Field(default=None, foreign_key="friend.id", primary_key=True)    
     expense_id: Optional[int] = Field(default=None, foreign_key="expense.id", primary_key=True)
     amount: float = Field(default = 0)
@@ -17,26 +29,125 @@ class FriendExpenseLink(SQLModel, table=True):
 
 
 class Friend(SQLModel, table=True):
+    # Ids are never reused after a delete: the balance history of a deleted friend must not
+    # become the history of a new one
+    __table_args__ = {"sqlite_autoincrement": True}
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    name: str  
+    name: str = Field(index=True)
     expense_links: list["FriendExpenseLink"] = Relationship(back_populates="friend", cascade_delete=True)
     credit_balance: float = Field(default = 0)
     debit_balance: float = Field(default = 0)
 
 
 class Expense(SQLModel, table=True):
+    # Ids are never reused, like the friends'
+    __table_args__ = (Index("uq_expense_description_date", "description", "date", unique=True),
+                      {"sqlite_autoincrement": True})
+
     id: Optional[int] = Field(default=None, primary_key=True)
     description: str
-    date: str
-    amount: float
+    date: datetime.date = Field(index=True)
+    amount: float = Field(index=True)
     credit_balance: Optional[float] = Field(default = 0)
     num_friends: Optional[int] = Field(default = 1)
     friend_links: list["FriendExpenseLink"] = Relationship(back_populates="expense", cascade_delete=True)
 
+
+class BalanceEntry(SQLModel, table=True):
+    # Append-only ledger of the balance changes, in commit order (see persistence.history). The
+    # credit changes the balances of the friend and of the expense, the debit only the friend's.
+    # No foreign keys: the history outlives the friends and expenses. Ids are never reused after
+    # the old entries are dropped.
+    __table_args__ = (Index("ix_balanceentry_friend_id_id", "friend_id", "id"),
+                      Index("ix_balanceentry_expense_id_id", "expense_id", "id"),
+                      {"sqlite_autoincrement": True})
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    timestamp: datetime.datetime
+    friend_id: Optional[int] = None
+    expense_id: Optional[int] = None
+    credit: float = Field(default = 0)
+    debit: float = Field(default = 0)
+
+
+class BalanceSnapshot(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    taken_at: datetime.datetime = Field(index=True)
+    # The snapshot includes the ledger entries up to this one
+    last_entry_id: int
+
+
+class SnapshotBalance(SQLModel, table=True):
+    # Balance of a friend or an expense in a snapshot. A snapshot only stores the balances that
+    # changed since the previous one: the balance at a snapshot is the latest stored up to it.
+    __table_args__ = (Index("ix_snapshotbalance_friend_id_snapshot_id", "friend_id", "snapshot_id"),
+                      Index("ix_snapshotbalance_expense_id_snapshot_id", "expense_id", "snapshot_id"))
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    snapshot_id: int
+    friend_id: Optional[int] = None
+    expense_id: Optional[int] = None
+    credit_balance: float = Field(default = 0)
+    debit_balance: float = Field(default = 0)
+
+
 class FriendExpense(BaseModel):
     id: int
     description: str
     amount: float
     num_friends: int
     credit_balance: float
-    debit_balance: float
\ No newline at end of file
+    debit_balance: float
+
+
+class ExpenseFriend(BaseModel):
+    id: int
+    name: str
+    credit_balance: float
+    debit_balance: float
+
+
+class PeriodReport(BaseModel):
+    period: datetime.date
+    num_expenses: int
+    spend: float
+    credit: float
+    debit: float
+
+
+class FriendPeriodReport(PeriodReport):
+    friend_id: int
+
+
+class Transfer(BaseModel):
+    # Friend ids (None is the owner of the expenses)
+    from_friend_id: Optional[int]
+    to_friend_id: Optional[int]
+    amount: float
+
+
+class Settlement(BaseModel):
+    # Expenses included in the plan (None: all the expenses in the date range)
+    expense_ids: Optional[list[int]] = None
+    # Friends (and owner) with a balance to settle
+    num_participants: int
+    total: float
+    transfers: list[Transfer]
+
+
+class FriendExpenseItem(BaseModel):
+    expense_id: int
+    friend_id: int
+
+
+class CreditItem(BaseModel):
+    expense_id: int
+    friend_id: int
+    amount: float
+
+
+class BatchItemResult(BaseModel):
+    status_code: int
+    detail: Optional[str] = None
+    id: Optional[int] = None
@@ -0,0 +1,150 @@
+from abc import ABC, abstractmethod
+from typing import Literal, Optional
+from datetime import date, datetime
+from persistence.models import Friend, Expense, FriendExpenseLink, FriendExpense, ExpenseFriend
+
+
+class AlreadyExists(Exception):
+    # An expense with the same description and date is already stored
+    pass
+
+
+class HistoryUnavailable(Exception):
+    # The balances are not kept that far back: the history starts at start (None if there is none)
+    def __init__(self, start: Optional[datetime]):
+        self.start = start
+
+
+class Repository(ABC):
+    # Storage of friends, expenses and their links, used by the friends, expenses and
+    # friend_expenses routers. Implemented on SQLite (persistence.sql_repository) and in memory
+    # (persistence.memory_repository), selected with SPLITWITHME_STORAGE (persistence.storage).
+    #
+    # Every write method applies its change, keeps the stored balances up to date and commits.
+    # The objects returned by the read methods are passed back to the write methods that change
+    # them. Lists are paginated like paginate(): ordered by (sort, id) after the cursor, with one
+    # extra item to know whether there is a next page.
+
+    # Friends
+
+    @abstractmethod
+    def get_friend(self, friend_id: int) -> Optional[Friend]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_friends(self, name_prefix: Optional[str], sort: Literal["id", "name"], descending: bool,
+                    cursor: Optional[str], limit: int) -> list[Friend]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_friend_as_of(self, friend_id: int, as_of: datetime) -> Optional[Friend]:
+        # The friend with their balances at a time (in UTC), and their current name. Raises
+        # HistoryUnavailable if the history does not go back that far
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_friend_expenses(self, friend_id: int, cursor: Optional[str], limit: int) -> Optional[list[FriendExpense]]:
+        # None if the friend does not exist
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_existing_friends(self, friend_ids: set[int]) -> set[int]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_friend(self, friend: Friend) -> Optional[Friend]:
+        # None if a friend with the same id already exists
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_friend(self, friend: Friend, name: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_friend(self, friend: Friend):
+        # The friend is removed from all their expenses
+        raise NotImplementedError
+
+    # Expenses
+
+    @abstractmethod
+    def get_expense(self, expense_id: int) -> Optional[Expense]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_expense_as_of(self, expense_id: int, as_of: datetime) -> Optional[Expense]:
+        # The expense with its credit balance at a time, like get_friend_as_of. The description,
+        # date, amount and num_friends are the current ones.
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_expenses(self, date_from: Optional[date], date_to: Optional[date],
+                     min_amount: Optional[float], max_amount: Optional[float],
+                     sort: Literal["id", "date", "amount"], descending: bool,
+                     cursor: Optional[str], limit: int) -> list[Expense]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_existing_expenses(self, expense_ids: set[int]) -> set[int]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_existing_expense_keys(self, keys: set[tuple[str, date]]) -> set[tuple[str, date]]:
+        # (description, date) pairs that are already used
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_expenses(self, expenses: list[Expense]) -> list[int]:
+        # Returns their ids. Raises AlreadyExists (and adds none of them) if a (description, date)
+        # is already used
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_expense(self, expense: Expense, description: str, date: date, amount: float):
+        # Raises AlreadyExists (and changes nothing) if the new (description, date) is already used
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_expense(self, expense: Expense):
+        raise NotImplementedError
+
+    # Friends in expenses
+
+    @abstractmethod
+    def get_link(self, expense_id: int, friend_id: int) -> Optional[FriendExpenseLink]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_existing_links(self, keys: set[tuple[int, int]]) -> set[tuple[int, int]]:
+        # (expense_id, friend_id) pairs that are already assigned
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_expense_friends(self, expense_id: int, cursor: Optional[str], limit: int) -> Optional[list[ExpenseFriend]]:
+        # None if the expense does not exist
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_expense_friend(self, expense_id: int, friend_id: int) -> Optional[ExpenseFriend]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_participants(self, links: dict[int, list[int]]):
+        # Assign lists of friends to expenses ({expense_id: [friend_id, ...]}), all of them existing
+        # and not assigned yet
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_credit(self, expense_id: int, friend_id: int, amount: float) -> Optional[float]:
+        # Returns the new credit of the friend in the expense (None if the friend is not assigned to it)
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_credits(self, credits: list[tuple[int, int, float]], atomic: bool = False) -> list[Optional[float]]:
+        # (expense_id, friend_id, amount) credits. Returns the new credit of each one (None if the
+        # friend is not assigned to the expense); if atomic, none is applied when one is None.
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_participant(self, link: FriendExpenseLink):
+        raise NotImplementedError
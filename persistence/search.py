@@ -0,0 +1,57 @@
+from sqlalchemy import Column, Float, Integer, MetaData, String, Table
+import re
+
+
+# FTS5 indexes over the expense descriptions and friend names. They are external content tables:
+# they only store the index, the text is read from the expense and friend tables. Triggers keep
+# them in sync with every write, bulk inserts included.
+# Diacritics are ignored (Sevilla matches "sevilla", Matías matches "matias") and the 2 and 3
+# character prefixes are indexed, so prefix queries are index lookups too.
+TOKENIZE = "unicode61 remove_diacritics 2"
+PREFIX = "2 3"
+
+SEARCH_INDEXES = {
+    # index name: (table, column)
+    "expense_fts": ("expense", "description"),
+    "friend_fts": ("friend", "name"),
+}
+
+metadata = MetaData()
+expense_fts = Table("expense_fts", metadata, Column("rowid", Integer), Column("description", String), Column("rank", Float))
+friend_fts = Table("friend_fts", metadata, Column("rowid", Integer), Column("name", String), Column("rank", Float))
+
+
+def get_search_ddl(index_name: str, table: str, column: str) -> list[str]:
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {index_name} USING fts5({column}, content='{table}', content_rowid='id', "
+        f"tokenize='{TOKENIZE}', prefix='{PREFIX}')",
+        f"CREATE TRIGGER IF NOT EXISTS {index_name}_insert AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {index_name}(rowid, {column}) VALUES (new.id, new.{column}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {index_name}_delete AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {index_name}({index_name}, rowid, {column}) VALUES ('delete', old.id, old.{column}); END",
+        # Only reindex when the text changes (balance updates do not touch the index)
+        f"CREATE TRIGGER IF NOT EXISTS {index_name}_update AFTER UPDATE OF {column} ON {table} BEGIN "
+        f"INSERT INTO {index_name}({index_name}, rowid, {column}) VALUES ('delete', old.id, old.{column}); "
+        f"INSERT INTO {index_name}(rowid, {column}) VALUES (new.id, new.{column}); END",
+    ]
+
+
+def create_search_indexes(engine):
+    # Create the indexes and their triggers, and index the existing rows of databases created
+    # by previous versions
+    with engine.begin() as connection:
+        existing = set(connection.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'table'").scalars())
+        for index_name, (table, column) in SEARCH_INDEXES.items():
+            for statement in get_search_ddl(index_name, table, column):
+                connection.exec_driver_sql(statement)
+            if index_name not in existing:
+                connection.exec_driver_sql(f"INSERT INTO {index_name}({index_name}) VALUES ('rebuild')")
+
+
+def to_match_query(text: str) -> str:
+    # The last word (the one being typed) and the words ending with * are prefixes: "travel sev"
+    # and "trav* sev" find "Travel to Sevilla". Complete words are matched as such, which is much
+    # faster for common words. Words are quoted, so FTS5 operators and punctuation are ignored.
+    words = re.findall(r"(\w+)(\*?)", text)
+    return " ".join(f'"{word}"*' if star or index == len(words) - 1 else f'"{word}"'
+                    for index, (word, star) in enumerate(words))
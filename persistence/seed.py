@@ -0,0 +1,98 @@
+from persistence.database import engine
+from persistence.models import Friend, FriendExpenseLink, Expense, BalanceEntry
+from persistence.history import utc_now
+from sqlmodel import insert, select
+from faker import Faker
+import datetime
+import random
+
+
+# Rows inserted per executemany call
+CHUNK_SIZE = 10000
+
+
+def insert_rows(connection, model, rows: list[dict]):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        connection.execute(insert(model), rows[start:start + CHUNK_SIZE])
+
+
+def get_used_keys(connection, descriptions: set[str]) -> set[tuple[str, datetime.date]]:
+    # (description, date) of the stored expenses with any of the descriptions
+    descriptions = list(descriptions)
+    used_keys = set()
+    for start in range(0, len(descriptions), CHUNK_SIZE):
+        used_keys.update(tuple(row) for row in connection.execute(
+            select(Expense.description, Expense.date).where(Expense.description.in_(descriptions[start:start + CHUNK_SIZE]))))
+    return used_keys
+
+
+def init_db(num_friends: int = 10, num_expenses: int = 5, seed=None):
+    # Fill the database with fake friends sharing fake expenses, in a single transaction.
+    # The stored balances are computed here, so there is no need to reconcile them afterwards.
+    fake = Faker("es_ES")
+    fake.seed_instance(seed)
+    rng = random.Random(seed)
+    start_date = datetime.date(2024, 10, 1)
+    end_date = max(start_date, datetime.date.today())
+
+    expenses = [{"id": expense_id, "description": f"Travel to {fake.city()}", "date": fake.date_between(start_date, end_date),
+                 "amount": float(rng.randint(50, 1000)), "credit_balance": 0, "num_friends": 1}
+                for expense_id in range(1, num_expenses + 1)]
+
+    links = []
+    for friend_id in range(1, num_friends + 1):
+        for expense in rng.sample(expenses, rng.randint(0, min(4, num_expenses))):
+            links.append({"friend_id": friend_id, "expense_id": expense["id"], "amount": 0})
+            expense["num_friends"] += 1
+
+    debit_balances = [0.0] * (num_friends + 1)
+    for link in links:
+        expense = expenses[link["expense_id"] - 1]
+        debit_balances[link["friend_id"]] += expense["amount"] / expense["num_friends"]
+    friends = [{"id": friend_id, "name": fake.first_name(), "credit_balance": 0, "debit_balance": debit_balances[friend_id]}
+               for friend_id in range(1, num_friends + 1)]
+
+    with engine.begin() as connection:
+        # Append after the existing rows (the database is usually empty), and after the deleted
+        # ones: ids are never reused
+        offsets = [connection.exec_driver_sql(f"SELECT max(coalesce(max(id), 0), coalesce((SELECT seq FROM sqlite_sequence "
+                                              f"WHERE name = '{table}'), 0)) FROM {table}").scalar()
+                   for table in ("expense", "friend")]
+        # (description, date) is unique: the expenses already stored (e.g. by a previous run with
+        # the same seed) are checked too, and the repeated ones get their id appended
+        used_keys = get_used_keys(connection, {expense["description"] for expense in expenses})
+        for expense in expenses:
+            expense["id"] += offsets[0]
+            if (expense["description"], expense["date"]) in used_keys:
+                expense["description"] = f"{expense['description']} ({expense['id']})"
+            used_keys.add((expense["description"], expense["date"]))
+        for friend in friends:
+            friend["id"] += offsets[1]
+        for link in links:
+            link["expense_id"] += offsets[0]
+            link["friend_id"] += offsets[1]
+        insert_rows(connection, Expense, expenses)
+        insert_rows(connection, Friend, friends)
+        insert_rows(connection, FriendExpenseLink, links)
+        # The shares of the friends are the first changes in the balance history
+        shares = {expense["id"]: expense["amount"] / expense["num_friends"] for expense in expenses}
+        timestamp = utc_now()
+        insert_rows(connection, BalanceEntry,
+                    [{"timestamp": timestamp, "friend_id": link["friend_id"], "expense_id": link["expense_id"],
+                      "credit": 0, "debit": shares[link["expense_id"]]} for link in links])
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    from persistence.utils import create_db_and_tables
+
+    parser = argparse.ArgumentParser(description="Fill the database with fake friends and expenses")
+    parser.add_argument("--friends", type=int, default=10, help="number of friends")
+    parser.add_argument("--expenses", type=int, default=5, help="number of expenses")
+    parser.add_argument("--seed", type=int, help="random seed, for reproducible data")
+    args = parser.parse_args()
+    create_db_and_tables()
+    start = time.perf_counter()
+    init_db(args.friends, args.expenses, args.seed)
+    print(f"Seeded {args.friends} friends and {args.expenses} expenses in {time.perf_counter() - start:.2f} s")
@@ -0,0 +1,74 @@
+from typing import Iterable, Optional
+from datetime import date
+from sqlmodel import Session, select, func
+from persistence.models import Friend, Expense, FriendExpenseLink
+import heapq
+
+
+# Positions (and remainders) smaller than this are considered settled
+TOLERANCE = 1e-6
+# Participant id of the owner of the expenses, who paid them in full
+OWNER_ID = 0
+
+
+def get_net_positions(session: Session, expense_ids: Optional[Iterable[int]] = None,
+                      date_from: Optional[date] = None, date_to: Optional[date] = None) -> dict[int, float]:
+    # Net position (credit minus debit) of every friend in the selected expenses. A negative
+    # position is owed to the others, a positive one is owed by them.
+    if expense_ids is None and date_from is None and date_to is None:
+        # The stored balances already add up every link
+        statement = (select(Friend.id, Friend.credit_balance - Friend.debit_balance)
+                     .where(Friend.credit_balance != Friend.debit_balance))
+    else:
+        # One aggregate scan of the selected expenses and their links. The expenses drive the join
+        # (id + 0 keeps SQLite from looking them up by id for every link): they are read in date
+        # or id order, and their links come from the covering index by expense.
+        statement = (select(FriendExpenseLink.friend_id,
+                            func.sum(FriendExpenseLink.amount - Expense.amount / Expense.num_friends))
+                     .join(Expense, Expense.id + 0 == FriendExpenseLink.expense_id)
+                     .group_by(FriendExpenseLink.friend_id))
+        if expense_ids is not None:
+            statement = statement.where(Expense.id.in_(list(expense_ids)))
+        if date_from is not None:
+            statement = statement.where(Expense.date >= date_from)
+        if date_to is not None:
+            statement = statement.where(Expense.date <= date_to)
+    positions = dict(session.exec(statement).all())
+    # The owner gets what the friends still owe (and returns what they overpaid)
+    positions[OWNER_ID] = -sum(positions.values())
+    return positions
+
+
+def plan_transfers(positions: dict[int, float]) -> list[tuple[int, int, float]]:
+    # Greedy netting in O(n log n): the largest debtor pays the largest creditor until one of them
+    # is settled, and the other stays in its heap with the remainder. Every transfer settles at
+    # least one participant, so there are at most n - 1 transfers.
+    # Returns (from_id, to_id, amount) transfers.
+    heappop, heapreplace = heapq.heappop, heapq.heapreplace
+    # Both heaps hold negative amounts, so the largest debt and credit are on top
+    debtors = [(position, participant_id) for participant_id, position in positions.items() if position < -TOLERANCE]
+    creditors = [(-position, participant_id) for participant_id, position in positions.items() if position > TOLERANCE]
+    heapq.heapify(debtors)
+    heapq.heapify(creditors)
+    transfers = []
+    while debtors and creditors:
+        debt, debtor_id = debtors[0]
+        credit, creditor_id = creditors[0]
+        if debt > credit:
+            # The debtor is settled, the creditor keeps the remainder (a single sift)
+            transfers.append((debtor_id, creditor_id, -debt))
+            heappop(debtors)
+            remainder = credit - debt
+            if remainder < -TOLERANCE:
+                heapreplace(creditors, (remainder, creditor_id))
+            else:
+                heappop(creditors)
+        else:
+            transfers.append((debtor_id, creditor_id, -credit))
+            heappop(creditors)
+            remainder = debt - credit
+            if remainder < -TOLERANCE:
+                heapreplace(debtors, (remainder, debtor_id))
+            else:
+                heappop(debtors)
+    return transfers
@@ -0,0 +1,228 @@
+from typing import Literal, Optional
+from datetime import date, datetime
+from persistence.database import wait
+from persistence.group_commit import credit_committer
+from persistence.models import Friend, Expense, FriendExpenseLink, FriendExpense, ExpenseFriend
+from persistence.balances import add_participants, remove_participant, update_amount, remove_expense, add_credit, add_credits
+from persistence.changes import mark_changed, add_event
+from persistence.history import get_balance_as_of
+from persistence.repository import AlreadyExists, Repository
+from routers.pagination import paginate, prefix_range
+from sqlmodel import Session, select
+from sqlalchemy import tuple_
+from sqlalchemy.exc import IntegrityError
+
+
+def is_duplicated_expense(error: IntegrityError) -> bool:
+    # Violation of uq_expense_description_date (SQLite reports its columns, not its name). Other
+    # violations, like a used id, are not duplicated expenses.
+    return "UNIQUE constraint failed: expense.description, expense.date" in str(error.orig)
+
+
+class SqlRepository(Repository):
+    # Repository on a SQLModel session (one per request)
+
+    def __init__(self, session: Session):
+        self.session = session
+
+    # Friends
+
+    def get_friend(self, friend_id: int) -> Optional[Friend]:
+        return self.session.exec(select(Friend).where(Friend.id == friend_id)).first()
+
+    def get_friends(self, name_prefix: Optional[str], sort: Literal["id", "name"], descending: bool,
+                    cursor: Optional[str], limit: int) -> list[Friend]:
+        statement = select(Friend)
+        if name_prefix:
+            statement = statement.where(prefix_range(Friend.name, name_prefix))
+        sort_column = getattr(Friend, sort)
+        return list(self.session.exec(paginate(statement, Friend.id, cursor, limit, sort_column, descending)).all())
+
+    def get_friend_as_of(self, friend_id: int, as_of: datetime) -> Optional[Friend]:
+        friend = self.get_friend(friend_id)
+        if friend is None:
+            return None
+        credit_balance, debit_balance = get_balance_as_of(self.session, as_of, friend_id=friend_id)
+        # A copy, the stored friend is not changed
+        return Friend(id=friend.id, name=friend.name, credit_balance=credit_balance, debit_balance=debit_balance)
+
+    def get_friend_expenses(self, friend_id: int, cursor: Optional[str], limit: int) -> Optional[list[FriendExpense]]:
+        if self.session.exec(select(Friend.id).where(Friend.id == friend_id)).first() is None:
+            return None
+        statement = (select(Expense.id, Expense.description, Expense.amount, Expense.num_friends,
+                            FriendExpenseLink.amount, Expense.amount / Expense.num_friends)
+                     .join(Expense, Expense.id == FriendExpenseLink.expense_id)
+                     .where(FriendExpenseLink.friend_id == friend_id))
+        return [FriendExpense(id=expense_id, description=description, amount=amount, num_friends=num_friends,
+                              credit_balance=credit_balance, debit_balance=debit_balance)
+                for expense_id, description, amount, num_friends, credit_balance, debit_balance
+                in self.session.exec(paginate(statement, FriendExpenseLink.expense_id, cursor, limit))]
+
+    def get_existing_friends(self, friend_ids: set[int]) -> set[int]:
+        return set(self.session.exec(select(Friend.id).where(Friend.id.in_(friend_ids))).all())
+
+    def add_friend(self, friend: Friend) -> Optional[Friend]:
+        if friend.id is not None and self.get_friend(friend.id) is not None:
+            return None
+        self.session.add(friend)
+        self.session.flush()
+        mark_changed(self.session, lists=["friends"])
+        add_event(self.session, "friend_created", friends=[friend.id])
+        self.session.commit()
+        self.session.refresh(friend)
+        return friend
+
+    def update_friend(self, friend: Friend, name: str):
+        friend.name = name
+        mark_changed(self.session, friends=[friend.id], lists=["friends"])
+        add_event(self.session, "friend_updated", friends=[friend.id])
+        self.session.commit()
+
+    def delete_friend(self, friend: Friend):
+        # The links are read again after removing them: once the first one is removed the
+        # transaction holds the write lock, so the ones added meanwhile are removed too
+        links = select(FriendExpenseLink.expense_id).where(FriendExpenseLink.friend_id == friend.id)
+        expense_ids = self.session.exec(links).all()
+        while expense_ids:
+            for expense_id in expense_ids:
+                remove_participant(expense_id, friend.id, self.session)
+            expense_ids = self.session.exec(links).all()
+        self.session.delete(friend)
+        mark_changed(self.session, friends=[friend.id], lists=["friends"])
+        add_event(self.session, "friend_deleted", friends=[friend.id])
+        self.session.commit()
+
+    # Expenses
+
+    def get_expense(self, expense_id: int) -> Optional[Expense]:
+        return self.session.exec(select(Expense).where(Expense.id == expense_id)).first()
+
+    def get_expense_as_of(self, expense_id: int, as_of: datetime) -> Optional[Expense]:
+        expense = self.get_expense(expense_id)
+        if expense is None:
+            return None
+        credit_balance, _ = get_balance_as_of(self.session, as_of, expense_id=expense_id)
+        return Expense(**{**expense.model_dump(), "credit_balance": credit_balance})
+
+    def get_expenses(self, date_from: Optional[date], date_to: Optional[date],
+                     min_amount: Optional[float], max_amount: Optional[float],
+                     sort: Literal["id", "date", "amount"], descending: bool,
+                     cursor: Optional[str], limit: int) -> list[Expense]:
+        statement = select(Expense)
+        if date_from is not None:
+            statement = statement.where(Expense.date >= date_from)
+        if date_to is not None:
+            statement = statement.where(Expense.date <= date_to)
+        if min_amount is not None:
+            statement = statement.where(Expense.amount >= min_amount)
+        if max_amount is not None:
+            statement = statement.where(Expense.amount <= max_amount)
+        sort_column = getattr(Expense, sort)
+        return list(self.session.exec(paginate(statement, Expense.id, cursor, limit, sort_column, descending)).all())
+
+    def get_existing_expenses(self, expense_ids: set[int]) -> set[int]:
+        return set(self.session.exec(select(Expense.id).where(Expense.id.in_(expense_ids))).all())
+
+    def get_existing_expense_keys(self, keys: set[tuple[str, date]]) -> set[tuple[str, date]]:
+        return set(self.session.exec(select(Expense.description, Expense.date)
+                                     .where(tuple_(Expense.description, Expense.date).in_(keys))).all())
+
+    def add_expenses(self, expenses: list[Expense]) -> list[int]:
+        self.session.add_all(expenses)
+        mark_changed(self.session, lists=["expenses"])
+        try:
+            # A single batched INSERT for all the new expenses. The unique index on (description, date)
+            # rejects duplicated expenses.
+            self.session.flush()
+            expense_ids = [expense.id for expense in expenses]
+            for expense_id in expense_ids:
+                add_event(self.session, "expense_created", expenses=[expense_id])
+            self.session.commit()
+        except IntegrityError as error:
+            self.session.rollback()
+            if is_duplicated_expense(error):
+                raise AlreadyExists()
+            raise
+        return expense_ids
+
+    def update_expense(self, expense: Expense, description: str, date: date, amount: float):
+        expense.description = description
+        expense.date = date
+        try:
+            # The unique index on (description, date) is checked when the balance updates autoflush
+            update_amount(expense, amount, self.session)
+            self.session.commit()
+        except IntegrityError as error:
+            self.session.rollback()
+            if is_duplicated_expense(error):
+                raise AlreadyExists()
+            raise
+
+    def delete_expense(self, expense: Expense):
+        remove_expense(expense, self.session)
+        self.session.delete(expense)
+        self.session.commit()
+
+    # Friends in expenses
+
+    def get_link(self, expense_id: int, friend_id: int) -> Optional[FriendExpenseLink]:
+        return self.session.exec(select(FriendExpenseLink)
+                                 .where(FriendExpenseLink.expense_id == expense_id)
+                                 .where(FriendExpenseLink.friend_id == friend_id)).first()
+
+    def get_existing_links(self, keys: set[tuple[int, int]]) -> set[tuple[int, int]]:
+        if not keys:
+            return set()
+        statement = (select(FriendExpenseLink.expense_id, FriendExpenseLink.friend_id)
+                     .where(tuple_(FriendExpenseLink.expense_id, FriendExpenseLink.friend_id).in_(keys)))
+        return set(self.session.exec(statement).all())
+
+    def get_expense_friends(self, expense_id: int, cursor: Optional[str], limit: int) -> Optional[list[ExpenseFriend]]:
+        debit_per_friend = self.session.exec(select(Expense.amount / Expense.num_friends).where(Expense.id == expense_id)).first()
+        if debit_per_friend is None:
+            return None
+        statement = (select(Friend.id, Friend.name, FriendExpenseLink.amount)
+                     .join(Friend, Friend.id == FriendExpenseLink.friend_id)
+                     .where(FriendExpenseLink.expense_id == expense_id))
+        return [ExpenseFriend(id=friend_id, name=name, credit_balance=credit_balance, debit_balance=debit_per_friend)
+                for friend_id, name, credit_balance
+                in self.session.exec(paginate(statement, FriendExpenseLink.friend_id, cursor, limit))]
+
+    def get_expense_friend(self, expense_id: int, friend_id: int) -> Optional[ExpenseFriend]:
+        statement = (select(Friend.id, Friend.name, FriendExpenseLink.amount, Expense.amount / Expense.num_friends)
+                     .join(Friend, Friend.id == FriendExpenseLink.friend_id)
+                     .join(Expense, Expense.id == FriendExpenseLink.expense_id)
+                     .where(FriendExpenseLink.expense_id == expense_id)
+                     .where(FriendExpenseLink.friend_id == friend_id))
+        row = self.session.exec(statement).first()
+        if row is None:
+            return None
+        friend_id, name, credit_balance, debit_balance = row
+        return ExpenseFriend(id=friend_id, name=name, credit_balance=credit_balance, debit_balance=debit_balance)
+
+    def add_participants(self, links: dict[int, list[int]]):
+        for expense_id, friend_ids in links.items():
+            if friend_ids:
+                add_participants(expense_id, friend_ids, self.session)
+        self.session.add_all([FriendExpenseLink(expense_id=expense_id, friend_id=friend_id)
+                              for expense_id, friend_ids in links.items() for friend_id in friend_ids])
+        self.session.commit()
+
+    def add_credit(self, expense_id: int, friend_id: int, amount: float) -> Optional[float]:
+        if credit_committer is not None:
+            return wait(credit_committer.submit(expense_id, friend_id, amount))
+        new_amount = add_credit(expense_id, friend_id, amount, self.session)
+        self.session.commit()
+        return new_amount
+
+    def add_credits(self, credits: list[tuple[int, int, float]], atomic: bool = False) -> list[Optional[float]]:
+        new_amounts = add_credits(credits, self.session)
+        if atomic and None in new_amounts:
+            self.session.rollback()
+        else:
+            self.session.commit()
+        return new_amounts
+
+    def remove_participant(self, link: FriendExpenseLink):
+        remove_participant(link.expense_id, link.friend_id, self.session)
+        self.session.commit()
@@ -0,0 +1,38 @@
+from fastapi import Depends
+from persistence.database import ASYNC_DEPENDENCIES, get_session, get_read_session, get_async_session, get_async_read_session
+from persistence.repository import Repository
+from sqlmodel import Session
+import os
+
+
+# Storage of friends, expenses and their links (SPLITWITHME_STORAGE):
+# - sqlite (default): the SQLite database
+# - memory: process memory, loaded from the database at startup and never written back. Only
+#   the friends, expenses and friend_expenses routers are served.
+STORAGE = os.environ.get("SPLITWITHME_STORAGE", "sqlite")
+if STORAGE not in ("sqlite", "memory"):
+    raise ValueError(f"Unknown SPLITWITHME_STORAGE '{STORAGE}' (required: sqlite or memory)")
+
+memory_repository = None
+
+if STORAGE == "memory":
+    from persistence.memory_repository import MemoryRepository
+
+    memory_repository = MemoryRepository()
+
+    def get_repository() -> Repository:
+        return memory_repository
+
+    def get_read_repository() -> Repository:
+        return memory_repository
+else:
+    from persistence.sql_repository import SqlRepository
+
+    def get_repository(session: Session = Depends(get_session)) -> Repository:
+        return SqlRepository(session)
+
+    def get_read_repository(session: Session = Depends(get_read_session)) -> Repository:
+        return SqlRepository(session)
+
+    ASYNC_DEPENDENCIES[get_repository] = (get_async_session, SqlRepository)
+    ASYNC_DEPENDENCIES[get_read_repository] = (get_async_read_session, SqlRepository)
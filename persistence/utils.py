@@ -1,56 +1,128 @@
-from persistence.database import engine
-from persistence.models import Friend, FriendExpenseLink, Expense
-from sqlmodel import SQLModel, text, Session, select
-from faker import Faker
+from persistence.database import engine, DB_SETTINGS
+from persistence.models import Friend, Expense
+from persistence.search import create_search_indexes
+from persistence.balances import reconcile
+from sqlmodel import SQLModel, Session, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateTable
 import datetime
-import random
 
 
+# Indexes created by previous versions and replaced by the ones declared in the models
+OBSOLETE_INDEXES = ["ix_friendexpenselink_expense_id_friend_id"]
+
+# Tables whose ids are never reused (AUTOINCREMENT)
+AUTOINCREMENT_TABLES = [Friend.__table__, Expense.__table__]
+
+ISO_DATE_PATTERN = "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]"
+
+
+def migrate_dates():
+    # Dates are stored as ISO 8601 text (YYYY-MM-DD), so they compare, sort and group as dates.
+    # Previous versions stored them as sent (e.g. 2024-1-5): rewrite them in the ISO format.
+    with engine.begin() as connection:
+        rows = connection.exec_driver_sql(f"SELECT id, date FROM expense WHERE date NOT GLOB '{ISO_DATE_PATTERN}'").all()
+        updates = []
+        for expense_id, value in rows:
+            try:
+                updates.append((datetime.datetime.strptime(value, "%Y-%m-%d").date().isoformat(), expense_id))
+            except (TypeError, ValueError):
+                raise RuntimeError(f"Cannot migrate the date '{value}' of expense {expense_id} (required format: YYYY-MM-DD)")
+        if updates:
+            try:
+                connection.exec_driver_sql("UPDATE expense SET date = ? WHERE id = ?", updates)
+            except IntegrityError:
+                raise RuntimeError("Cannot migrate the expense dates: some expenses have the same description and date")
+
+
+def migrate_autoincrement():
+    # Previous versions created the friend and expense tables without AUTOINCREMENT, so SQLite
+    # reused the id of the last row after it was deleted. Rebuild them, keeping every row and id:
+    # the indexes are created again by migrate_indexes and the search triggers by
+    # create_search_indexes (the search indexes still match, the ids do not change).
+    with engine.connect() as connection:
+        ddl = dict(connection.exec_driver_sql("SELECT name, sql FROM sqlite_master WHERE type = 'table'").all())
+    tables = [table for table in AUTOINCREMENT_TABLES if "AUTOINCREMENT" not in ddl[table.name].upper()]
+    if not tables:
+        return
+    script = ["BEGIN IMMEDIATE"]
+    for table in tables:
+        columns = ", ".join(column.name for column in table.columns)
+        create = str(CreateTable(table).compile(engine)).strip()
+        script += [create.replace(f"CREATE TABLE {table.name} ", f"CREATE TABLE {table.name}_new ", 1),
+                   f"INSERT INTO {table.name}_new ({columns}) SELECT {columns} FROM {table.name}",
+                   f"DROP TABLE {table.name}",
+                   f"ALTER TABLE {table.name}_new RENAME TO {table.name}",
+                   # Nor the ids of the deleted rows that are still in the balance history
+                   f"UPDATE sqlite_sequence SET seq = max(seq, "
+                   f"(SELECT coalesce(max({table.name}_id), 0) FROM balanceentry), "
+                   f"(SELECT coalesce(max({table.name}_id), 0) FROM snapshotbalance)) WHERE name = '{table.name}'"]
+    script.append("COMMIT")
+    connection = engine.raw_connection()
+    try:
+        # The links reference the tables while they are rebuilt: foreign keys cannot be disabled
+        # within a transaction
+        connection.execute("PRAGMA foreign_keys = OFF")
+        try:
+            connection.executescript(";\n".join(script) + ";")
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.execute(f"PRAGMA foreign_keys = {int(DB_SETTINGS['foreign_keys'])}")
+    finally:
+        connection.close()
+
+
+def migrate_indexes():
+    # create_all skips the indexes of tables that already exist
+    with engine.begin() as connection:
+        for index_name in OBSOLETE_INDEXES:
+            connection.exec_driver_sql(f"DROP INDEX IF EXISTS {index_name}")
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(engine, checkfirst=True)
+            except IntegrityError:
+                columns = [column.name for column in index.columns]
+                raise RuntimeError(f"Cannot create unique index '{index.name}': there are rows with the same {', '.join(columns)}")
+
+
+def migrate_balances():
+    # Previous versions had the balance columns but never updated them (nor the balance
+    # history): compute them once, so the upgraded database serves the right balances
+    with Session(engine) as session:
+        reconcile(session)
+
 
 def create_db_and_tables():
+    with engine.connect() as connection:
+        tables = set(connection.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'table'").scalars())
     SQLModel.metadata.create_all(engine)
-    # Foreign keys are disabled in sqlite3 by default
-    with Session(engine) as session:
-        session.exec(text("PRAGMA foreign_keys = ON"))
+    migrate_autoincrement()
+    migrate_dates()
+    migrate_indexes()
+    create_search_indexes(engine)
+    if "friend" in tables and "balanceentry" not in tables:
+        migrate_balances()
 
 
-def init_db():
-    fake = Faker("es_ES")
-    expenses = []
+def is_db_empty() -> bool:
     with Session(engine) as session:
-        for _ in range(5):
-            expenses.append(Expense(description=f"Travel to {fake.city()}", 
-                                    date=fake.date_between(datetime.datetime(2024,10,1), datetime.datetime.now()),
-                                    amount=float(random.randint(50, 1000))))
-            session.add(expenses[-1])
-            session.commit()
-            session.refresh(expenses[-1])
-
-        for _ in range(10):
-            expense_links = []
-            used = []
-            for _ in range(random.randint(0,4)):
-                random_expense = random.randint(0,len(expenses)-1)
-                if random_expense in used:
-                    continue
-                used.append(random_expense)
-                expense_link = FriendExpenseLink(expense_id = expenses[random_expense].id,
-                                   amount = 0)
-                expense_links.append(expense_link)
-            friend = Friend(name=fake.first_name(), expense_links=expense_links)
-            session.add(friend)
-            session.commit()
+        return session.exec(select(Friend.id).limit(1)).first() is None
+
 
 def init_db_if_empty():
-    with Session(engine) as session:
-        friends = session.exec(select(Friend))
-        if len(friends.all()) == 0:
-            init_db()
-        else:
-            print("DB not empty")
+    if is_db_empty():
+        # Faker is only imported when seeding is needed
+        from persistence.seed import init_db
+        init_db()
+    else:
+        print("DB not empty")
 
 
 if __name__ == "__main__":
+    from persistence.seed import init_db
     create_db_and_tables()
     init_db()
 
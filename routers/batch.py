@@ -0,0 +1,25 @@
+from typing import Optional
+from fastapi import Body, Query
+from persistence.models import BatchItemResult
+
+
+MAX_BATCH_SIZE = 1000
+
+# Parameters shared by every batch endpoint
+Atomic = Query(default=True, description="Apply all the items or none of them (otherwise apply the valid ones)")
+
+
+def BatchBody(description: str):
+    return Body(min_length=1, max_length=MAX_BATCH_SIZE, description=description)
+
+
+def has_failures(results: list[Optional[BatchItemResult]]) -> bool:
+    # Items that passed validation have no result yet
+    return any(result is not None for result in results)
+
+
+def skip_batch(results: list[Optional[BatchItemResult]]) -> list[BatchItemResult]:
+    # All or nothing: the valid items are not applied because some other item failed
+    return [result if result is not None
+            else BatchItemResult(status_code=424, detail="Not applied: another item of the batch failed")
+            for result in results]
@@ -0,0 +1,168 @@
+from typing import Any, Callable, Optional
+from collections import OrderedDict
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from persistence.changes import on_commit
+from pydantic import BaseModel
+import functools
+import hashlib
+import inspect
+import json
+import os
+import re
+import threading
+
+
+# Opaque tag of every entity tag in a list (commas can be part of a tag)
+ENTITY_TAG = re.compile(r'(?:W/)?("[^"]*")')
+
+# Maximum number of cached responses (SPLITWITHME_CACHE_SIZE=0 disables the cache)
+CACHE_SIZE = int(os.environ.get("SPLITWITHME_CACHE_SIZE", "1024"))
+
+
+class ResponseCache:
+    # LRU cache of serialized responses. Every entry is tagged with the friends, expenses and
+    # lists it depends on, so a write only evicts the entries that include what it changed.
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.lock = threading.Lock()
+        # Incremented by every invalidation: responses computed across one are not stored
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: str) -> Optional[tuple[str, bytes]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            etag, body, _ = entry
+            return etag, body
+
+    def put(self, key: str, etag: str, body: bytes, tags: set[str], generation: int):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.remove(key)
+            self.entries[key] = (etag, body, tags)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_size:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key: str):
+        # Must be called with the lock held
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self.tags.get(tag)
+            keys.discard(key)
+            if not keys:
+                del self.tags[tag]
+
+    def invalidate(self, tags: set[str]):
+        with self.lock:
+            self.generation += 1
+            for tag in tags:
+                for key in list(self.tags.get(tag, ())):
+                    self.remove(key)
+                    self.invalidations += 1
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {"size": len(self.entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                    "not_modified": self.not_modified, "evictions": self.evictions, "invalidations": self.invalidations}
+
+
+response_cache = ResponseCache(CACHE_SIZE)
+
+
+@on_commit
+def invalidate_changes(changes: dict[str, set]):
+    tags = {f"friend:{friend_id}" for friend_id in changes["friends"]}
+    tags.update(f"expense:{expense_id}" for expense_id in changes["expenses"])
+    tags.update(f"list:{name}" for name in changes["lists"])
+    # Aggregates over all the expenses depend on any of them
+    if changes["expenses"]:
+        tags.add("expense:*")
+    if tags:
+        response_cache.invalidate(tags)
+
+
+def get_etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def matches_etag(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match is "*" or a list of entity tags, compared with the weak comparison (RFC 9110,
+    # 13.1.2): W/"x" matches "x"
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in ENTITY_TAG.findall(if_none_match)
+
+
+def get_response(request: Request, etag: str, body: bytes) -> Response:
+    if matches_etag(request.headers.get("if-none-match"), etag):
+        with response_cache.lock:
+            response_cache.not_modified += 1
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+def cached(get_tags: Callable[[Any], set[str]]):
+    # Cache the responses of a GET handler (keyed by path and query) with a strong ETag.
+    # get_tags returns the tags of a result: friend:<id>, expense:<id>, expense:* and list:<friends|expenses>.
+    # Cached responses (and 304 Not Modified) are served without querying the database.
+    def decorator(handler):
+        signature = inspect.signature(handler)
+        parameters = [inspect.Parameter("request", inspect.Parameter.KEYWORD_ONLY, annotation=Request)]
+        parameters += [parameter.replace(kind=inspect.Parameter.KEYWORD_ONLY) for parameter in signature.parameters.values()]
+
+        def lookup(request: Request):
+            key = request.url.path + "?" + "&".join(sorted(f"{name}={value}" for name, value in request.query_params.multi_items()))
+            entry = response_cache.get(key)
+            return key, response_cache.generation, entry
+
+        def store(request: Request, key: str, generation: int, result: Any) -> Response:
+            if isinstance(result, BaseModel):
+                # Serialized by pydantic-core, much faster than jsonable_encoder on big responses
+                body = result.model_dump_json().encode()
+            else:
+                body = json.dumps(jsonable_encoder(result), separators=(",", ":")).encode()
+            etag = get_etag(body)
+            response_cache.put(key, etag, body, get_tags(result), generation)
+            return get_response(request, etag, body)
+
+        if inspect.iscoroutinefunction(handler):
+            @functools.wraps(handler)
+            async def cached_handler(request: Request, **kwargs):
+                key, generation, entry = lookup(request)
+                if entry is not None:
+                    return get_response(request, *entry)
+                return store(request, key, generation, await handler(**kwargs))
+        else:
+            @functools.wraps(handler)
+            def cached_handler(request: Request, **kwargs):
+                key, generation, entry = lookup(request)
+                if entry is not None:
+                    return get_response(request, *entry)
+                return store(request, key, generation, handler(**kwargs))
+
+        cached_handler.__signature__ = signature.replace(parameters=parameters)
+        return cached_handler
+    return decorator
@@ -0,0 +1,199 @@
+from typing import Literal, Optional
+from collections import deque
+from fastapi import APIRouter, Header, Query
+from fastapi.responses import StreamingResponse
+from persistence.changes import on_commit
+import asyncio
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+
+router = APIRouter(
+    prefix = "/events",
+    tags=["events"]
+)
+
+# Events kept for the clients that reconnect with Last-Event-ID (SPLITWITHME_EVENTS_HISTORY)
+HISTORY_SIZE = int(os.environ.get("SPLITWITHME_EVENTS_HISTORY", "10000"))
+# Events buffered for a client: a client that falls further behind is disconnected, and resumes
+# from the history when it reconnects (SPLITWITHME_EVENTS_BUFFER)
+BUFFER_SIZE = int(os.environ.get("SPLITWITHME_EVENTS_BUFFER", "1000"))
+# Seconds between keepalive comments on idle connections
+KEEPALIVE_INTERVAL = 15.0
+# Milliseconds before a disconnected client reconnects
+RETRY_MS = 3000
+
+logger = logging.getLogger("splitwithme.events")
+
+EventType = Literal["friend_created", "friend_updated", "friend_deleted", "expense_created", "expense_updated",
+                    "expense_deleted", "participant_added", "participant_removed", "credit_updated"]
+
+
+class Subscription:
+    # Events for one client, filtered by type and by friend or expense. Events are pushed on the
+    # event loop of the client's response and buffered until they are sent.
+
+    def __init__(self, loop, types: Optional[list[str]], friend_ids: Optional[list[int]], expense_ids: Optional[list[int]]):
+        self.loop = loop
+        self.types = set(types) if types is not None else None
+        self.friend_ids = set(friend_ids) if friend_ids is not None else None
+        self.expense_ids = set(expense_ids) if expense_ids is not None else None
+        self.buffer = deque()
+        self.ready = asyncio.Event()
+        self.overflowed = False
+        # Events can reach the client both from the history and pushed: the ones already sent are skipped
+        self.last_id = 0
+
+    def matches(self, event: dict) -> bool:
+        if self.types is not None and event["type"] not in self.types:
+            return False
+        if self.friend_ids is None and self.expense_ids is None:
+            return True
+        return (self.friend_ids is not None and not self.friend_ids.isdisjoint(event["friend_ids"] + event["affected_friend_ids"])
+                or self.expense_ids is not None and not self.expense_ids.isdisjoint(event["expense_ids"]))
+
+    def push(self, events: list[dict]):
+        for event in events:
+            if not self.matches(event):
+                continue
+            if len(self.buffer) >= BUFFER_SIZE:
+                self.overflowed = True
+                break
+            self.buffer.append(event)
+        self.ready.set()
+
+
+class EventHub:
+    # Publishes the events of the committed transactions, with the balances read in their
+    # transaction (see persistence.balances). A thread numbers them and pushes them to the
+    # subscriptions, so commits never wait for the clients.
+
+    def __init__(self, history_size: int):
+        self.queue = queue.Queue()
+        self.history = deque(maxlen=history_size)
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        # Microseconds since the epoch, so ids keep increasing across restarts
+        self.next_id = time.time_ns() // 1000
+
+    def publish(self, events: list[dict]):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="event-hub", daemon=True)
+                self.thread.start()
+        self.queue.put(events)
+
+    def stop(self):
+        with self.lock:
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread.join()
+                self.thread = None
+
+    def run(self):
+        while True:
+            batches = [self.queue.get()]
+            while not self.queue.empty():
+                batches.append(self.queue.get())
+            events = [event for batch in batches if batch is not None for event in batch]
+            if events:
+                try:
+                    self.dispatch(events)
+                except Exception:
+                    # The hub keeps running for the next events
+                    logger.exception("Failed to dispatch %d events", len(events))
+            if None in batches:
+                return
+
+    def dispatch(self, events: list[dict]):
+        with self.lock:
+            for event in events:
+                event["id"] = self.next_id
+                self.next_id += 1
+                self.history.append(event)
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.push, events)
+            except RuntimeError:
+                # The loop of the client's response is closed: the client is gone
+                self.unsubscribe(subscription)
+
+    def subscribe(self, subscription: Subscription, last_event_id: Optional[int]) -> Optional[list[dict]]:
+        # Returns the events after last_event_id, or None if some of them are no longer in the history
+        with self.lock:
+            self.subscriptions.add(subscription)
+            if last_event_id is None:
+                return []
+            first_id = self.history[0]["id"] if self.history else self.next_id
+            if not first_id - 1 <= last_event_id < self.next_id:
+                return None
+            return list(itertools.islice(self.history, last_event_id - first_id + 1, None))
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+
+event_hub = EventHub(HISTORY_SIZE)
+
+
+@on_commit
+def publish_events(changes: dict[str, set]):
+    if changes["events"]:
+        event_hub.publish(changes["events"])
+
+
+def format_event(event: dict) -> str:
+    data = {name: value for name, value in event.items() if name not in ("id", "type", "affected_friend_ids")}
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_events(subscription: Subscription, last_event_id: Optional[int]):
+    # Subscribed only once the response is streamed, so a client that disconnects before is
+    # never subscribed
+    backlog = event_hub.subscribe(subscription, last_event_id)
+    try:
+        yield f"retry: {RETRY_MS}\n\n"
+        if backlog is None:
+            # Some events were missed: the client has to reload what it shows
+            yield "event: reset\ndata: {}\n\n"
+        for event in backlog or ():
+            if subscription.matches(event):
+                subscription.last_id = event["id"]
+                yield format_event(event)
+        while True:
+            try:
+                await asyncio.wait_for(subscription.ready.wait(), KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            subscription.ready.clear()
+            while subscription.buffer:
+                event = subscription.buffer.popleft()
+                if event["id"] > subscription.last_id:
+                    subscription.last_id = event["id"]
+                    yield format_event(event)
+            if subscription.overflowed:
+                # Too slow: the client reconnects and resumes from the history
+                return
+    finally:
+        event_hub.unsubscribe(subscription)
+
+
+@router.get("/", summary="Stream the changes of friends and expenses as Server-Sent Events",
+         response_class=StreamingResponse,
+         responses={200: {"content": {"text/event-stream": {}}}})
+async def get_events(type: Optional[list[EventType]] = Query(default=None, description="Only send these events"),
+                     friend_id: Optional[list[int]] = Query(default=None, description="Only send the events of these friends"),
+                     expense_id: Optional[list[int]] = Query(default=None, description="Only send the events of these expenses"),
+                     last_event_id: Optional[int] = Header(default=None, description="Resume after this event")):
+    subscription = Subscription(asyncio.get_running_loop(), type, friend_id, expense_id)
+    return StreamingResponse(stream_events(subscription, last_event_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -1,105 +1,140 @@
 from fastapi import APIRouter, Depends, HTTPException
-from persistence.database import get_session
-from persistence.models import Message, Friend, Expense, FriendExpenseLink, Expense
-from sqlmodel import Session, select, func
+from persistence.database import db_handler
+from persistence.models import Message, Expense, Page, BatchItemResult
+from persistence.repository import AlreadyExists, Repository
+from persistence.storage import get_repository, get_read_repository
+from routers.pagination import Cursor, Limit, get_next_cursor
+from routers.cache import cached
+from routers.batch import Atomic, BatchBody, has_failures, skip_batch
+from routers.history import AsOf, get_as_of
 
-import time
-from datetime import datetime
+from typing import Any, Literal, Optional
+from datetime import date, datetime
 
 router = APIRouter(
     prefix = "/expenses",
     tags=["expenses"]
 )
 
-def is_valid_date(date_str: str) -> bool:
+def parse_date(value: Any) -> Optional[date]:
+    # Table models are not validated, so the date of a request body arrives as it was sent
+    if isinstance(value, date):
+        return value
     try:
-        datetime.strptime(date_str, "%Y-%m-%d")
-        return True
-    except ValueError:
-        return False
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return None
 
 @router.post("/",
           status_code=201,
           responses={201: {"model": Expense}, 409: {"model": Message}})
-def add_expense(expense: Expense, session: Session = Depends(get_session)) -> Expense:
-    if not is_valid_date(expense.date):
+@db_handler
+def add_expense(expense: Expense, repository: Repository = Depends(get_repository)) -> Expense:
+    date = parse_date(expense.date)
+    if date is None:
         raise HTTPException(status_code=422, detail=f"Malformed date '{expense.date}' (required format: YYYY-MM-DD)")
-    existing_expense = session.exec(select(Expense).where(Expense.description == expense.description).where(Expense.date == expense.date))
-    if existing_expense.first() is None:
-        session.add(expense)
-        session.commit()
-        session.refresh(expense)
-        return expense
-    else:
+    expense.date = date
+    # Balances are maintained by the friend expense operations
+    expense.credit_balance = 0
+    expense.num_friends = 1
+    try:
+        expense_id, = repository.add_expenses([expense])
+    except AlreadyExists:
         raise HTTPException(status_code=409, detail="Expense already exists")
+    return repository.get_expense(expense_id)
 
 
-def get_credit_balance(expense_id: int, session: Session) -> float:
-    # Sum all the contributions of the expense
-    credit_balance = session.exec(select(func.sum(FriendExpenseLink.amount)).where(FriendExpenseLink.expense_id == expense_id)).first()
-    if credit_balance is None:
-        credit_balance = 0
-    return credit_balance
-
-def get_num_friends(expense_id: int, session: Session) -> float:
-    # Get all the friends
-    num_friends = session.exec(select(func.count(FriendExpenseLink.friend_id)).where(FriendExpenseLink.expense_id == expense_id)).first()
-    if num_friends is None:
-        num_friends = 1
-    return num_friends + 1
+@router.post("/batch", summary="Add Expenses in batch",
+          responses={200: {"model": list[BatchItemResult]}, 409: {"model": Message}})
+@db_handler
+def add_expenses(expenses: list[Expense] = BatchBody("Expenses to add"), atomic: bool = Atomic,
+                 repository: Repository = Depends(get_repository)) -> list[BatchItemResult]:
+    results = [None] * len(expenses)
+    keys = set()
+    for index, expense in enumerate(expenses):
+        date = parse_date(expense.date)
+        if date is None:
+            results[index] = BatchItemResult(status_code=422, detail=f"Malformed date '{expense.date}' (required format: YYYY-MM-DD)")
+        elif (expense.description, date) in keys:
+            results[index] = BatchItemResult(status_code=409, detail="Expense already exists")
+        else:
+            expense.date = date
+            keys.add((expense.description, date))
+    if keys:
+        existing_keys = repository.get_existing_expense_keys(keys)
+        for index, expense in enumerate(expenses):
+            if results[index] is None and (expense.description, expense.date) in existing_keys:
+                results[index] = BatchItemResult(status_code=409, detail="Expense already exists")
+    if atomic and has_failures(results):
+        return skip_batch(results)
 
+    new_expenses = [(index, expense) for index, expense in enumerate(expenses) if results[index] is None]
+    for _, expense in new_expenses:
+        expense.credit_balance = 0
+        expense.num_friends = 1
+    try:
+        expense_ids = repository.add_expenses([expense for _, expense in new_expenses])
+    except AlreadyExists:
+        raise HTTPException(status_code=409, detail="Expense already exists")
+    for (index, _), expense_id in zip(new_expenses, expense_ids):
+        results[index] = BatchItemResult(status_code=201, id=expense_id)
+    return results
 
 
 @router.get("/{expense_id}",
-         responses={200: {"model": Expense}, 404: {"model": Message}})
-def get_expense(expense_id: int, session: Session = Depends(get_session)) -> Expense: 
-    time.sleep(2)
-    results = session.exec(select(Expense).where(Expense.id == expense_id))
-    expense = results.first()
+         responses={200: {"model": Expense}, 304: {"description": "Not modified"}, 404: {"model": Message}, 422: {"model": Message}})
+@cached(lambda expense: {f"expense:{expense.id}"})
+@db_handler
+def get_expense(expense_id: int, as_of: Optional[datetime] = AsOf,
+                repository: Repository = Depends(get_read_repository)) -> Expense:
+    if as_of is not None:
+        expense = get_as_of(repository.get_expense_as_of, expense_id, as_of)
+    else:
+        expense = repository.get_expense(expense_id)
     if expense is not None:
-        expense.credit_balance = get_credit_balance(expense_id, session)
-        expense.num_friends = get_num_friends(expense_id, session)
         return expense
     else:
         raise HTTPException(status_code=404, detail=f"Expense '{expense_id}' not found")
 
 
 @router.get("/",
-         responses={200: {"model": list[Expense]}, 404: {"model": Message}})
-def get_expenses(session: Session = Depends(get_session)) -> list[Expense]:
-    time.sleep(2)
-    expenses = session.exec(select(Expense)).all()
-    for expense in expenses:
-        expense.credit_balance = get_credit_balance(expense.id, session)
-        expense.num_friends = get_num_friends(expense.id, session)
-    return expenses
+         responses={200: {"model": Page[Expense]}, 304: {"description": "Not modified"}, 404: {"model": Message}, 422: {"model": Message}})
+@cached(lambda page: {"list:expenses"} | {f"expense:{expense.id}" for expense in page.items})
+@db_handler
+def get_expenses(date_from: Optional[date] = None, date_to: Optional[date] = None,
+                 min_amount: Optional[float] = None, max_amount: Optional[float] = None,
+                 sort: Literal["id", "date", "amount"] = "id", descending: bool = False,
+                 cursor: Optional[str] = Cursor, limit: int = Limit,
+                 repository: Repository = Depends(get_read_repository)) -> Page[Expense]:
+    expenses = repository.get_expenses(date_from, date_to, min_amount, max_amount, sort, descending, cursor, limit)
+    next_cursor = get_next_cursor(expenses, limit, lambda expense: (getattr(expense, sort), expense.id))
+    return Page(items=expenses, next_cursor=next_cursor)
 
 @router.put("/{expense_id}",
          status_code=204,
-         responses={404: {"model": Message}})
-def update_expense(expense_id: int, expense: Expense, session: Session = Depends(get_session)):
-    if not is_valid_date(expense.date):
+         responses={404: {"model": Message}, 409: {"model": Message}})
+@db_handler
+def update_expense(expense_id: int, expense: Expense, repository: Repository = Depends(get_repository)):
+    date = parse_date(expense.date)
+    if date is None:
         raise HTTPException(status_code=422, detail=f"Malformed date '{expense.date}' (required format: YYYY-MM-DD)")
-    results = session.exec(select(Expense).where(Expense.id == expense_id))
-    stored_expense = results.first()
+    stored_expense = repository.get_expense(expense_id)
     if stored_expense is not None:
-        stored_expense.description = expense.description
-        stored_expense.date = expense.date
-        stored_expense.amount = expense.amount
-        session.commit()
-        session.refresh(stored_expense)
+        try:
+            repository.update_expense(stored_expense, expense.description, date, expense.amount)
+        except AlreadyExists:
+            raise HTTPException(status_code=409, detail="Expense already exists")
     else:
         raise HTTPException(status_code=404, detail=f"Expense {expense_id} not found")
     
 @router.delete("/{expense_id}",
          status_code=204,
          responses={404: {"model": Message}})
-def delete_expense(expense_id: int, session: Session = Depends(get_session)):
-    results = session.exec(select(Expense).where(Expense.id == expense_id))
-    stored_expense = results.first()
+@db_handler
+def delete_expense(expense_id: int, repository: Repository = Depends(get_repository)):
+    stored_expense = repository.get_expense(expense_id)
     if stored_expense is not None:
-        session.delete(stored_expense)
-        session.commit()  
+        repository.delete_expense(stored_expense)
     else:
         raise HTTPException(status_code=404, detail=f"Expense '{expense_id}' not found")
     
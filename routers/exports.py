@@ -0,0 +1,123 @@
+from typing import Iterator, Literal, Optional
+from datetime import date
+from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
+from persistence.database import read_engine
+from persistence.models import Message, Friend, Expense, FriendExpenseLink
+from sqlmodel import Session, select
+
+import csv
+import io
+import json
+
+
+router = APIRouter(
+    prefix = "/export",
+    tags=["export"]
+)
+
+# Rows fetched from the cursor (and written to the response) at a time
+CHUNK_SIZE = 1000
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+EXPENSE_COLUMNS = ["id", "description", "date", "amount", "num_friends", "credit_balance",
+                   "friend_id", "friend_name", "friend_credit_balance", "friend_debit_balance"]
+FRIEND_COLUMNS = ["id", "name", "credit_balance", "debit_balance"]
+
+
+def stream_rows(statement) -> Iterator:
+    # The rows are read from the cursor in chunks, so memory stays flat whatever the table size.
+    # The session is owned by the generator because the response outlives the request handler.
+    with Session(read_engine) as session:
+        yield from session.exec(statement.execution_options(yield_per=CHUNK_SIZE))
+
+
+def get_expense_rows(since: Optional[date]) -> Iterator[list]:
+    # One row per friend in each expense (and one row without friend for unshared expenses)
+    statement = (select(Expense.id, Expense.description, Expense.date, Expense.amount, Expense.num_friends,
+                        Expense.credit_balance, FriendExpenseLink.friend_id, Friend.name, FriendExpenseLink.amount)
+                 .outerjoin(FriendExpenseLink, FriendExpenseLink.expense_id == Expense.id)
+                 .outerjoin(Friend, Friend.id == FriendExpenseLink.friend_id)
+                 .order_by(Expense.id, FriendExpenseLink.friend_id))
+    if since is not None:
+        statement = statement.where(Expense.date >= since)
+    for *expense, friend_id, friend_name, friend_credit in stream_rows(statement):
+        expense[2] = expense[2].isoformat()
+        amount, num_friends = expense[3], expense[4]
+        if friend_id is None:
+            yield expense + [None, None, None, None]
+        else:
+            yield expense + [friend_id, friend_name, friend_credit, amount / num_friends]
+
+
+def get_expense_documents(since: Optional[date]) -> Iterator[dict]:
+    # Group the rows of each expense into one document with the list of its friends
+    document = None
+    for row in get_expense_rows(since):
+        if document is None or document["id"] != row[0]:
+            if document is not None:
+                yield document
+            document = dict(zip(EXPENSE_COLUMNS[:6], row[:6]))
+            document["friends"] = []
+        if row[6] is not None:
+            document["friends"].append(dict(zip(FRIEND_COLUMNS, row[6:])))
+    if document is not None:
+        yield document
+
+
+def get_friend_rows() -> Iterator[list]:
+    statement = select(Friend.id, Friend.name, Friend.credit_balance, Friend.debit_balance).order_by(Friend.id)
+    for row in stream_rows(statement):
+        yield list(row)
+
+
+def to_ndjson(documents: Iterator[dict]) -> Iterator[str]:
+    lines = []
+    for document in documents:
+        lines.append(json.dumps(document) + "\n")
+        if len(lines) == CHUNK_SIZE:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+
+def to_csv(columns: list[str], rows: Iterator[list]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for index, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if index % CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_response(content: Iterator[str], name: str, format: str) -> StreamingResponse:
+    return StreamingResponse(content, media_type=MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="{name}.{format}"'})
+
+
+@router.get("/expenses", summary="Export Expenses with their Friends",
+         response_class=StreamingResponse,
+         responses={200: {"content": {"application/x-ndjson": {}, "text/csv": {}}}, 422: {"model": Message}})
+def export_expenses(format: Literal["ndjson", "csv"] = "ndjson", since: Optional[date] = None):
+    if format == "csv":
+        content = to_csv(EXPENSE_COLUMNS, get_expense_rows(since))
+    else:
+        content = to_ndjson(get_expense_documents(since))
+    return export_response(content, "expenses", format)
+
+
+@router.get("/friends", summary="Export Friends with their balances",
+         response_class=StreamingResponse,
+         responses={200: {"content": {"application/x-ndjson": {}, "text/csv": {}}}})
+def export_friends(format: Literal["ndjson", "csv"] = "ndjson"):
+    if format == "csv":
+        content = to_csv(FRIEND_COLUMNS, get_friend_rows())
+    else:
+        content = to_ndjson(dict(zip(FRIEND_COLUMNS, row)) for row in get_friend_rows())
+    return export_response(content, "friends", format)
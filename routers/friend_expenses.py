@@ -1,7 +1,13 @@
 from fastapi import APIRouter, Depends, HTTPException
-from persistence.database import get_session
-from persistence.models import Message, Friend, Expense, FriendExpenseLink, Expense
-from sqlmodel import Session, select, func
+from persistence.database import db_handler
+from persistence.models import Message, Expense, FriendExpenseLink, Page, ExpenseFriend, FriendExpenseItem, CreditItem, BatchItemResult
+from persistence.repository import Repository
+from persistence.storage import get_repository, get_read_repository
+from routers.pagination import Cursor, Limit, get_next_cursor
+from routers.batch import Atomic, BatchBody, has_failures, skip_batch
+
+from typing import Optional
+from collections import defaultdict
 
 
 router = APIRouter(
@@ -10,88 +16,120 @@ router = APIRouter(
 )
 
 
+@router.post("/friends/batch", summary="Assign Friends to Expenses in batch",
+          responses={200: {"model": list[BatchItemResult]}})
+@db_handler
+def add_friends_to_expenses(items: list[FriendExpenseItem] = BatchBody("Friends to assign to each expense"),
+                            atomic: bool = Atomic,
+                            repository: Repository = Depends(get_repository)) -> list[BatchItemResult]:
+    existing_friends = repository.get_existing_friends({item.friend_id for item in items})
+    existing_expenses = repository.get_existing_expenses({item.expense_id for item in items})
+    existing_links = repository.get_existing_links({(item.expense_id, item.friend_id) for item in items})
+
+    results = [None] * len(items)
+    new_links = defaultdict(list)
+    for index, item in enumerate(items):
+        if item.friend_id not in existing_friends:
+            results[index] = BatchItemResult(status_code=404, detail=f"Friend '{item.friend_id}' not found")
+        elif item.expense_id not in existing_expenses:
+            results[index] = BatchItemResult(status_code=404, detail=f"Expense '{item.expense_id}' not found")
+        elif (item.expense_id, item.friend_id) in existing_links or item.friend_id in new_links[item.expense_id]:
+            results[index] = BatchItemResult(status_code=409, detail="Friend was previously assigned to expense")
+        else:
+            new_links[item.expense_id].append(item.friend_id)
+    if atomic and has_failures(results):
+        return skip_batch(results)
+
+    repository.add_participants({expense_id: friend_ids for expense_id, friend_ids in new_links.items() if friend_ids})
+    return [result if result is not None else BatchItemResult(status_code=201) for result in results]
+
+
+@router.put("/friends/batch", summary="Update Friends' credit in Expenses in batch",
+         responses={200: {"model": list[BatchItemResult]}})
+@db_handler
+def update_expenses(items: list[CreditItem] = BatchBody("Credit to add to each friend in each expense"),
+                    atomic: bool = Atomic,
+                    repository: Repository = Depends(get_repository)) -> list[BatchItemResult]:
+    existing_links = repository.get_existing_links({(item.expense_id, item.friend_id) for item in items})
+    results = [None] * len(items)
+    for index, item in enumerate(items):
+        if (item.expense_id, item.friend_id) not in existing_links:
+            results[index] = BatchItemResult(status_code=404, detail=f"Expense '{item.expense_id}' for friend '{item.friend_id}' not found")
+    if atomic and has_failures(results):
+        return skip_batch(results)
+
+    # The links may have been removed since they were checked
+    pending = [index for index, result in enumerate(results) if result is None]
+    new_amounts = repository.add_credits([(items[index].expense_id, items[index].friend_id, items[index].amount) for index in pending], atomic)
+    for index, new_amount in zip(pending, new_amounts):
+        if new_amount is None:
+            results[index] = BatchItemResult(status_code=404, detail=f"Expense '{items[index].expense_id}' for friend '{items[index].friend_id}' not found")
+    if atomic and has_failures(results):
+        return skip_batch(results)
+    return [result if result is not None else BatchItemResult(status_code=200) for result in results]
+
+
 @router.post("/{expense_id}/friends",
           status_code=201,
           responses={201: {"model": Expense},
                      404: {"model": Message}, 
                      409: {"model": Message}})
-def add_friend_to_expense(expense_id: int, friend_id: int, session: Session = Depends(get_session)) -> FriendExpenseLink:
-    existing_friend = session.exec(select(Friend).where(Friend.id==friend_id)).first()
-    if existing_friend is None:
+@db_handler
+def add_friend_to_expense(expense_id: int, friend_id: int, repository: Repository = Depends(get_repository)) -> FriendExpenseLink:
+    if not repository.get_existing_friends({friend_id}):
         raise  HTTPException(status_code=404, detail=f"Friend '{friend_id}' not found")
-    existing_expense = session.exec(select(Expense).where(Expense.id==expense_id)).first()
-    if existing_expense is None:
+    if not repository.get_existing_expenses({expense_id}):
          raise HTTPException(status_code=404, detail=f"Expense '{expense_id}' not found")
-    existing_friend_expense = session.exec(select(FriendExpenseLink).where(FriendExpenseLink.expense_id == expense_id).where(FriendExpenseLink.friend_id == friend_id))
-    if existing_friend_expense.first() is None:
-        friend_expense_link = FriendExpenseLink(expense_id=expense_id, friend_id=friend_id)
-        session.add(friend_expense_link)
-        session.commit()
-        session.refresh(friend_expense_link)
-        return friend_expense_link
+    if repository.get_link(expense_id, friend_id) is None:
+        repository.add_participants({expense_id: [friend_id]})
+        return FriendExpenseLink(expense_id=expense_id, friend_id=friend_id, amount=0)
     else:
         raise HTTPException(status_code=409, detail="Friend was previously assigned to expense")
 
 
 
 @router.get("/{expense_id}/friends",
-         responses={200: {"model": list[Friend]}, 404: {"model": Message}})
-def get_friends_by_expense(expense_id: int, session: Session = Depends(get_session)) -> list[Friend]:
-    expense = session.exec(select(Expense).where(Expense.id == expense_id)).first()
-    if expense is not None:
-        friends_by_expense = expense.friend_links
-        friends = []
-        debit_per_friend = expense.amount / (len(friends_by_expense)+1)
-
-        for friend_by_expense in friends_by_expense:
-            friend = friend_by_expense.friend
-            friend.credit_balance = friend_by_expense.amount
-            friend.debit_balance = debit_per_friend
-            friends.append(friend)
-    
-        return friends
+         responses={200: {"model": Page[ExpenseFriend]}, 404: {"model": Message}})
+@db_handler
+def get_friends_by_expense(expense_id: int, cursor: Optional[str] = Cursor, limit: int = Limit,
+                           repository: Repository = Depends(get_read_repository)) -> Page[ExpenseFriend]:
+    friends = repository.get_expense_friends(expense_id, cursor, limit)
+    if friends is not None:
+        next_cursor = get_next_cursor(friends, limit, lambda friend: (None, friend.id))
+        return Page(items=friends, next_cursor=next_cursor)
     else:
         raise HTTPException(status_code=404, detail=f"Expense '{expense_id}' not found")
 
 
 @router.get("/{expense_id}/friends/{friend_id}", summary="Get Friend info by Expense",
-         responses={200: {"model": Friend}, 404: {"model": Message}})
-def get_expenses(expense_id: int, friend_id: int, session: Session = Depends(get_session)) -> Friend:
-    friend_by_expense = session.exec(select(FriendExpenseLink).where(FriendExpenseLink.expense_id == expense_id).where(FriendExpenseLink.friend_id == friend_id)).first()
-    if friend_by_expense is not None:
-        expense = friend_by_expense.expense
-        debit_per_friend = expense.amount / (len(expense.friend_links)+1)
-        friend = friend_by_expense.friend
-        friend.credit_balance = friend_by_expense.amount
-        friend.debit_balance = debit_per_friend
-        
+         responses={200: {"model": ExpenseFriend}, 404: {"model": Message}})
+@db_handler
+def get_expenses(expense_id: int, friend_id: int, repository: Repository = Depends(get_read_repository)) -> ExpenseFriend:
+    friend = repository.get_expense_friend(expense_id, friend_id)
+    if friend is not None:
         return friend
     else:
         raise HTTPException(status_code=404, detail=f"Expense '{expense_id}' for friend '{friend_id}' not found")
-    
+
 @router.put("/{expense_id}/friends/{friend_id}", summary="Update Friend's credit in Expense",
          status_code=204,
          responses={404: {"model": Message}})
-def update_expense(expense_id: int, friend_id: int, amount: float, session: Session = Depends(get_session)):
-    friend_by_expense = session.exec(select(FriendExpenseLink).where(FriendExpenseLink.expense_id == expense_id).where(FriendExpenseLink.friend_id == friend_id)).first()
-
-    if friend_by_expense is not None:
-        friend_by_expense.amount += amount
-        session.commit()
-        session.refresh(friend_by_expense)
-    else:
+@db_handler
+def update_expense(expense_id: int, friend_id: int, amount: float, repository: Repository = Depends(get_repository)):
+    new_amount = repository.add_credit(expense_id, friend_id, amount)
+    if new_amount is None:
         raise HTTPException(status_code=404, detail=f"Expense '{expense_id}' for friend '{friend_id}' not found")
     
 @router.delete("/{expense_id}/friends/{friend_id}", summary="Delete Friend from Expense",
          status_code=204,
          responses={404: {"model": Message},
                     409: {"model": Message}})
-def delete_expense(expense_id: int, friend_id: int, session: Session = Depends(get_session)):
-    friend_by_expense = session.exec(select(FriendExpenseLink).where(FriendExpenseLink.expense_id == expense_id).where(FriendExpenseLink.friend_id == friend_id)).first()
+@db_handler
+def delete_expense(expense_id: int, friend_id: int, repository: Repository = Depends(get_repository)):
+    friend_by_expense = repository.get_link(expense_id, friend_id)
     if friend_by_expense is not None:
         if friend_by_expense.amount == 0:
-            session.delete(friend_by_expense)
-            session.commit()  
+            repository.remove_participant(friend_by_expense)
         else:
             raise HTTPException(status_code=409, detail=f"Credit balance of friend '{friend_id}' in expense '{expense_id}' is not zero")
     else:
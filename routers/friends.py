@@ -1,7 +1,14 @@
 from fastapi import APIRouter, Depends, HTTPException
-from persistence.database import get_session
-from persistence.models import Message, Friend, FriendExpenseLink, FriendExpense
-from sqlmodel import Session, select, func
+from persistence.database import db_handler
+from persistence.models import Message, Friend, FriendExpense, Page
+from persistence.repository import Repository
+from persistence.storage import get_repository, get_read_repository
+from routers.cache import cached
+from routers.pagination import Cursor, Limit, get_next_cursor
+from routers.history import AsOf, get_as_of
+
+from typing import Literal, Optional
+from datetime import datetime
 
 
 router = APIRouter(
@@ -13,89 +20,67 @@ router = APIRouter(
 @router.post("/",
           status_code=201,
           responses={201: {"model": Friend}, 409: {"model": Message}})
-def add_friend(friend: Friend, session: Session = Depends(get_session)) -> Friend:
-    existing_friend = session.exec(select(Friend).where(Friend.id == friend.id))
-    if existing_friend.first() is None:
-        session.add(friend)
-        session.commit()
-        session.refresh(friend)
+@db_handler
+def add_friend(friend: Friend, repository: Repository = Depends(get_repository)) -> Friend:
+    # Balances are maintained by the friend expense operations
+    friend.credit_balance = 0
+    friend.debit_balance = 0
+    friend = repository.add_friend(friend)
+    if friend is not None:
         return friend
     else:
         raise HTTPException(status_code=409, detail="Friend already exists")
 
 
-def get_credit_balance(friend_id: int, session: Session) -> float:
-    # Sum all the contributions of the friend
-    credit_balance = session.exec(select(func.sum(FriendExpenseLink.amount)).where(FriendExpenseLink.friend_id == friend_id)).first()
-    if credit_balance is None:
-        credit_balance = 0
-    return credit_balance
-
-def get_debit_balance(friend_id: int, session: Session) -> float:
-    # Get all the expenses this friend has 
-    expense_links = session.exec(select(FriendExpenseLink).where(FriendExpenseLink.friend_id == friend_id)).all()
-    debit_balance = 0
-    for expense_link in expense_links:
-        # Get the amount of each expense
-        total_amount = expense_link.expense.amount
-        # and the number of friends involved plus the user himself/herself
-        num_friends = len(expense_link.expense.friend_links) + 1
-        debit_balance += total_amount / num_friends
-    return debit_balance
-
 @router.get("/{friend_id}",
-         responses={200: {"model": Friend}, 404: {"model": Message}})
-def get_friend(friend_id: int, session: Session = Depends(get_session)) -> Friend:
-    results = session.exec(select(Friend).where(Friend.id == friend_id))
-    friend = results.first()
+         responses={200: {"model": Friend}, 304: {"description": "Not modified"}, 404: {"model": Message}, 422: {"model": Message}})
+@cached(lambda friend: {f"friend:{friend.id}"})
+@db_handler
+def get_friend(friend_id: int, as_of: Optional[datetime] = AsOf,
+               repository: Repository = Depends(get_read_repository)) -> Friend:
+    if as_of is not None:
+        friend = get_as_of(repository.get_friend_as_of, friend_id, as_of)
+    else:
+        friend = repository.get_friend(friend_id)
     if friend is not None:
-        friend.credit_balance = get_credit_balance(friend_id, session)
-        friend.debit_balance = get_debit_balance(friend_id, session)
         return friend
     else:
         raise HTTPException(status_code=404, detail=f"Friend '{friend_id}' not found")
 
 
 @router.get("/{friend_id}/expenses", summary="Get Expenses by Friend",
-         responses={200: {"model": FriendExpense}, 404: {"model": Message}})
-def get_friend(friend_id: int, session: Session = Depends(get_session)) -> list[FriendExpense]:
-    friend = session.exec(select(Friend).where(Friend.id == friend_id)).first()
-    if friend is not None:
-        friend_expenses = []
-        for friend_expense_link in friend.expense_links:
-            expense = friend_expense_link.expense
-            num_friends = len(expense.friend_links)
-            friend_expenses.append(FriendExpense(id=expense.id, 
-                                                 description=expense.description,
-                                                 amount=expense.amount,
-                                                 num_friends=num_friends + 1,
-                                                 credit_balance=friend_expense_link.amount,
-                                                 debit_balance=expense.amount/(num_friends+1)))
-        
-        return friend_expenses
+         responses={200: {"model": Page[FriendExpense]}, 404: {"model": Message}})
+@db_handler
+def get_friend(friend_id: int, cursor: Optional[str] = Cursor, limit: int = Limit,
+               repository: Repository = Depends(get_read_repository)) -> Page[FriendExpense]:
+    friend_expenses = repository.get_friend_expenses(friend_id, cursor, limit)
+    if friend_expenses is not None:
+        next_cursor = get_next_cursor(friend_expenses, limit, lambda friend_expense: (None, friend_expense.id))
+        return Page(items=friend_expenses, next_cursor=next_cursor)
     else:
         raise HTTPException(status_code=404, detail=f"Friend '{friend_id}' not found")
 
 
 @router.get("/",
-         responses={200: {"model": list[Friend]}, 404: {"model": Message}})
-def get_friends(session: Session = Depends(get_session)) -> list:
-    friends = session.exec(select(Friend)).all()
-    for friend in friends:
-        friend.credit_balance = get_credit_balance(friend.id, session)
-        friend.debit_balance = get_debit_balance(friend.id, session)
-    return friends
+         responses={200: {"model": Page[Friend]}, 304: {"description": "Not modified"}, 404: {"model": Message}})
+@cached(lambda page: {"list:friends"} | {f"friend:{friend.id}" for friend in page.items})
+@db_handler
+def get_friends(name_prefix: Optional[str] = None,
+                sort: Literal["id", "name"] = "id", descending: bool = False,
+                cursor: Optional[str] = Cursor, limit: int = Limit,
+                repository: Repository = Depends(get_read_repository)) -> Page[Friend]:
+    friends = repository.get_friends(name_prefix, sort, descending, cursor, limit)
+    next_cursor = get_next_cursor(friends, limit, lambda friend: (getattr(friend, sort), friend.id))
+    return Page(items=friends, next_cursor=next_cursor)
 
 @router.put("/{friend_id}",
          status_code=204,
          responses={404: {"model": Message}})
-def update_friend(friend_id: int, friend: Friend, session: Session = Depends(get_session)):
-    results = session.exec(select(Friend).where(Friend.id == friend_id))
-    stored_friend = results.first()
+@db_handler
+def update_friend(friend_id: int, friend: Friend, repository: Repository = Depends(get_repository)):
+    stored_friend = repository.get_friend(friend_id)
     if stored_friend is not None:
-        stored_friend.name = friend.name
-        session.commit()
-        session.refresh(stored_friend)
+        repository.update_friend(stored_friend, friend.name)
     else:
         raise HTTPException(status_code=404, detail=f"Friend '{friend_id}' not found")
     
@@ -103,15 +88,13 @@ def update_friend(friend_id: int, friend: Friend, session: Session = Depends(get
          status_code=204,
          responses={404: {"model": Message},
                     409: {"model": Message}})
-def delete_friend(friend_id: int, session: Session = Depends(get_session)):
-    results = session.exec(select(Friend).where(Friend.id == friend_id))
-    stored_friend = results.first()
+@db_handler
+def delete_friend(friend_id: int, repository: Repository = Depends(get_repository)):
+    stored_friend = repository.get_friend(friend_id)
     if stored_friend is not None:
-        credit_balance = get_credit_balance(friend_id, session)
-        if credit_balance == 0:
-            session.delete(stored_friend)
-            session.commit()
+        if stored_friend.credit_balance == 0:
+            repository.delete_friend(stored_friend)
         else:
             raise HTTPException(status_code=409, detail=f"Credit balance of '{friend_id}' is not zero")
     else:
-        raise HTTPException(status_code=404, detail=f"Friend '{friend_id}' not found")
\ No newline at end of file
+        raise HTTPException(status_code=404, detail=f"Friend '{friend_id}' not found")
@@ -0,0 +1,21 @@
+from typing import Any, Callable
+from datetime import datetime
+from fastapi import HTTPException, Query
+from persistence.history import to_utc
+from persistence.repository import HistoryUnavailable
+
+
+# Query parameter of the endpoints that return balances. Only the balances are historical: the
+# ledger does not record the other fields
+AsOf = Query(default=None, description="Get the credit_balance and debit_balance at this time (ISO 8601, UTC if it has no offset) "
+                                       "instead of the current ones. The other fields are the current ones")
+
+
+def get_as_of(get: Callable[[int, datetime], Any], id: int, as_of: datetime) -> Any:
+    # Call a get_*_as_of method of the repository, with the time in UTC
+    try:
+        return get(id, to_utc(as_of))
+    except HistoryUnavailable as exception:
+        if exception.start is None:
+            raise HTTPException(status_code=422, detail="There is no balance history")
+        raise HTTPException(status_code=422, detail=f"The balance history starts at {exception.start.isoformat()}")
@@ -0,0 +1,205 @@
+from collections import Counter
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+from persistence.instrumentation import request_stats, new_request_stats
+from persistence.models import Message
+from routers.cache import response_cache
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+
+router = APIRouter(
+    tags=["metrics"]
+)
+
+# Requests slower than this are logged with their SQL statistics (SPLITWITHME_SLOW_REQUEST_MS, 0 disables the log)
+SLOW_REQUEST_MS = float(os.environ.get("SPLITWITHME_SLOW_REQUEST_MS", "0"))
+# Interval of the sampling profiler (SPLITWITHME_PROFILER_INTERVAL_MS, 0 disables the profiler)
+PROFILER_INTERVAL_MS = float(os.environ.get("SPLITWITHME_PROFILER_INTERVAL_MS", "0"))
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+STATEMENT_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50, 100, 500]
+
+slow_request_logger = logging.getLogger("splitwithme.slow_request")
+
+
+class Histogram:
+    # Cumulative histogram in the Prometheus exposition format (le buckets, sum and count)
+
+    def __init__(self, buckets: list[float]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RouteMetrics:
+    # Request metrics by route template (/friends/{friend_id}, not /friends/1), so the
+    # number of series stays bounded whatever the ids in the requests
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.latency = {}
+        self.statements = {}
+        self.db_time = Counter()
+        self.rows = Counter()
+
+    def observe(self, method: str, route: str, status_code: int, duration: float, stats: dict):
+        key = (method, route)
+        with self.lock:
+            self.requests[(method, route, status_code)] += 1
+            if key not in self.latency:
+                self.latency[key] = Histogram(LATENCY_BUCKETS)
+                self.statements[key] = Histogram(STATEMENT_BUCKETS)
+            self.latency[key].observe(duration)
+            self.statements[key].observe(stats["statements"])
+            self.db_time[key] += stats["db_time"]
+            self.rows[key] += stats["rows"]
+
+    def render(self) -> list[str]:
+        lines = []
+        with self.lock:
+            lines += ["# HELP splitwithme_requests_total Requests served.",
+                      "# TYPE splitwithme_requests_total counter"]
+            for (method, route, status_code), value in sorted(self.requests.items()):
+                lines.append(f'splitwithme_requests_total{{method="{method}",route="{route}",status="{status_code}"}} {value}')
+            lines += render_histograms("splitwithme_request_duration_seconds", "Request latency.", self.latency)
+            lines += render_histograms("splitwithme_request_sql_statements", "SQL statements executed per request.", self.statements)
+            lines += ["# HELP splitwithme_request_db_seconds_total Time spent executing SQL statements.",
+                      "# TYPE splitwithme_request_db_seconds_total counter"]
+            for (method, route), value in sorted(self.db_time.items()):
+                lines.append(f'splitwithme_request_db_seconds_total{{method="{method}",route="{route}"}} {value:.6f}')
+            lines += ["# HELP splitwithme_request_db_rows_total Rows returned or changed by the SQL statements.",
+                      "# TYPE splitwithme_request_db_rows_total counter"]
+            for (method, route), value in sorted(self.rows.items()):
+                lines.append(f'splitwithme_request_db_rows_total{{method="{method}",route="{route}"}} {value}')
+        return lines
+
+
+def render_histograms(name: str, help: str, histograms: dict) -> list[str]:
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+    for (method, route), histogram in sorted(histograms.items()):
+        labels = f'method="{method}",route="{route}"'
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+        lines.append(f"{name}_sum{{{labels}}} {histogram.sum:.6f}")
+        lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+    return lines
+
+
+route_metrics = RouteMetrics()
+
+
+class StackSampler:
+    # Sampling profiler: a daemon thread records the stacks of the other threads every interval.
+    # The samples are aggregated as collapsed stacks (frame;frame;frame count), the input format
+    # of flamegraph.pl and speedscope.
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples = Counter()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="stack-sampler", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        current = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == current:
+                    continue
+                stack = ";".join(f"{entry.name} ({os.path.basename(entry.filename)}:{entry.lineno})"
+                                 for entry in traceback.extract_stack(frame))
+                with self.lock:
+                    self.samples[stack] += 1
+
+    def render(self) -> str:
+        with self.lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+stack_sampler = StackSampler(PROFILER_INTERVAL_MS / 1000) if PROFILER_INTERVAL_MS > 0 else None
+
+
+def get_route(request: Request) -> str:
+    route = request.scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+
+async def instrument_request(request: Request, call_next):
+    # Middleware: measure the request and the SQL statements it runs. The statistics are shared
+    # with the handler (and its threadpool worker or run_sync greenlet) through a context variable.
+    stats = new_request_stats(f"{request.method} {request.url.path}")
+    token = request_stats.set(stats)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        request_stats.reset(token)
+    # The headers are sent before the body: for streamed responses (the exports) Server-Timing
+    # only covers the work done before their body
+    duration = time.perf_counter() - start
+    response.headers["Server-Timing"] = (f'db;dur={stats["db_time"] * 1000:.2f};desc="{stats["statements"]} statements, '
+                                         f'{stats["rows"]} rows", total;dur={duration * 1000:.2f}')
+    response.body_iterator = observe_body(request, response, response.body_iterator, stats, start)
+    return response
+
+
+async def observe_body(request: Request, response, body_iterator, stats: dict, start: float):
+    # The body is produced while it is sent (and its statements are counted in the same stats):
+    # the request is recorded once it has been sent, or when the client disconnects
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        duration = time.perf_counter() - start
+        route = get_route(request)
+        route_metrics.observe(request.method, route, response.status_code, duration, stats)
+        if SLOW_REQUEST_MS > 0 and duration * 1000 >= SLOW_REQUEST_MS:
+            slow_request_logger.warning("Slow request (%.1f ms): %s %s (%s) with %d statements, %.1f ms in the database, %d rows",
+                                        duration * 1000, request.method, request.url.path, route,
+                                        stats["statements"], stats["db_time"] * 1000, stats["rows"])
+
+
+def render_cache_metrics() -> list[str]:
+    lines = []
+    for name, value in response_cache.stats().items():
+        if name in ("size", "max_size"):
+            lines += [f"# TYPE splitwithme_cache_{name} gauge", f"splitwithme_cache_{name} {value}"]
+        else:
+            lines += [f"# TYPE splitwithme_cache_{name}_total counter", f"splitwithme_cache_{name}_total {value}"]
+    return lines
+
+
+@router.get("/metrics", summary="Get request, SQL and cache metrics in the Prometheus text format",
+         response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse("\n".join(route_metrics.render() + render_cache_metrics()) + "\n",
+                             media_type="text/plain; version=0.0.4")
+
+
+@router.get("/metrics/profile", summary="Get the samples of the profiler as collapsed stacks",
+         response_class=PlainTextResponse,
+         responses={404: {"model": Message}})
+def get_profile():
+    if stack_sampler is None:
+        raise HTTPException(status_code=404, detail="Profiler disabled (set SPLITWITHME_PROFILER_INTERVAL_MS)")
+    return stack_sampler.render()
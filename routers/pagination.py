@@ -0,0 +1,73 @@
+from typing import Any, Optional
+from fastapi import HTTPException, Query
+from sqlalchemy import Date, tuple_
+import base64
+import datetime
+import json
+import sys
+
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Query parameters shared by every paginated list
+Cursor = Query(default=None, description="`next_cursor` returned by the previous page")
+Limit = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Number of items per page")
+
+
+def encode_cursor(sort_value: Any, id: int) -> str:
+    if isinstance(sort_value, datetime.date):
+        sort_value = sort_value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([sort_value, id]).encode()).decode()
+
+
+def decode_cursor(cursor: str, sort_column=None) -> tuple[Any, int]:
+    try:
+        sort_value, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if sort_column is not None and isinstance(sort_column.type, Date):
+            sort_value = datetime.date.fromisoformat(sort_value)
+        return sort_value, int(id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=422, detail=f"Malformed cursor '{cursor}'")
+
+
+def paginate(statement, id_column, cursor: Optional[str], limit: int, sort_column=None, descending: bool = False):
+    # Keyset pagination: rows are ordered by (sort_column, id_column) and the page starts right
+    # after the key stored in the cursor, so every page is an index range scan.
+    # One extra row is fetched to know whether there is a next page.
+    if sort_column is None or sort_column is id_column:
+        sort_key = [id_column]
+    else:
+        sort_key = [sort_column, id_column]
+    if cursor is not None:
+        sort_value, id = decode_cursor(cursor, sort_column)
+        key = id_column if len(sort_key) == 1 else tuple_(sort_column, id_column)
+        last_key = id if len(sort_key) == 1 else tuple_(sort_value, id)
+        statement = statement.where(key < last_key if descending else key > last_key)
+    order = [column.desc() for column in sort_key] if descending else sort_key
+    return statement.order_by(*order).limit(limit + 1)
+
+
+def get_next_cursor(rows: list, limit: int, get_key) -> Optional[str]:
+    # Remove the extra row fetched by paginate and build the cursor of the next page
+    if len(rows) <= limit:
+        return None
+    del rows[limit:]
+    return encode_cursor(*get_key(rows[-1]))
+
+
+def get_prefix_upper_bound(prefix: str) -> Optional[str]:
+    # Smallest string greater than every string starting with prefix (None if there is none,
+    # e.g. when it only has U+10FFFF characters, the last code point)
+    prefix = prefix.rstrip(chr(sys.maxunicode))
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def prefix_range(column, prefix: str):
+    # Index friendly equivalent of column LIKE 'prefix%' (case sensitive)
+    upper_bound = get_prefix_upper_bound(prefix)
+    if upper_bound is None:
+        return column >= prefix
+    return (column >= prefix) & (column < upper_bound)
@@ -0,0 +1,79 @@
+from fastapi import APIRouter, Depends, HTTPException
+from persistence.database import get_read_session, db_handler
+from persistence.models import Message, Friend, Expense, FriendExpenseLink, Page, PeriodReport, FriendPeriodReport
+from routers.pagination import Cursor, Limit, paginate, get_next_cursor
+from sqlmodel import Session, select, func
+from sqlalchemy import Date, type_coerce
+
+from typing import Literal, Optional
+from datetime import date
+
+
+router = APIRouter(
+    prefix = "/reports",
+    tags=["reports"]
+)
+
+# First day of the period of a date (weeks start on Monday)
+PERIODS = {
+    "day": lambda column: func.date(column),
+    "week": lambda column: func.date(column, "weekday 0", "-6 days"),
+    "month": lambda column: func.strftime("%Y-%m-01", column),
+    "year": lambda column: func.strftime("%Y-01-01", column),
+}
+
+
+def get_period(period: str):
+    return type_coerce(PERIODS[period](Expense.date), Date).label("period")
+
+
+def filter_dates(statement, date_from: Optional[date], date_to: Optional[date]):
+    # Range over the date index: only the expenses of the reported periods are read
+    if date_from is not None:
+        statement = statement.where(Expense.date >= date_from)
+    if date_to is not None:
+        statement = statement.where(Expense.date <= date_to)
+    return statement
+
+
+@router.get("/expenses", summary="Get Expense totals by period",
+         responses={200: {"model": list[PeriodReport]}, 422: {"model": Message}})
+@db_handler
+def get_expenses_report(period: Literal["day", "week", "month", "year"] = "month",
+                        date_from: Optional[date] = None, date_to: Optional[date] = None,
+                        session: Session = Depends(get_read_session)) -> list[PeriodReport]:
+    # spend: amount of the expenses, credit: paid by the friends, debit: share of the friends
+    period_column = get_period(period)
+    statement = (select(period_column, func.count(), func.sum(Expense.amount), func.sum(Expense.credit_balance),
+                        func.sum(Expense.amount - Expense.amount / Expense.num_friends))
+                 .group_by(period_column)
+                 .order_by(period_column))
+    rows = session.exec(filter_dates(statement, date_from, date_to)).all()
+    return [PeriodReport(period=period, num_expenses=num_expenses, spend=spend, credit=credit, debit=debit)
+            for period, num_expenses, spend, credit, debit in rows]
+
+
+@router.get("/friends", summary="Get Friend totals by period",
+         responses={200: {"model": Page[FriendPeriodReport]}, 404: {"model": Message}, 422: {"model": Message}})
+@db_handler
+def get_friends_report(period: Literal["day", "week", "month", "year"] = "month",
+                       date_from: Optional[date] = None, date_to: Optional[date] = None,
+                       friend_id: Optional[int] = None,
+                       cursor: Optional[str] = Cursor, limit: int = Limit,
+                       session: Session = Depends(get_read_session)) -> Page[FriendPeriodReport]:
+    # spend: amount of the friend's expenses, credit: paid by the friend, debit: share of the friend
+    period_column = get_period(period)
+    statement = (select(period_column, FriendExpenseLink.friend_id, func.count(), func.sum(Expense.amount),
+                        func.sum(FriendExpenseLink.amount), func.sum(Expense.amount / Expense.num_friends))
+                 .join(Expense, Expense.id == FriendExpenseLink.expense_id)
+                 .group_by(period_column, FriendExpenseLink.friend_id))
+    if friend_id is not None:
+        if session.exec(select(Friend.id).where(Friend.id == friend_id)).first() is None:
+            raise HTTPException(status_code=404, detail=f"Friend '{friend_id}' not found")
+        statement = statement.where(FriendExpenseLink.friend_id == friend_id)
+    statement = paginate(filter_dates(statement, date_from, date_to), FriendExpenseLink.friend_id, cursor, limit, period_column)
+    rows = list(session.exec(statement).all())
+    next_cursor = get_next_cursor(rows, limit, lambda row: (row.period, row.friend_id))
+    reports = [FriendPeriodReport(period=period, friend_id=friend_id, num_expenses=num_expenses, spend=spend, credit=credit, debit=debit)
+               for period, friend_id, num_expenses, spend, credit, debit in rows]
+    return Page(items=reports, next_cursor=next_cursor)
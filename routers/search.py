@@ -0,0 +1,53 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from persistence.database import get_read_session, db_handler
+from persistence.models import Message, Friend, Expense, Page
+from persistence.search import expense_fts, friend_fts, to_match_query
+from routers.cache import cached
+from routers.pagination import Cursor, Limit, paginate, get_next_cursor
+from sqlmodel import Session, select
+
+from typing import Optional
+
+
+router = APIRouter(
+    prefix = "/search",
+    tags=["search"]
+)
+
+Text = Query(min_length=1, description="Words to search for. The last one, and those ending with `*`, can be incomplete (e.g. `trav* sev`)")
+
+
+def get_match_query(q: str) -> str:
+    match_query = to_match_query(q)
+    if not match_query:
+        raise HTTPException(status_code=422, detail=f"No words to search for in '{q}'")
+    return match_query
+
+
+def search(model, fts_table, column, q: str, cursor: Optional[str], limit: int, session: Session) -> Page:
+    # Best matches (lowest bm25 rank) first. The index lookup returns the matching rows only,
+    # and the pages are keyset paginated by (rank, id).
+    statement = (select(model, fts_table.c.rank)
+                 .join(fts_table, fts_table.c.rowid == model.id)
+                 .where(column.match(get_match_query(q))))
+    rows = list(session.exec(paginate(statement, fts_table.c.rowid, cursor, limit, fts_table.c.rank)).all())
+    next_cursor = get_next_cursor(rows, limit, lambda row: (row.rank, row[0].id))
+    return Page(items=[row[0] for row in rows], next_cursor=next_cursor)
+
+
+@router.get("/expenses", summary="Search Expenses by description",
+         responses={200: {"model": Page[Expense]}, 304: {"description": "Not modified"}, 422: {"model": Message}})
+@cached(lambda page: {"list:expenses"} | {f"expense:{expense.id}" for expense in page.items})
+@db_handler
+def search_expenses(q: str = Text, cursor: Optional[str] = Cursor, limit: int = Limit,
+                    session: Session = Depends(get_read_session)) -> Page[Expense]:
+    return search(Expense, expense_fts, expense_fts.c.description, q, cursor, limit, session)
+
+
+@router.get("/friends", summary="Search Friends by name",
+         responses={200: {"model": Page[Friend]}, 304: {"description": "Not modified"}, 422: {"model": Message}})
+@cached(lambda page: {"list:friends"} | {f"friend:{friend.id}" for friend in page.items})
+@db_handler
+def search_friends(q: str = Text, cursor: Optional[str] = Cursor, limit: int = Limit,
+                   session: Session = Depends(get_read_session)) -> Page[Friend]:
+    return search(Friend, friend_fts, friend_fts.c.name, q, cursor, limit, session)
@@ -0,0 +1,40 @@
+from fastapi import APIRouter, Depends, Query
+from persistence.database import get_read_session, db_handler
+from persistence.models import Message, Settlement, Transfer
+from persistence.settlement import OWNER_ID, TOLERANCE, get_net_positions, plan_transfers
+from routers.cache import cached
+from sqlmodel import Session
+
+from typing import Optional
+from datetime import date
+
+
+router = APIRouter(
+    prefix = "/settlement",
+    tags=["settlement"]
+)
+
+
+def get_settlement_tags(settlement: Settlement) -> set[str]:
+    # The plan changes with the links (credits, participants and amounts) of its expenses
+    if settlement.expense_ids is not None:
+        return {f"expense:{expense_id}" for expense_id in settlement.expense_ids}
+    return {"expense:*"}
+
+
+@router.get("/", summary="Get the transfers that settle all the balances",
+         responses={200: {"model": Settlement}, 304: {"description": "Not modified"}, 422: {"model": Message}})
+@cached(get_settlement_tags)
+@db_handler
+def get_settlement(expense_id: Optional[list[int]] = Query(default=None, description="Only settle these expenses"),
+                   date_from: Optional[date] = None, date_to: Optional[date] = None,
+                   session: Session = Depends(get_read_session)) -> Settlement:
+    expense_ids = sorted(set(expense_id)) if expense_id is not None else None
+    positions = get_net_positions(session, expense_ids, date_from, date_to)
+    transfers = [Transfer(from_friend_id=from_id if from_id != OWNER_ID else None,
+                          to_friend_id=to_id if to_id != OWNER_ID else None,
+                          amount=amount)
+                 for from_id, to_id, amount in plan_transfers(positions)]
+    num_participants = sum(1 for position in positions.values() if abs(position) > TOLERANCE)
+    return Settlement(expense_ids=expense_ids, num_participants=num_participants,
+                      total=sum(transfer.amount for transfer in transfers), transfers=transfers)
@@ -0,0 +1,48 @@
+import os
+import sys
+import tempfile
+
+# The settings are read when the modules are imported, and the database is expenses.db in the
+# working directory: the tests run in a directory of their own, without the response cache (the
+# database is reset behind its back) and without the periodic balance snapshots.
+os.chdir(tempfile.mkdtemp(prefix="splitwithme-tests-"))
+os.environ.setdefault("SPLITWITHME_DB_PROFILE", "production")
+os.environ["SPLITWITHME_CACHE_SIZE"] = "0"
+os.environ["SPLITWITHME_SNAPSHOT_INTERVAL"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlmodel import SQLModel
+
+
+NUM_FRIENDS = 12
+NUM_EXPENSES = 8
+
+
+def reset_database():
+    # Same seeded data for every test
+    from persistence.database import engine
+    from persistence.history import snapshot_taker
+    from persistence.seed import init_db
+
+    with engine.begin() as connection:
+        for table in reversed(SQLModel.metadata.sorted_tables):
+            connection.execute(table.delete())
+        connection.exec_driver_sql("DELETE FROM sqlite_sequence")
+    init_db(NUM_FRIENDS, NUM_EXPENSES, seed=1)
+    snapshot_taker.run_once()
+
+
+@pytest.fixture(scope="session")
+def app():
+    import main
+
+    with TestClient(main.app):
+        yield main.app
+
+
+@pytest.fixture
+def client(app) -> TestClient:
+    reset_database()
+    return TestClient(app)
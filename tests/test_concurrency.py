@@ -0,0 +1,57 @@
+from concurrent.futures import ThreadPoolExecutor
+from fastapi.testclient import TestClient
+from persistence.balances import reconcile
+from persistence.database import engine
+from sqlmodel import Session
+
+
+# Concurrent writes on the same expense: every balance is updated from the stored values, in
+# the write transaction, so none of them is lost
+
+NUM_WRITERS = 30
+
+
+def run_concurrently(client: TestClient, requests: list[tuple]) -> list[int]:
+    def send(request):
+        method, url, params, body = request
+        return client.request(method, url, params=params, json=body).status_code
+
+    with ThreadPoolExecutor(8) as executor:
+        return list(executor.map(send, requests))
+
+
+def assert_reconciled():
+    with Session(engine) as session:
+        assert reconcile(session, repair=False) == []
+
+
+def create_friends(client: TestClient, count: int) -> list[int]:
+    return [client.post("/friends/", json={"name": f"Concurrent {index}"}).json()["id"] for index in range(count)]
+
+
+def test_concurrent_participants(client):
+    expense_id = client.post("/expenses/", json={"description": "Concurrent", "date": "2025-04-01", "amount": 300}).json()["id"]
+    friend_ids = create_friends(client, NUM_WRITERS)
+    statuses = run_concurrently(client, [("POST", f"/expenses/{expense_id}/friends", {"friend_id": friend_id}, None)
+                                         for friend_id in friend_ids])
+    assert statuses == [201] * NUM_WRITERS
+    assert client.get(f"/expenses/{expense_id}").json()["num_friends"] == NUM_WRITERS + 1
+    assert_reconciled()
+
+    # Credits, removals, amount updates and friend deletions on the same expense at the same time
+    requests = []
+    for index, friend_id in enumerate(friend_ids):
+        if index % 3 == 0:
+            requests.append(("DELETE", f"/expenses/{expense_id}/friends/{friend_id}", {}, None))
+        elif index % 3 == 1:
+            requests.append(("PUT", f"/expenses/{expense_id}/friends/{friend_id}", {"amount": 5}, None))
+        else:
+            requests.append(("DELETE", f"/friends/{friend_id}", {}, None))
+        requests.append(("PUT", f"/expenses/{expense_id}", {},
+                         {"description": "Concurrent", "date": "2025-04-01", "amount": 300 + index}))
+    statuses = run_concurrently(client, requests)
+    assert set(statuses) == {204}
+    expense = client.get(f"/expenses/{expense_id}").json()
+    assert expense["num_friends"] == NUM_WRITERS // 3 + 1
+    assert expense["credit_balance"] == 5 * (NUM_WRITERS // 3)
+    assert_reconciled()
@@ -0,0 +1,46 @@
+from persistence.changes import listeners
+from routers.events import EventHub, Subscription
+import asyncio
+import pytest
+
+
+@pytest.fixture
+def committed_events():
+    events = []
+
+    def listener(changes):
+        events.extend(changes["events"])
+
+    listeners.append(listener)
+    yield events
+    listeners.remove(listener)
+
+
+def test_events_carry_the_balances_of_their_transaction(client, committed_events):
+    # Two quick credits report each the balances after it, not the final ones
+    friend_id = client.post("/friends/", json={"name": "Events"}).json()["id"]
+    expense_id = client.post("/expenses/", json={"description": "Events", "date": "2025-01-02", "amount": 90}).json()["id"]
+    assert client.post(f"/expenses/{expense_id}/friends", params={"friend_id": friend_id}).status_code == 201
+    assert client.put(f"/expenses/{expense_id}/friends/{friend_id}", params={"amount": 10}).status_code == 204
+    assert client.put(f"/expenses/{expense_id}/friends/{friend_id}", params={"amount": 5}).status_code == 204
+    credits = [event for event in committed_events if event["type"] == "credit_updated"]
+    assert [event["friends"][0]["credit_balance"] for event in credits] == [10, 15]
+    assert [event["expenses"][0]["credit_balance"] for event in credits] == [10, 15]
+    assert credits[0]["friends"][0]["debit_balance"] == 45
+
+
+def test_deleted_friends_have_no_balances(client, committed_events):
+    assert client.delete("/friends/1").status_code == 204
+    assert committed_events[-1]["type"] == "friend_deleted"
+    assert committed_events[-1]["friends"] == []
+
+
+def test_closed_subscriptions_are_dropped():
+    # The loop of a disconnected client may be closed before it unsubscribes
+    hub = EventHub(10)
+    loop = asyncio.new_event_loop()
+    closed = Subscription(loop, None, None, None)
+    hub.subscribe(closed, None)
+    loop.close()
+    hub.dispatch([{"type": "friend_created", "friend_ids": [1], "expense_ids": [], "affected_friend_ids": []}])
+    assert hub.subscriptions == set()
@@ -0,0 +1,13 @@
+from routers.metrics import route_metrics
+
+
+def test_streamed_responses_are_recorded_after_their_body(client):
+    # The rows of an export are fetched while its body is sent
+    key = ("GET", "/export/expenses")
+    count = route_metrics.latency[key].count if key in route_metrics.latency else 0
+    rows = route_metrics.rows[key]
+    response = client.get("/export/expenses", params={"format": "csv"})
+    assert response.status_code == 200
+    assert route_metrics.latency[key].count == count + 1
+    # The header line is not a row
+    assert route_metrics.rows[key] - rows >= len(response.text.splitlines()) - 1
@@ -0,0 +1,100 @@
+from persistence.database import engine, read_engine
+from sqlalchemy import event
+import re
+
+
+# Requests that run every statement of the routers
+REQUESTS = [
+    ("GET", "/friends/", None),
+    ("GET", "/friends/?name_prefix=A", None),
+    ("GET", "/friends/?name_prefix=A&sort=name&descending=true", None),
+    ("GET", "/friends/2", None),
+    ("GET", "/friends/2?as_of=2100-01-01T00:00:00Z", None),
+    ("GET", "/friends/2/expenses", None),
+    ("GET", "/expenses/", None),
+    ("GET", "/expenses/?date_from=2024-01-01&date_to=2030-01-01&sort=date", None),
+    ("GET", "/expenses/?min_amount=10&max_amount=2000&sort=amount&descending=true", None),
+    ("GET", "/expenses/1", None),
+    ("GET", "/expenses/1?as_of=2100-01-01T00:00:00Z", None),
+    ("GET", "/expenses/1/friends", None),
+    ("GET", "/expenses/1/friends/2", None),
+    ("GET", "/export/expenses", None),
+    ("GET", "/export/expenses?since=2025-01-01&format=csv", None),
+    ("GET", "/export/friends", None),
+    ("GET", "/reports/expenses", None),
+    ("GET", "/reports/expenses?period=week&date_from=2025-01-01&date_to=2025-06-30", None),
+    ("GET", "/reports/friends?friend_id=2", None),
+    ("GET", "/reports/friends?date_from=2025-01-01&date_to=2025-06-30", None),
+    ("GET", "/settlement/", None),
+    ("GET", "/settlement/?expense_id=1&expense_id=2", None),
+    ("GET", "/settlement/?date_from=2025-01-01&date_to=2025-06-30", None),
+    ("GET", "/search/expenses?q=travel", None),
+    ("GET", "/search/friends?q=a", None),
+    ("POST", "/friends/", {"name": "New"}),
+    ("PUT", "/friends/13", {"name": "Renamed"}),
+    ("POST", "/expenses/", {"description": "New", "date": "2025-01-02", "amount": 90}),
+    ("POST", "/expenses/batch", [{"description": "Batch", "date": "2025-01-03", "amount": 30}]),
+    ("PUT", "/expenses/9", {"description": "New", "date": "2025-01-02", "amount": 120}),
+    ("POST", "/expenses/9/friends?friend_id=13", None),
+    ("POST", "/expenses/friends/batch", [{"expense_id": 9, "friend_id": 1}, {"expense_id": 10, "friend_id": 1}]),
+    ("PUT", "/expenses/9/friends/13?amount=10", None),
+    ("PUT", "/expenses/friends/batch", [{"expense_id": 9, "friend_id": 1, "amount": 5}]),
+    ("PUT", "/expenses/9/friends/13?amount=-10", None),
+    ("DELETE", "/expenses/9/friends/13", None),
+    ("DELETE", "/friends/13", None),
+    ("DELETE", "/expenses/10", None),
+]
+
+# Full scans on purpose: the statement reads every row of the table anyway
+FULL_SCANS = {
+    ("/export/expenses", "expense"): "exports every expense",
+    ("/export/friends", "friend"): "exports every friend",
+    ("/reports/expenses", "expense"): "totals of every expense",
+    ("/reports/friends", "friendexpenselink"): "totals of every friend",
+    ("/settlement/", "friendexpenselink"): "settles every expense",
+    ("/settlement/", "friend"): "settles every friend",
+}
+
+# SCAN of a table without an index (not of an index, a full-text index or a VALUES list)
+SCAN = re.compile(r"^SCAN (?!(?:\d+ )?CONSTANT ROW)(\w+)\b(?! USING (?:COVERING )?INDEX| VIRTUAL TABLE)")
+
+
+def is_full_scan(path: str, table: str, statement: str) -> bool:
+    if (path, table) in FULL_SCANS:
+        return False
+    # A page in primary key order reads the table in rowid order and stops at the limit
+    return re.search(rf"ORDER BY {table}\.id(?: DESC)?\s+LIMIT", statement) is None
+
+
+def capture_statements(statements: list):
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "INSERT", "WITH")):
+            statements.append((statement, parameters[0] if executemany else parameters))
+    return before_cursor_execute
+
+
+def test_router_statements_use_indexes(client):
+    statements = []
+    listener = capture_statements(statements)
+    engines = {engine, read_engine}
+    for sql_engine in engines:
+        event.listen(sql_engine, "before_cursor_execute", listener)
+    try:
+        captured = []
+        for method, url, body in REQUESTS:
+            del statements[:]
+            response = client.request(method, url, json=body)
+            assert response.status_code < 400, (method, url, response.status_code, response.text)
+            captured += [(url.split("?")[0], statement, parameters) for statement, parameters in statements]
+    finally:
+        for sql_engine in engines:
+            event.remove(sql_engine, "before_cursor_execute", listener)
+
+    full_scans = []
+    with engine.connect() as connection:
+        for path, statement, parameters in captured:
+            for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters):
+                match = SCAN.match(row[3])
+                if match and is_full_scan(path, match.group(1), statement):
+                    full_scans.append(f"{path}: {row[3]} in {' '.join(statement.split())}")
+    assert not full_scans, "\n".join(full_scans)
@@ -0,0 +1,316 @@
+from conftest import NUM_FRIENDS, NUM_EXPENSES, reset_database
+from fastapi.testclient import TestClient
+from persistence.database import DB_MODE, engine
+from persistence.memory_repository import MemoryRepository
+from persistence.sql_repository import SqlRepository
+from persistence.storage import get_repository, get_read_repository
+from sqlmodel import Session
+import random
+import pytest
+
+
+# The same requests must get the same responses from both repositories: the routers only see the
+# Repository interface. Only the friends, expenses and friend_expenses routers are served from memory.
+
+
+def use_storage(app, storage: str):
+    # Serve the app from a repository loaded from the seeded database
+    app.dependency_overrides.clear()
+    if storage == "memory":
+        repository = MemoryRepository()
+        repository.load(engine)
+        app.dependency_overrides[get_repository] = app.dependency_overrides[get_read_repository] = lambda: repository
+
+
+@pytest.fixture(params=["sqlite", "memory"])
+def storage_client(request, app) -> TestClient:
+    if request.param == "memory" and DB_MODE == "async":
+        # The async handlers replace the repository dependencies
+        pytest.skip("the in-memory repository is served by the sync handlers")
+    reset_database()
+    use_storage(app, request.param)
+    yield TestClient(app)
+    app.dependency_overrides.clear()
+
+
+def get_all(client: TestClient, url: str, limit: int = 3, **params) -> list[dict]:
+    # Every item of a paginated list, page by page
+    items = []
+    cursor = None
+    while True:
+        response = client.get(url, params={**params, "limit": limit, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200, response.text
+        page = response.json()
+        assert len(page["items"]) <= limit
+        items += page["items"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return items
+
+
+def create_expense(client: TestClient, description: str, amount: float, friend_ids: list[int]) -> int:
+    expense_id = client.post("/expenses/", json={"description": description, "date": "2025-02-03", "amount": amount}).json()["id"]
+    for friend_id in friend_ids:
+        assert client.post(f"/expenses/{expense_id}/friends", params={"friend_id": friend_id}).status_code == 201
+    return expense_id
+
+
+def test_balances_match_the_links(storage_client):
+    client = storage_client
+    friend_id = client.post("/friends/", json={"name": "Balances"}).json()["id"]
+    expense_id = create_expense(client, "Balances", 90, [1, 2, friend_id])
+    assert client.put(f"/expenses/{expense_id}/friends/{friend_id}", params={"amount": 30}).status_code == 204
+    assert client.put(f"/expenses/{expense_id}/friends/1", params={"amount": 12.5}).status_code == 204
+    assert client.put("/expenses/friends/batch", json=[{"expense_id": expense_id, "friend_id": 2, "amount": 7}]).status_code == 200
+    assert client.put(f"/expenses/{expense_id}", json={"description": "Balances", "date": "2025-02-03", "amount": 120}).status_code == 204
+    assert client.put(f"/expenses/{expense_id}/friends/2", params={"amount": -7}).status_code == 204
+    assert client.delete(f"/expenses/{expense_id}/friends/2").status_code == 204
+    other_id = create_expense(client, "Deleted", 40, [friend_id, 3])
+    assert client.put(f"/expenses/{other_id}/friends/3", params={"amount": 10}).status_code == 204
+    assert client.delete(f"/expenses/{other_id}").status_code == 204
+
+    for friend in get_all(client, "/friends/", limit=50):
+        friend_expenses = get_all(client, f"/friends/{friend['id']}/expenses")
+        assert friend["credit_balance"] == pytest.approx(sum(expense["credit_balance"] for expense in friend_expenses))
+        assert friend["debit_balance"] == pytest.approx(sum(expense["debit_balance"] for expense in friend_expenses))
+        for expense in friend_expenses:
+            assert expense["debit_balance"] == pytest.approx(expense["amount"] / expense["num_friends"])
+    for expense in get_all(client, "/expenses/", limit=50):
+        expense_friends = get_all(client, f"/expenses/{expense['id']}/friends")
+        assert expense["num_friends"] == len(expense_friends) + 1
+        assert expense["credit_balance"] == pytest.approx(sum(friend["credit_balance"] for friend in expense_friends))
+    assert client.get(f"/friends/{friend_id}").json()["credit_balance"] == 30
+    assert client.get(f"/expenses/{expense_id}").json()["credit_balance"] == 42.5
+
+
+@pytest.mark.parametrize("storage", ["sqlite", "memory"])
+def test_credits_of_removed_links_are_not_added(app, storage):
+    # The batch checks the links before crediting them: a link removed meanwhile adds no credit
+    reset_database()
+    with Session(engine) as session:
+        if storage == "memory":
+            repository = MemoryRepository()
+            repository.load(engine)
+        else:
+            repository = SqlRepository(session)
+        removed_id, other_id = [expense.id for expense in repository.get_friend_expenses(1, None, 2)][:2]
+        repository.remove_participant(repository.get_link(removed_id, 1))
+        credit_balance = repository.get_friend(1).credit_balance
+        assert repository.add_credits([(removed_id, 1, 5)]) == [None]
+        assert repository.add_credits([(other_id, 1, 5), (removed_id, 1, 5)], atomic=True)[1] is None
+        assert repository.get_friend(1).credit_balance == pytest.approx(credit_balance)
+        assert repository.get_expense(removed_id).credit_balance == 0
+        new_amounts = repository.add_credits([(other_id, 1, 5), (removed_id, 1, 5)])
+        assert new_amounts == [repository.get_link(other_id, 1).amount, None]
+        assert repository.get_friend(1).credit_balance == pytest.approx(credit_balance + 5)
+
+
+@pytest.mark.parametrize("url, params, key", [
+    ("/friends/", {}, lambda friend: friend["id"]),
+    ("/friends/", {"sort": "name"}, lambda friend: (friend["name"], friend["id"])),
+    ("/friends/", {"sort": "name", "descending": True}, lambda friend: (friend["name"], friend["id"])),
+    ("/friends/", {"name_prefix": "A"}, lambda friend: friend["id"]),
+    ("/expenses/", {"descending": True}, lambda expense: expense["id"]),
+    ("/expenses/", {"sort": "date"}, lambda expense: (expense["date"], expense["id"])),
+    ("/expenses/", {"sort": "amount", "descending": True, "min_amount": 100}, lambda expense: (expense["amount"], expense["id"])),
+    ("/expenses/", {"date_from": "2025-01-01"}, lambda expense: expense["id"]),
+])
+def test_pagination(storage_client, url, params, key):
+    items = get_all(storage_client, url, **params)
+    assert items == get_all(storage_client, url, limit=500, **params)
+    assert [key(item) for item in items] == sorted(map(key, items), reverse=params.get("descending", False))
+    assert len({item["id"] for item in items}) == len(items)
+    if url == "/friends/" and not params:
+        assert len(items) == NUM_FRIENDS
+    if url == "/expenses/" and list(params) == ["descending"]:
+        assert len(items) == NUM_EXPENSES
+
+
+def test_link_pagination(storage_client):
+    client = storage_client
+    expense_id = create_expense(client, "Pages", 60, list(range(1, NUM_FRIENDS + 1)))
+    expense_friends = get_all(client, f"/expenses/{expense_id}/friends", limit=5)
+    assert [friend["id"] for friend in expense_friends] == list(range(1, NUM_FRIENDS + 1))
+    friend_expenses = get_all(client, "/friends/1/expenses", limit=2)
+    assert [expense["id"] for expense in friend_expenses] == sorted(expense["id"] for expense in friend_expenses)
+    assert friend_expenses[-1]["id"] == expense_id
+
+
+def test_error_codes(storage_client):
+    client = storage_client
+    missing_id = 1000
+    for url in (f"/friends/{missing_id}", f"/friends/{missing_id}/expenses", f"/expenses/{missing_id}",
+                f"/expenses/{missing_id}/friends", f"/expenses/1/friends/{missing_id}"):
+        assert client.get(url).status_code == 404, url
+    assert client.put(f"/friends/{missing_id}", json={"name": "Missing"}).status_code == 404
+    assert client.delete(f"/friends/{missing_id}").status_code == 404
+    assert client.put(f"/expenses/{missing_id}", json={"description": "Missing", "date": "2025-01-01", "amount": 1}).status_code == 404
+    assert client.delete(f"/expenses/{missing_id}").status_code == 404
+    assert client.post(f"/expenses/{missing_id}/friends", params={"friend_id": 1}).status_code == 404
+    assert client.post(f"/expenses/1/friends", params={"friend_id": missing_id}).status_code == 404
+    assert client.put(f"/expenses/1/friends/{missing_id}", params={"amount": 1}).status_code == 404
+    assert client.delete(f"/expenses/1/friends/{missing_id}").status_code == 404
+
+    expense = client.get("/expenses/1").json()
+    duplicate = {"description": expense["description"], "date": expense["date"], "amount": 1}
+    assert client.post("/expenses/", json=duplicate).status_code == 409
+    assert client.put("/expenses/2", json=duplicate).status_code == 409
+    assert client.post("/friends/", json={"id": 1, "name": "Duplicate"}).status_code == 409
+    friend_id = client.post("/friends/", json={"name": "Errors"}).json()["id"]
+    expense_id = create_expense(client, "Errors", 30, [friend_id])
+    assert client.post(f"/expenses/{expense_id}/friends", params={"friend_id": friend_id}).status_code == 409
+    assert client.put(f"/expenses/{expense_id}/friends/{friend_id}", params={"amount": 5}).status_code == 204
+    assert client.delete(f"/expenses/{expense_id}/friends/{friend_id}").status_code == 409
+    assert client.delete(f"/friends/{friend_id}").status_code == 409
+
+    assert client.post("/expenses/", json={"description": "Errors", "date": "2025-13-01", "amount": 1}).status_code == 422
+    assert client.get("/friends/", params={"cursor": "not a cursor"}).status_code == 422
+    assert client.get("/expenses/", params={"limit": 0}).status_code == 422
+    assert client.get("/friends/1", params={"as_of": "2000-01-01T00:00:00Z"}).status_code == 422
+
+    results = client.post("/expenses/friends/batch", json=[{"expense_id": expense_id, "friend_id": 1},
+                                                         {"expense_id": missing_id, "friend_id": 1},
+                                                         {"expense_id": expense_id, "friend_id": friend_id}]).json()
+    # Atomic by default: the valid item is not applied either
+    assert [result["status_code"] for result in results] == [424, 404, 409]
+
+
+def test_ids_are_never_reused(storage_client):
+    client = storage_client
+    friend_id = client.post("/friends/", json={"name": "Deleted"}).json()["id"]
+    assert client.delete(f"/friends/{friend_id}").status_code == 204
+    assert client.post("/friends/", json={"name": "New"}).json()["id"] == friend_id + 1
+    expense_id = create_expense(client, "Deleted", 10, [])
+    assert client.delete(f"/expenses/{expense_id}").status_code == 204
+    assert create_expense(client, "New", 10, []) == expense_id + 1
+
+
+@pytest.mark.skipif(DB_MODE == "async", reason="the in-memory repository is served by the sync handlers")
+def test_memory_ids_continue_the_database(app):
+    # The ids deleted before the repository is loaded are not reused either
+    reset_database()
+    client = TestClient(app)
+    assert client.delete(f"/expenses/{NUM_EXPENSES}").status_code == 204
+    friend_id = client.post("/friends/", json={"name": "Deleted"}).json()["id"]
+    assert client.delete(f"/friends/{friend_id}").status_code == 204
+    try:
+        use_storage(app, "memory")
+        assert client.post("/friends/", json={"name": "New"}).json()["id"] == friend_id + 1
+        assert create_expense(client, "New", 10, []) == NUM_EXPENSES + 1
+        # Nothing is written to the database
+        app.dependency_overrides.clear()
+        assert client.get(f"/friends/{friend_id + 1}").status_code == 404
+    finally:
+        app.dependency_overrides.clear()
+
+
+def get_workload(seed: int, num_requests: int) -> list[tuple]:
+    # Random (method, url, params, body) requests on existing and missing ids, so they succeed
+    # and fail in every way
+    rng = random.Random(seed)
+    requests = []
+    num_friends = NUM_FRIENDS
+    num_expenses = NUM_EXPENSES
+    for index in range(num_requests):
+        friend_id = rng.randint(1, num_friends + 2)
+        expense_id = rng.randint(1, num_expenses + 2)
+        expense = {"description": rng.choice(["Dinner", "Taxi", "Hotel"]), "date": f"2025-03-{rng.randint(1, 3):02}",
+                   "amount": rng.choice([30, 45, 100])}
+        kind = rng.choice(["add_friend", "add_expense", "add_participant", "add_participant", "credit", "credit",
+                           "remove_participant", "update_expense", "delete_expense", "delete_friend", "rename_friend", "read"])
+        if kind == "add_friend":
+            num_friends += 1
+            requests.append(("POST", "/friends/", {}, {"name": rng.choice(["Ana", "Bea", "Carla"])}))
+        elif kind == "add_expense":
+            num_expenses += 1
+            requests.append(("POST", "/expenses/", {}, expense))
+        elif kind == "add_participant":
+            requests.append(("POST", f"/expenses/{expense_id}/friends", {"friend_id": friend_id}, None))
+        elif kind == "credit":
+            requests.append(("PUT", f"/expenses/{expense_id}/friends/{friend_id}", {"amount": rng.choice([5, 12.5, -5])}, None))
+        elif kind == "remove_participant":
+            requests.append(("DELETE", f"/expenses/{expense_id}/friends/{friend_id}", {}, None))
+        elif kind == "update_expense":
+            requests.append(("PUT", f"/expenses/{expense_id}", {}, expense))
+        elif kind == "delete_expense":
+            requests.append(("DELETE", f"/expenses/{expense_id}", {}, None))
+        elif kind == "delete_friend":
+            requests.append(("DELETE", f"/friends/{friend_id}", {}, None))
+        elif kind == "rename_friend":
+            requests.append(("PUT", f"/friends/{friend_id}", {}, {"name": rng.choice(["Dani", "Eva"])}))
+        else:
+            requests.append(rng.choice([("GET", f"/friends/{friend_id}", {}, None),
+                                        ("GET", f"/expenses/{expense_id}", {}, None),
+                                        ("GET", f"/friends/{friend_id}/expenses", {}, None),
+                                        ("GET", f"/expenses/{expense_id}/friends", {}, None),
+                                        ("GET", "/friends/", {"sort": "name", "limit": 500}, None),
+                                        ("GET", "/expenses/", {"sort": "amount", "limit": 500}, None)]))
+    return requests
+
+
+def round_floats(value):
+    # The balances are updated in the same order, but sums may still differ in the last bits
+    if isinstance(value, float):
+        return round(value, 6)
+    if isinstance(value, list):
+        return [round_floats(item) for item in value]
+    if isinstance(value, dict):
+        return {key: round_floats(item) for key, item in value.items()}
+    return value
+
+
+def run_workload(app, storage: str, requests: list[tuple]) -> list[tuple]:
+    reset_database()
+    use_storage(app, storage)
+    client = TestClient(app)
+    responses = []
+    for method, url, params, body in requests:
+        response = client.request(method, url, params=params, json=body)
+        responses.append((method, url, response.status_code, round_floats(response.json()) if response.content else None))
+    # The max ids of the seeded data, deleted if the workload did not delete them
+    link_url = f"/expenses/{NUM_EXPENSES}/friends/{NUM_FRIENDS}"
+    link = client.get(link_url)
+    if link.status_code == 200 and link.json()["credit_balance"]:
+        assert client.put(link_url, params={"amount": -link.json()["credit_balance"]}).status_code == 204
+    assert client.delete(link_url).status_code == (204 if link.status_code == 200 else 404)
+    expense_status = client.get(f"/expenses/{NUM_EXPENSES}").status_code
+    assert client.delete(f"/expenses/{NUM_EXPENSES}").status_code == (204 if expense_status == 200 else 404)
+    friend = client.get(f"/friends/{NUM_FRIENDS}")
+    friend_status = client.delete(f"/friends/{NUM_FRIENDS}").status_code
+    if friend.status_code == 200:
+        assert friend_status == (409 if friend.json()["credit_balance"] else 204)
+    else:
+        assert friend_status == 404
+    # The max ids, created after the workload and deleted: the new ones come after them
+    last_friend_id = client.post("/friends/", json={"name": "Last"}).json()["id"]
+    last_expense_id = create_expense(client, "Last", 10, [last_friend_id])
+    assert client.delete(f"/expenses/{last_expense_id}/friends/{last_friend_id}").status_code == 204
+    assert client.delete(f"/expenses/{last_expense_id}").status_code == 204
+    assert client.delete(f"/friends/{last_friend_id}").status_code == 204
+    new_friend = client.post("/friends/", json={"name": "Last"}).json()
+    new_expense = client.post("/expenses/", json={"description": "Last", "date": "2025-04-01", "amount": 10}).json()
+    assert (new_friend["id"], new_expense["id"]) == (last_friend_id + 1, last_expense_id + 1)
+    for new, url, num_seeded in ((new_friend, "/friends/", NUM_FRIENDS), (new_expense, "/expenses/", NUM_EXPENSES)):
+        created_ids = [body["id"] for method, request_url, status, body in responses
+                       if method == "POST" and request_url == url and status == 201]
+        assert new["id"] > max([num_seeded] + created_ids)
+    final = [friend_status,
+             new_friend,
+             new_expense,
+             get_all(client, "/friends/"),
+             [(expense, get_all(client, f"/expenses/{expense['id']}/friends")) for expense in get_all(client, "/expenses/")]]
+    return responses + round_floats(final)
+
+
+@pytest.mark.skipif(DB_MODE == "async", reason="the in-memory repository is served by the sync handlers")
+@pytest.mark.parametrize("seed", [1, 2])
+def test_same_responses(app, seed):
+    requests = get_workload(seed, 300)
+    try:
+        sqlite_responses = run_workload(app, "sqlite", requests)
+        memory_responses = run_workload(app, "memory", requests)
+    finally:
+        app.dependency_overrides.clear()
+    for sqlite_response, memory_response in zip(sqlite_responses, memory_responses):
+        assert sqlite_response == memory_response
+    assert {status for _, _, status, _ in sqlite_responses[:len(requests)]} >= {200, 201, 204, 404, 409}